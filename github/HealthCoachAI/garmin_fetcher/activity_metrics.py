@@ -0,0 +1,139 @@
+import numpy as np
+
+# ActivityGPS fields the metrics are computed from
+METRIC_SOURCE_FIELDS = ["DurationSeconds", "HeartRate", "Speed", "GradeAdjustedSpeed", "Power", "Altitude", "Distance"]
+HEART_RATE_ZONES = [0.5, 0.6, 0.7, 0.8, 0.9] # lower bound of zones 1 to 5, fraction of the maximum heart rate
+MAX_SAMPLE_SECONDS = 30 # a longer gap between two points is a pause, it counts for this long at most
+MOVING_SPEED = 0.5 # m/s
+NORMALIZED_POWER_WINDOW_SECONDS = 30
+ELEVATION_SMOOTHING_SECONDS = 15
+DECOUPLING_MIN_SECONDS = 600
+
+
+def activity_metrics_chunks(chunks, max_heart_rate=185, resting_heart_rate=60, split_meters=1000):
+    """Passes the point chunks of an activity through and yields a single ActivityMetrics point after them.
+
+    The metrics are computed at once from the value columns of the ActivityGPS points (see activity_metrics), so
+    queries read one row per activity instead of the whole track. Only compact value columns are kept until the last chunk.
+    """
+    columns = {field: [] for field in METRIC_SOURCE_FIELDS}
+    template = None
+    for chunk in chunks:
+        for point in chunk:
+            if point["measurement"] != "ActivityGPS":
+                continue
+            if template is None:
+                template = point
+            fields = point["fields"]
+            for field, values in columns.items():
+                values.append(fields.get(field))
+        yield chunk
+    if template is None:
+        return
+    values = {field: np.array([np.nan if value is None else value for value in column_values], dtype=float) for field, column_values in columns.items()}
+    fields = {"ActivityName": template["fields"].get("ActivityName"), "Activity_ID": template["fields"].get("Activity_ID")}
+    fields.update(activity_metrics(values, max_heart_rate, resting_heart_rate, split_meters))
+    yield [{"measurement": "ActivityMetrics", "time": template["time"], "tags": dict(template["tags"]), "fields": fields}]
+
+
+def activity_metrics(values, max_heart_rate=185, resting_heart_rate=60, split_meters=1000):
+    """Activity level metrics from {field: float array} columns of the ActivityGPS points (NaN for missing values), in time order.
+
+    Time in heart rate zones (fractions HEART_RATE_ZONES of max_heart_rate), Banister TRIMP, aerobic decoupling (drift of
+    speed per heart beat between the first and second half of the moving time, in %), normalized power, elevation gain
+    and loss of the smoothed altitude and grade adjusted pace (s/km) overall and per split_meters split. Metrics the
+    recorded values don't allow are left out.
+    """
+    duration = values["DurationSeconds"]
+    elapsed = np.isfinite(duration)
+    duration, values = duration[elapsed], {field: column[elapsed] for field, column in values.items()}
+    if len(duration) == 0:
+        return {}
+    sample_seconds = np.clip(np.diff(duration, append=duration[-1]), 0, MAX_SAMPLE_SECONDS)
+    heart_rate, speed = values["HeartRate"], values["Speed"]
+    moving = np.isfinite(speed) & (speed > MOVING_SPEED)
+    metrics = {
+        "Elapsed_Seconds": float(duration[-1] - duration[0]),
+        "Moving_Seconds": float(sample_seconds[moving].sum()),
+    }
+    with np.errstate(invalid="ignore"):
+        has_heart_rate = np.isfinite(heart_rate) & (heart_rate > 0)
+        if has_heart_rate.any():
+            zones = np.searchsorted(np.array(HEART_RATE_ZONES) * max_heart_rate, heart_rate, side="right")
+            zone_seconds = np.bincount(zones[has_heart_rate], weights=sample_seconds[has_heart_rate], minlength=len(HEART_RATE_ZONES) + 1)
+            for zone in range(1, len(HEART_RATE_ZONES) + 1):
+                metrics[f"HR_Zone_{zone}_Seconds"] = float(zone_seconds[zone])
+            reserve = np.clip((heart_rate[has_heart_rate] - resting_heart_rate) / (max_heart_rate - resting_heart_rate), 0, 1)
+            metrics["TRIMP"] = float(np.sum(sample_seconds[has_heart_rate] / 60 * reserve * 0.64 * np.exp(1.92 * reserve)))
+            metrics.update(aerobic_decoupling(speed, heart_rate, sample_seconds, moving & has_heart_rate))
+        metrics.update(normalized_power(duration, values["Power"]))
+        altitude = smoothed_altitude(duration, values["Altitude"])
+        if altitude is not None:
+            climb = np.diff(altitude[1])
+            metrics["Elevation_Gain"] = float(climb[climb > 0].sum())
+            metrics["Elevation_Loss"] = float(-climb[climb < 0].sum())
+        metrics.update(grade_adjusted_pace(duration, values, altitude, sample_seconds, moving, split_meters))
+    return metrics
+
+
+def aerobic_decoupling(speed, heart_rate, sample_seconds, valid):
+    moving_seconds = np.where(valid, sample_seconds, 0)
+    total = moving_seconds.sum()
+    if total < DECOUPLING_MIN_SECONDS:
+        return {}
+    first_half = valid & (np.cumsum(moving_seconds) <= total / 2)
+    second_half = valid & ~first_half
+    efficiency = [np.sum(speed[half] * sample_seconds[half]) / np.sum(heart_rate[half] * sample_seconds[half]) for half in [first_half, second_half]]
+    if not all(np.isfinite(efficiency)) or efficiency[0] <= 0:
+        return {}
+    return {"Aerobic_Decoupling": float((efficiency[0] - efficiency[1]) / efficiency[0] * 100)}
+
+
+def normalized_power(duration, power):
+    # 4th power mean of the 30 s rolling average power, resampled to one value per second
+    has_power = np.isfinite(power)
+    if has_power.sum() < 2 or duration[has_power][-1] - duration[has_power][0] < NORMALIZED_POWER_WINDOW_SECONDS:
+        return {}
+    seconds = np.arange(duration[has_power][0], duration[has_power][-1] + 1)
+    cumulative = np.concatenate([[0], np.cumsum(np.interp(seconds, duration[has_power], power[has_power]))])
+    rolling = (cumulative[NORMALIZED_POWER_WINDOW_SECONDS:] - cumulative[:-NORMALIZED_POWER_WINDOW_SECONDS]) / NORMALIZED_POWER_WINDOW_SECONDS
+    return {"Normalized_Power": float(np.mean(rolling ** 4) ** 0.25)}
+
+
+def smoothed_altitude(duration, altitude):
+    # (seconds, altitude) resampled to one value per second and smoothed with a centered moving average, None without altitude
+    has_altitude = np.isfinite(altitude)
+    if has_altitude.sum() < 2:
+        return None
+    seconds = np.arange(duration[has_altitude][0], duration[has_altitude][-1] + 1)
+    resampled = np.interp(seconds, duration[has_altitude], altitude[has_altitude])
+    window = min(ELEVATION_SMOOTHING_SECONDS, len(resampled))
+    padded = np.pad(resampled, (window // 2, window - 1 - window // 2), mode="edge")
+    return seconds, np.convolve(padded, np.ones(window) / window, mode="valid")
+
+
+def grade_adjusted_pace(duration, values, altitude, sample_seconds, moving, split_meters):
+    # Garmin's grade adjusted speed where the device recorded it, otherwise the speed scaled by Minetti's energy cost of running at the grade
+    distance, speed = values["Distance"], values["Speed"]
+    valid = moving & np.isfinite(distance)
+    if not valid.any():
+        return {}
+    grade = np.zeros(len(duration))
+    if altitude is not None:
+        rise = np.gradient(np.interp(duration, *altitude))
+        run = np.gradient(np.nan_to_num(distance))
+        grade = np.clip(np.where(run > 0.5, rise / np.where(run > 0.5, run, 1), 0), -0.45, 0.45)
+    cost = 155.4 * grade**5 - 30.4 * grade**4 - 43.3 * grade**3 + 46.3 * grade**2 + 19.5 * grade + 3.6
+    adjusted_speed = np.where(np.isfinite(values["GradeAdjustedSpeed"]), values["GradeAdjustedSpeed"], speed * cost / 3.6)
+    valid &= np.isfinite(adjusted_speed) & (adjusted_speed > 0)
+    if not valid.any():
+        return {}
+    weights = sample_seconds[valid]
+    metrics = {"Grade_Adjusted_Pace": float(1000 * weights.sum() / np.sum(adjusted_speed[valid] * weights))}
+    splits = np.maximum((distance[valid] - distance[valid][0]) // split_meters, 0).astype(np.int64)
+    split_seconds = np.bincount(splits, weights=weights)
+    split_meters_adjusted = np.bincount(splits, weights=adjusted_speed[valid] * weights)
+    for split, (seconds, meters) in enumerate(zip(split_seconds.tolist(), split_meters_adjusted.tolist()), start=1):
+        if seconds > 0 and meters > 0:
+            metrics[f"GAP_Split_{split}"] = 1000 * seconds / meters
+    return metrics
@@ -0,0 +1,350 @@
+import io, re, pytz
+import numpy as np
+import xml.etree.ElementTree as ET
+from datetime import datetime
+from fitparse import FitFile
+from fit_decoder import decode_fit, masked_list
+
+# Everything here is a pure function of its arguments (no Garmin or InfluxDB client, no logging) so it can run in worker processes
+ACTIVITY_SCHEMA_VERSION = 1 # bump whenever the activity points built here change, ingested activities are then derived again
+TCX_NAMESPACE = "{http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2}"
+TCX_EXTENSION_NAMESPACE = "{http://www.garmin.com/xmlschemas/ActivityExtension/v2}"
+TCX_ACTIVITY, TCX_LAP, TCX_TRACK, TCX_TRACKPOINT, TCX_ID = (TCX_NAMESPACE + tag for tag in ["Activity", "Lap", "Track", "Trackpoint", "Id"])
+# Trackpoint value elements (LatitudeDegrees sits in Position, Value in HeartRateBpm, Speed in Extensions/TPX)
+TCX_TRACKPOINT_VALUES = {
+    TCX_NAMESPACE + "Time": "Time",
+    TCX_NAMESPACE + "LatitudeDegrees": "Latitude",
+    TCX_NAMESPACE + "LongitudeDegrees": "Longitude",
+    TCX_NAMESPACE + "AltitudeMeters": "Altitude",
+    TCX_NAMESPACE + "DistanceMeters": "Distance",
+    TCX_NAMESPACE + "Value": "HeartRate",
+    TCX_EXTENSION_NAMESPACE + "Speed": "Speed",
+}
+NUMBER_PATTERN = re.compile(r"\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?\s*")
+
+
+class StreamingFitFile(FitFile):
+    # fitparse keeps every message it parsed in _messages - dropped here once handed out so memory does not grow with the file
+    def _parse_message(self):
+        message = super()._parse_message()
+        self._messages.clear()
+        return message
+
+
+def fit_file_member(zip_ref, activityID):
+    """Name of the FIT file in a download_activity(ORIGINAL) zip archive, raises FileNotFoundError if there is none."""
+    fit_filename = next((f for f in zip_ref.namelist() if f.endswith('.fit')), None)
+    if not fit_filename:
+        raise FileNotFoundError(f"No FIT file found in the downloaded zip archive for Activity ID {activityID}")
+    return fit_filename
+
+
+def chunked(points, chunk_size):
+    chunk = []
+    for point in points:
+        chunk.append(point)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def point_timestamp(point_time):
+    """Epoch seconds of a point time (ISO string), times without an offset (TCX points) being UTC."""
+    point_time = datetime.fromisoformat(point_time)
+    return (point_time if point_time.tzinfo else point_time.replace(tzinfo=pytz.UTC)).timestamp()
+
+
+def activity_tags(device, database, activityID, activity_start_time, activity_type):
+    return {
+        "Device": device,
+        "Database_Name": database,
+        "ActivityID": activityID,
+        "ActivitySelector": activity_start_time.strftime('%Y%m%dT%H%M%SUTC-') + activity_type
+    }
+
+
+def fit_gps_point(parsed_record, activityID, activity_type, activity_start_time, device, database):
+    return {
+        "measurement": "ActivityGPS",
+        "time": parsed_record['timestamp'].replace(tzinfo=pytz.UTC).isoformat(),
+        "tags": activity_tags(device, database, activityID, activity_start_time, activity_type),
+        "fields": {
+            "ActivityName": activity_type,
+            "Activity_ID": activityID,
+            "Latitude": int(parsed_record['position_lat']) * ( 180 / 2**31 ) if parsed_record.get('position_lat') else None,
+            "Longitude": int(parsed_record['position_long']) * ( 180 / 2**31 ) if parsed_record.get('position_long') else None,
+            "Altitude": parsed_record.get('enhanced_altitude', None) or parsed_record.get('altitude', None),
+            "Distance": parsed_record.get('distance', None),
+            "DurationSeconds": (parsed_record['timestamp'].replace(tzinfo=pytz.UTC) - activity_start_time).total_seconds(),
+            "HeartRate": float(parsed_record.get('heart_rate', None)) if parsed_record.get('heart_rate', None) else None,
+            "Speed": parsed_record.get('enhanced_speed', None) or parsed_record.get('speed', None),
+            "GradeAdjustedSpeed": (parsed_record.get("unknown_140") / 1000.0) if parsed_record.get("unknown_140") else None,
+            "RunningEfficiency": ((parsed_record.get("unknown_140") / 1000.0)/parsed_record.get('heart_rate')) if (parsed_record.get("unknown_140") and parsed_record.get('heart_rate')) else None,
+            "Cadence": parsed_record.get('cadence', None),
+            "Fractional_Cadence": parsed_record.get('fractional_cadence', None),
+            "Temperature": parsed_record.get('temperature', None),
+            "Accumulated_Power": parsed_record.get('accumulated_power', None),
+            "Power": parsed_record.get('power', None)
+        }
+    }
+
+
+def fit_session_point(session_record, activityID, activity_type, activity_start_time, device, database):
+    if not (session_record.get('start_time') or session_record.get('timestamp')):
+        return None
+    return {
+        "measurement": "ActivitySession",
+        "time": session_record['start_time'].replace(tzinfo=pytz.UTC).isoformat() or session_record['timestamp'].replace(tzinfo=pytz.UTC).isoformat(),
+        "tags": activity_tags(device, database, activityID, activity_start_time, activity_type),
+        "fields": {
+            "Index": int(session_record.get('message_index', -1)) + 1,
+            "ActivityName": activity_type,
+            "Activity_ID": activityID,
+            "Sport": str(session_record.get('sport', None)), # Avoid partial write error 400 see #152#issuecomment-3084539416
+            "Sub_Sport": session_record.get('sub_sport', None),
+            "Pool_Length": session_record.get('pool_length', None),
+            "Pool_Length_Unit": session_record.get('pool_length_unit', None),
+            "Lengths": session_record.get('num_laps', None),
+            "Laps": session_record.get('num_lengths', None),
+            "Aerobic_Training": session_record.get('total_training_effect', None),
+            "Anaerobic_Training": session_record.get('total_anaerobic_training_effect', None),
+            "Primary_Benefit": session_record.get('primary_benefit', None),
+            "Recovery_Time": session_record.get('recovery_time', None)
+        }
+    }
+
+
+def fit_length_point(length_record, activityID, activity_type, activity_start_time, device, database):
+    if not (length_record.get('start_time') or length_record.get('timestamp')):
+        return None
+    return {
+        "measurement": "ActivityLength",
+        "time": length_record['start_time'].replace(tzinfo=pytz.UTC).isoformat() or length_record['timestamp'].replace(tzinfo=pytz.UTC).isoformat(),
+        "tags": activity_tags(device, database, activityID, activity_start_time, activity_type),
+        "fields": {
+            "Index": int(length_record.get('message_index', -1)) + 1,
+            "ActivityName": activity_type,
+            "Activity_ID": activityID,
+            "Elapsed_Time": length_record.get('total_elapsed_time', None),
+            "Strokes": length_record.get('total_strokes', None),
+            "Swim_Stroke": length_record.get('swim_stroke', None),
+            "Avg_Speed": length_record.get('avg_speed', None),
+            "Calories": length_record.get('total_calories', None),
+            "Avg_Cadence": length_record.get('avg_swimming_cadence', None)
+        }
+    }
+
+
+def fit_lap_point(lap_record, activityID, activity_type, activity_start_time, device, database):
+    if not (lap_record.get('start_time') or lap_record.get('timestamp')):
+        return None
+    return {
+        "measurement": "ActivityLap",
+        "time": lap_record['start_time'].replace(tzinfo=pytz.UTC).isoformat() or lap_record['timestamp'].replace(tzinfo=pytz.UTC).isoformat(),
+        "tags": activity_tags(device, database, activityID, activity_start_time, activity_type),
+        "fields": {
+            "Index": int(lap_record.get('message_index', -1)) + 1,
+            "ActivityName": activity_type,
+            "Activity_ID": activityID,
+            "Elapsed_Time": lap_record.get('total_elapsed_time', None),
+            "Sport": lap_record.get('sport', None),
+            "Lengths": lap_record.get('num_lengths', None),
+            "Length_Index": lap_record.get('first_length_index', None),
+            "Distance": lap_record.get('total_distance', None),
+            "Cycles": lap_record.get('total_cycles', None),
+            "Avg_Stroke_Distance": lap_record.get('avg_stroke_distance', None),
+            "Moving_Duration": lap_record.get('total_moving_time', None),
+            "Standing_Duration": lap_record.get('time_standing', None),
+            "Avg_Speed": lap_record.get('enhanced_avg_speed', None),
+            "Max_Speed": lap_record.get('enhanced_max_speed', None),
+            "Calories": lap_record.get('total_calories', None),
+            "Avg_Power": lap_record.get('avg_power', None),
+            "Avg_HR": lap_record.get('avg_heart_rate', None),
+            "Max_HR": lap_record.get('max_heart_rate', None),
+            "Avg_Cadence": lap_record.get('avg_cadence', None),
+            "Avg_Temperature": lap_record.get('avg_temperature', None)
+        }
+    }
+
+
+
+FIT_SUMMARY_POINTS = {'session': fit_session_point, 'length': fit_length_point, 'lap': fit_lap_point}
+
+
+def iter_fit_activity(fit_file, activityID, activity_type, device, database, fast_decoder=False, chunk_size=10000):
+    """Yields the points of a FIT file (binary file object, e.g. an open zip member) in lists of at most chunk_size points :
+    ActivityGPS, ActivitySession, ActivityLength and ActivityLap.
+
+    Messages become points while the file is read and are dropped once their chunk is handed out, so memory stays
+    flat whatever the activity length. Raises FileNotFoundError if the file has no records and FitParseError if it
+    can't be parsed - fitparse checks the CRC at the end, after the chunks were yielded.
+    fast_decoder decodes the file with fit_decoder instead of fitparse (whole file at once, as compact NumPy columns).
+    """
+    if fast_decoder:
+        points = _decoded_fit_points(fit_file.read(), activityID, activity_type, device, database, chunk_size)
+    else:
+        points = _fitparse_points(fit_file, activityID, activity_type, device, database)
+    return chunked(points, chunk_size)
+
+
+def parse_fit_activity(fit_data, activityID, activity_type, device, database, fast_decoder=False, chunk_size=10000):
+    # List of the point chunks of a FIT file (bytes), for worker processes which can't hand out a generator
+    return list(iter_fit_activity(io.BytesIO(fit_data), activityID, activity_type, device, database, fast_decoder, chunk_size))
+
+
+def _fitparse_points(fit_file, activityID, activity_type, device, database):
+    activity_start_time = None
+    early_messages = [] # sessions, laps and lengths stored before the first record
+    for message in StreamingFitFile(fit_file).get_messages(['record', 'session', 'lap', 'length']):
+        parsed_record = message.get_values()
+        if message.name == 'record':
+            if activity_start_time is None:
+                activity_start_time = parsed_record['timestamp'].replace(tzinfo=pytz.UTC)
+                for name, early_record in early_messages:
+                    point = FIT_SUMMARY_POINTS[name](early_record, activityID, activity_type, activity_start_time, device, database)
+                    if point:
+                        yield point
+                early_messages = []
+            if parsed_record.get('timestamp'):
+                yield fit_gps_point(parsed_record, activityID, activity_type, activity_start_time, device, database)
+        elif activity_start_time is None:
+            early_messages.append((message.name, parsed_record))
+        else:
+            point = FIT_SUMMARY_POINTS[message.name](parsed_record, activityID, activity_type, activity_start_time, device, database)
+            if point:
+                yield point
+    if activity_start_time is None:
+        raise FileNotFoundError(f"No records found in FIT file for Activity ID {activityID} - Discarding FIT file")
+
+
+def _decoded_fit_points(fit_data, activityID, activity_type, device, database, chunk_size):
+    fit_messages = decode_fit(fit_data)
+    record_timestamps = fit_messages['record'].get('timestamp')
+    if not record_timestamps.valid.any():
+        raise FileNotFoundError(f"No records found in FIT file for Activity ID {activityID} - Discarding FIT file")
+    activity_start_time = datetime.fromtimestamp(int(record_timestamps.values[record_timestamps.valid][0]), tz=pytz.UTC)
+    yield from fit_record_points(fit_messages['record'], activityID, activity_type, activity_start_time, device, database, chunk_size)
+    for name in ['session', 'length', 'lap']:
+        for parsed_record in fit_messages[name].to_dicts():
+            point = FIT_SUMMARY_POINTS[name](parsed_record, activityID, activity_type, activity_start_time, device, database)
+            if point:
+                yield point
+
+
+def fit_record_points(records, activityID, activity_type, activity_start_time, device, database, chunk_size=10000):
+    # ActivityGPS points from the decode_fit record columns, same fields and values as fit_gps_point
+    # The Python values are only built for chunk_size records at a time
+    timestamp = records.get('timestamp')
+    latitude, longitude = records.get('position_lat'), records.get('position_long')
+    enhanced_altitude, plain_altitude = records.get('enhanced_altitude'), records.get('altitude')
+    enhanced_speed, plain_speed = records.get('enhanced_speed'), records.get('speed')
+    heart_rate, grade_adjusted = records.get('heart_rate'), records.get('unknown_140')
+    use_enhanced_altitude, use_enhanced_speed = enhanced_altitude.truthy(), enhanced_speed.truthy()
+    heart_rate_set, grade_adjusted_set = heart_rate.truthy(), grade_adjusted.truthy()
+    grade_adjusted_speed = grade_adjusted.values / 1000.0
+    columns = {
+        "Latitude": (latitude.values * (180 / 2**31), latitude.truthy()),
+        "Longitude": (longitude.values * (180 / 2**31), longitude.truthy()),
+        "Altitude": (np.where(use_enhanced_altitude, enhanced_altitude.values, plain_altitude.values), use_enhanced_altitude | plain_altitude.valid),
+        "Distance": (records.get('distance').values, records.get('distance').valid),
+        "DurationSeconds": ((timestamp.values - activity_start_time.timestamp()).astype(float), timestamp.valid),
+        "HeartRate": (heart_rate.values.astype(float), heart_rate_set),
+        "Speed": (np.where(use_enhanced_speed, enhanced_speed.values, plain_speed.values), use_enhanced_speed | plain_speed.valid),
+        "GradeAdjustedSpeed": (grade_adjusted_speed, grade_adjusted_set),
+        "RunningEfficiency": (grade_adjusted_speed / np.where(heart_rate_set, heart_rate.values, 1), grade_adjusted_set & heart_rate_set),
+    }
+    for field, name in [("Cadence", 'cadence'), ("Fractional_Cadence", 'fractional_cadence'), ("Temperature", 'temperature'), ("Accumulated_Power", 'accumulated_power'), ("Power", 'power')]:
+        columns[field] = (records.get(name).values, records.get(name).valid)
+    for start in range(0, len(records), chunk_size):
+        rows = slice(start, start + chunk_size)
+        fields = {name: masked_list(values[rows], valid[rows]) for name, (values, valid) in columns.items()}
+        for i, (point_time, has_time) in enumerate(zip(timestamp.values[rows].tolist(), timestamp.valid[rows].tolist())):
+            if has_time:
+                point = {
+                    "measurement": "ActivityGPS",
+                    "time": datetime.fromtimestamp(point_time, tz=pytz.UTC).isoformat(),
+                    "tags": activity_tags(device, database, activityID, activity_start_time, activity_type),
+                    "fields": {"ActivityName": activity_type, "Activity_ID": activityID}
+                }
+                point["fields"].update((name, column[i]) for name, column in fields.items())
+                yield point
+
+
+def parse_number(text):
+    # float of an XML text value, None if it is missing or not a number
+    return float(text) if text and NUMBER_PATTERN.fullmatch(text) else None
+
+
+def iter_tcx_activity(tcx_file_data, activityID, activity_type, device, database, chunk_size=10000):
+    """Yields the ActivityGPS points of a TCX file (bytes or binary file object) in lists of at most chunk_size points, the fallback when there is no usable FIT file.
+
+    The document is read incrementally with iterparse : trackpoints become points as soon as they are closed and
+    are then cleared, so neither the whole tree nor the whole point list is held in memory.
+    """
+    return chunked(_tcx_points(tcx_file_data, activityID, activity_type, device, database), chunk_size)
+
+
+def parse_tcx_activity(tcx_file_data, activityID, activity_type, device, database, chunk_size=10000):
+    # List of the point chunks of a TCX file, for worker processes
+    return list(iter_tcx_activity(tcx_file_data, activityID, activity_type, device, database, chunk_size))
+
+
+def _tcx_points(tcx_file_data, activityID, activity_type, device, database):
+    activity_start_time = None
+    lap_index = 0
+    in_lap = False
+    trackpoint = None # values of the open trackpoint, first occurrence of each tag wins like findtext
+    track = None # open Track element, finished trackpoints are removed from it so the tree doesn't grow with the file
+    tcx_file = io.BytesIO(tcx_file_data) if isinstance(tcx_file_data, bytes) else tcx_file_data
+    for event, element in ET.iterparse(tcx_file, events=("start", "end")):
+        tag = element.tag
+        if event == "start":
+            if tag == TCX_TRACKPOINT:
+                trackpoint = {}
+            elif tag == TCX_TRACK:
+                track = element
+            elif tag == TCX_LAP:
+                lap_index += 1
+                in_lap = True
+            elif tag == TCX_ACTIVITY:
+                lap_index = 0
+            continue
+        if trackpoint is not None:
+            if tag != TCX_TRACKPOINT:
+                if tag in TCX_TRACKPOINT_VALUES:
+                    trackpoint.setdefault(TCX_TRACKPOINT_VALUES[tag], element.text)
+                continue
+            point_time = trackpoint.get("Time")
+            element.clear()
+            if track is not None:
+                track.remove(element)
+            values, trackpoint = trackpoint, None
+            if not point_time:
+                continue
+            time_obj = datetime.fromisoformat(point_time.strip().strip("Z"))
+            yield {
+                "measurement": "ActivityGPS",
+                "time": time_obj.isoformat(),
+                "tags": activity_tags(device, database, activityID, activity_start_time, activity_type),
+                "fields": {
+                    "ActivityName": activity_type,
+                    "Activity_ID": activityID,
+                    "Latitude": parse_number(values.get("Latitude")),
+                    "Longitude": parse_number(values.get("Longitude")),
+                    "Altitude": parse_number(values.get("Altitude")),
+                    "Distance": parse_number(values.get("Distance")),
+                    "DurationSeconds": (time_obj - activity_start_time).total_seconds(),
+                    "HeartRate": parse_number(values.get("HeartRate")),
+                    "Speed": parse_number(values.get("Speed")),
+                    "lap": lap_index
+                }
+            }
+        elif tag == TCX_ID and not in_lap:
+            activity_start_time = datetime.fromisoformat(element.text.strip().strip("Z"))
+        elif tag == TCX_LAP:
+            in_lap = False
+            element.clear()
+        elif tag == TCX_ACTIVITY:
+            element.clear()
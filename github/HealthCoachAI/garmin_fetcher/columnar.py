@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+from datetime import datetime, timezone
+
+
+class ColumnarPoints:
+    """Points of a single measurement kept as NumPy columns instead of one dict per point.
+
+    times_ms holds the epoch milliseconds of every point, fields maps each field name to a column of the
+    same length and tags are shared by all points of the block.
+    """
+
+    def __init__(self, measurement, times_ms, fields, tags):
+        self.measurement = measurement
+        self.times_ms = times_ms
+        self.fields = fields
+        self.tags = dict(tags)
+
+    def __len__(self):
+        return len(self.times_ms)
+
+    def latest_time_ms(self):
+        return int(self.times_ms.max())
+
+    def to_dataframe(self):
+        data_frame = pd.DataFrame(self.fields)
+        for tag, value in self.tags.items():
+            data_frame[tag] = value
+        data_frame["time"] = pd.to_datetime(self.times_ms, unit="ms", utc=True)
+        return data_frame
+
+    def to_points(self):
+        # Same dicts as the row by row getters build, for writers which can't take a DataFrame
+        columns = {name: column.tolist() for name, column in self.fields.items()}
+        return [{
+            "measurement": self.measurement,
+            "time": datetime.fromtimestamp(time_ms / 1000, tz=timezone.utc).isoformat(),
+            "tags": dict(self.tags),
+            "fields": {name: column[i] for name, column in columns.items()}
+        } for i, time_ms in enumerate(self.times_ms.tolist())]
+
+
+def pair_columns(entries, value_index, dtype, keep_zero=True, since_ms=0):
+    """Splits Garmin [timestamp ms, ..., value, ...] arrays into (times_ms, values) columns.
+
+    Entries without a value are dropped, as are zero values unless keep_zero is set and entries older than since_ms.
+    """
+    if not entries:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=dtype)
+    times_ms = np.array([entry[0] for entry in entries], dtype=np.int64)
+    values = np.array([entry[value_index] for entry in entries], dtype=np.float64) # None becomes NaN
+    keep = ~np.isnan(values) & (times_ms >= since_ms)
+    if not keep_zero:
+        keep &= values != 0
+    return times_ms[keep], values[keep].astype(dtype)
@@ -0,0 +1,310 @@
+import numpy as np
+from datetime import datetime, timedelta
+from fitparse import FitParseError
+from fitparse.profile import MESSAGE_TYPES
+
+FIT_EPOCH = datetime(1989, 12, 31)
+FIT_EPOCH_UNIX_SECONDS = 631065600
+TIMESTAMP_FIELD = 253
+# Messages decoded by default (global message number -> name)
+ACTIVITY_MESSAGES = {20: 'record', 18: 'session', 19: 'lap', 101: 'length'}
+# FIT base type number -> (NumPy type, invalid value) - strings and byte arrays are skipped
+BASE_TYPES = {
+    0x00: ('u1', 0xFF), 0x01: ('i1', 0x7F), 0x02: ('u1', 0xFF), 0x83: ('i2', 0x7FFF), 0x84: ('u2', 0xFFFF),
+    0x85: ('i4', 0x7FFFFFFF), 0x86: ('u4', 0xFFFFFFFF), 0x88: ('f4', None), 0x89: ('f8', None), 0x0A: ('u1', 0),
+    0x8B: ('u2', 0), 0x8C: ('u4', 0), 0x8E: ('i8', 0x7FFFFFFFFFFFFFFF), 0x8F: ('u8', 0xFFFFFFFFFFFFFFFF),
+}
+
+
+def _crc_table():
+    # CRC-16 of the FIT SDK (reflected polynomial 0xA001, initial value 0), one entry per byte value
+    table = np.zeros(256, dtype=np.uint16)
+    for byte in range(256):
+        crc = byte
+        for bit in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table[byte] = crc
+    return table
+
+
+CRC_TABLE = _crc_table()
+
+
+def fit_crc(buffer):
+    """CRC-16 of a FIT file part (uint8 NumPy array), as stored after the header and at the end of the file.
+
+    The bytes are cut into about sqrt(n) lanes whose CRCs are updated together one column at a time, then merged
+    pairwise : the CRC is linear, so a lane is appended by running the CRC on its left neighbour through as many
+    zero bytes (a 16x16 bit matrix, applied with its image of each bit) and XORing both.
+    """
+    lanes = 1 << max(0, (len(buffer).bit_length() + 1) // 2)
+    width = -(-len(buffer) // lanes) if len(buffer) else 0
+    # Leading zero bytes leave a zero CRC unchanged, so the padding goes in front
+    padded = np.zeros(lanes * width, dtype=np.uint8)
+    padded[lanes * width - len(buffer):] = buffer
+    columns = padded.reshape(lanes, width).T.astype(np.uint16)
+    crcs = np.zeros(lanes, dtype=np.uint16)
+    images = np.left_shift(1, np.arange(16)).astype(np.uint16) # images of each bit through width zero bytes
+    for column in columns:
+        crcs = (crcs >> 8) ^ CRC_TABLE[(crcs ^ column) & 0xFF]
+        images = (images >> 8) ^ CRC_TABLE[images & 0xFF]
+    while len(crcs) > 1:
+        shifted = np.zeros(len(crcs) // 2, dtype=np.uint16)
+        for bit in range(16):
+            shifted ^= ((crcs[0::2] >> bit) & 1) * images[bit]
+        crcs = shifted ^ crcs[1::2]
+        doubled = np.zeros(16, dtype=np.uint16)
+        for bit in range(16):
+            doubled ^= ((images >> bit) & 1) * images[bit]
+        images = doubled
+    return int(crcs[0])
+
+
+class FitColumn:
+    """Decoded values of one field for every message of a type, valid is False where the field was missing or invalid.
+
+    values are scaled floats, raw integers, epoch seconds (date_time fields, is_time set) or objects (enum names).
+    """
+    __slots__ = ('values', 'valid', 'is_time')
+
+    def __init__(self, values, valid, is_time=False):
+        self.values = values
+        self.valid = valid
+        self.is_time = is_time
+
+    def truthy(self):
+        # Same as a truth test on the fitparse value : missing, invalid or zero values are dropped
+        return self.valid & (self.values != 0) if self.values.dtype != object else self.valid & np.array([bool(value) for value in self.values], dtype=bool)
+
+    def to_list(self):
+        values = self.values.tolist()
+        if self.is_time:
+            values = [FIT_EPOCH + timedelta(seconds=value - FIT_EPOCH_UNIX_SECONDS) for value in values]
+        return masked_list(values, self.valid)
+
+
+def masked_list(values, mask):
+    """Python list of values (array or list) with None where mask is False."""
+    values = values.tolist() if isinstance(values, np.ndarray) else values
+    return [value if ok else None for value, ok in zip(values, mask.tolist())]
+
+
+class FitMessages:
+    """All decoded messages of one type in file order, as FitColumns keyed by the fitparse field name."""
+
+    def __init__(self, name, length, columns):
+        self.name = name
+        self.length = length
+        self.columns = columns
+
+    def __len__(self):
+        return self.length
+
+    def get(self, name):
+        return self.columns.get(name) or FitColumn(np.zeros(self.length), np.zeros(self.length, dtype=bool))
+
+    def to_dicts(self):
+        # Same dicts as fitparse's get_values(), for the message types with only a few messages
+        names = list(self.columns)
+        value_lists = [self.columns[name].to_list() for name in names]
+        return [dict(zip(names, values)) for values in zip(*value_lists)]
+
+
+class _Layout:
+    # Data messages sharing one definition : where they start in the file, their order and compressed timestamps
+    def __init__(self, mesg_num, endian, fields, size):
+        self.mesg_num = mesg_num
+        self.endian = endian
+        self.fields = fields # (field number, offset, size, base type)
+        self.size = size
+        self.timestamp_offset = next((offset for number, offset, field_size, base_type in fields if number == TIMESTAMP_FIELD and field_size == 4), None)
+        self.offsets = []
+        self.sequence = []
+        self.header_timestamps = []
+
+
+def decode_fit(data, messages=ACTIVITY_MESSAGES):
+    """Decodes the given message types of a FIT file (bytes) into {message name: FitMessages}.
+
+    Only the message headers are walked in Python, the field values of each definition are then read at once
+    as NumPy columns. Compressed timestamp headers, developer fields and chained FIT files are supported.
+    The header and file CRCs are checked like fitparse does, and any decoding error raises FitParseError.
+    """
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    layouts = []
+    position = 0
+    sequence = 0
+    try:
+        while position + 12 <= len(data):
+            header_size = data[position]
+            if data[position + 8:position + 12] != b'.FIT':
+                raise FitParseError("Invalid .FIT File Header")
+            data_size = int.from_bytes(data[position + 4:position + 8], 'little')
+            file_start = position
+            if header_size >= 14: # header CRC, zero when not computed
+                header_crc = int.from_bytes(data[position + 12:position + 14], 'little')
+                if header_crc and header_crc != fit_crc(buffer[position:position + 12]):
+                    raise FitParseError("FIT file header CRC mismatch")
+            elif header_size != 12:
+                raise FitParseError("Irregular FIT file header size")
+            position += header_size
+            end = position + data_size
+            if end + 2 > len(data):
+                raise FitParseError("FIT file is truncated")
+            local_layouts = {}
+            last_timestamp = 0
+            while position < end:
+                header = data[position]
+                position += 1
+                if header & 0x80: # compressed timestamp header
+                    layout = local_layouts[(header >> 5) & 0x3]
+                    time_offset = header & 0x1F
+                    timestamp = (last_timestamp & ~0x1F) + time_offset
+                    if time_offset < (last_timestamp & 0x1F):
+                        timestamp += 0x20
+                    last_timestamp = timestamp
+                elif header & 0x40: # definition message
+                    endian = 'big' if data[position + 1] else 'little'
+                    mesg_num = int.from_bytes(data[position + 2:position + 4], endian)
+                    num_fields = data[position + 4]
+                    position += 5
+                    fields = []
+                    offset = 0
+                    for i in range(num_fields):
+                        number, size, base_type = data[position:position + 3]
+                        fields.append((number, offset, size, base_type))
+                        offset += size
+                        position += 3
+                    if header & 0x20: # developer fields are skipped, only their size matters
+                        num_dev_fields = data[position]
+                        position += 1
+                        for i in range(num_dev_fields):
+                            offset += data[position + 1]
+                            position += 3
+                    layout = _Layout(mesg_num, '>' if endian == 'big' else '<', fields, offset)
+                    local_layouts[header & 0xF] = layout
+                    if mesg_num in messages:
+                        layouts.append(layout)
+                    continue
+                else:
+                    layout = local_layouts[header & 0xF]
+                    timestamp = None
+                if layout.timestamp_offset is not None:
+                    field_timestamp = int.from_bytes(data[position + layout.timestamp_offset:position + layout.timestamp_offset + 4], 'big' if layout.endian == '>' else 'little')
+                    if field_timestamp != 0xFFFFFFFF:
+                        last_timestamp = field_timestamp
+                if layout.mesg_num in messages:
+                    layout.offsets.append(position)
+                    layout.sequence.append(sequence)
+                    layout.header_timestamps.append(-1 if timestamp is None else timestamp)
+                    sequence += 1
+                position += layout.size
+            if position > end:
+                raise FitParseError("FIT file is truncated")
+            if int.from_bytes(data[end:end + 2], 'little') != fit_crc(buffer[file_start:end]):
+                raise FitParseError("FIT file CRC mismatch")
+            position = end + 2
+        return {name: _decode_messages(buffer, mesg_num, name, [layout for layout in layouts if layout.mesg_num == mesg_num]) for mesg_num, name in messages.items()}
+    except FitParseError:
+        raise
+    except Exception as err:
+        raise FitParseError(f"Corrupt FIT file : {err!r}") from err
+
+
+def _decode_messages(buffer, mesg_num, name, layouts):
+    layouts = [layout for layout in layouts if layout.offsets]
+    sequence = np.concatenate([np.array(layout.sequence, dtype=np.int64) for layout in layouts]) if layouts else np.empty(0, dtype=np.int64)
+    order = np.argsort(sequence, kind='stable')
+    length = len(sequence)
+    raw_columns = {}
+    # Raw values of every field in every layout, then merged in file order
+    for layout_index, layout in enumerate(layouts):
+        rows = buffer[np.array(layout.offsets, dtype=np.int64)[:, None] + np.arange(layout.size)]
+        start = sum(len(previous.offsets) for previous in layouts[:layout_index])
+        for number, offset, size, base_type in layout.fields:
+            numpy_type = BASE_TYPES.get(base_type)
+            if numpy_type is None or np.dtype(numpy_type[0]).itemsize != size:
+                continue # strings, byte and array fields
+            dtype = np.dtype(numpy_type[0]).newbyteorder(layout.endian)
+            values = np.ascontiguousarray(rows[:, offset:offset + size]).view(dtype).reshape(-1)
+            valid = ~np.isnan(values) if numpy_type[1] is None else values != numpy_type[1]
+            values = values.astype(np.float64 if numpy_type[1] is None else np.int64)
+            if number not in raw_columns:
+                raw_columns[number] = (np.zeros(length, dtype=values.dtype), np.zeros(length, dtype=bool), np.zeros(length, dtype=bool))
+            column_values, column_valid, column_present = raw_columns[number]
+            if column_values.dtype != values.dtype:
+                column_values = column_values.astype(np.float64)
+                raw_columns[number] = (column_values, column_valid, column_present)
+            column_values[start:start + len(values)] = values
+            column_valid[start:start + len(values)] = valid
+            column_present[start:start + len(values)] = True
+        if TIMESTAMP_FIELD not in [field[0] for field in layout.fields]:
+            header_timestamps = np.array(layout.header_timestamps, dtype=np.int64)
+            if (header_timestamps >= 0).any():
+                if TIMESTAMP_FIELD not in raw_columns:
+                    raw_columns[TIMESTAMP_FIELD] = (np.zeros(length, dtype=np.int64), np.zeros(length, dtype=bool), np.zeros(length, dtype=bool))
+                raw_columns[TIMESTAMP_FIELD][0][start:start + len(header_timestamps)] = header_timestamps
+                raw_columns[TIMESTAMP_FIELD][1][start:start + len(header_timestamps)] = header_timestamps >= 0
+                raw_columns[TIMESTAMP_FIELD][2][start:start + len(header_timestamps)] = header_timestamps >= 0
+    # (values, valid, present) - present tells the messages whose definition has the field apart from invalid values
+    raw_columns = {number: tuple(column[order] for column in columns) for number, columns in raw_columns.items()}
+    return FitMessages(name, length, _apply_profile(mesg_num, raw_columns, length))
+
+
+def _apply_profile(mesg_num, raw_columns, length):
+    # Names, subfields, components, scale/offset and enum names the way fitparse applies them
+    mesg_type = MESSAGE_TYPES.get(mesg_num)
+    columns = {}
+    component_columns = {}
+    for number, (raw, valid, present) in raw_columns.items():
+        field = mesg_type.fields.get(number) if mesg_type else None
+        if field is None:
+            columns[f"unknown_{number}"] = FitColumn(raw, valid)
+            continue
+        for component in field.components or []:
+            if component.accumulate or mesg_type.fields.get(component.def_num) is None:
+                continue
+            component_raw = (raw.astype(np.int64) >> component.bit_offset) & ((1 << component.bits) - 1)
+            component_columns[mesg_type.fields[component.def_num]] = (_scale(component_raw, component.scale, component.offset), valid & present)
+        variants = [(field, np.ones(length, dtype=bool))]
+        for subfield in field.subfields or []:
+            matches = np.zeros(length, dtype=bool)
+            for ref_field in subfield.ref_fields:
+                ref_raw, ref_valid, ref_present = raw_columns.get(ref_field.def_num, (None, None, None))
+                if ref_raw is not None:
+                    matches |= ref_valid & (ref_raw == ref_field.raw_value) & variants[0][1]
+            if matches.any():
+                variants[0] = (field, variants[0][1] & ~matches)
+                variants.append((subfield, matches))
+        for variant, rows in variants:
+            if (rows & present).any():
+                columns[variant.name] = _render(variant, raw, valid & rows)
+    for field, (values, valid) in component_columns.items():
+        column = _render(field, values, valid, scaled=True)
+        if field.def_num in raw_columns and field.name in columns: # a field present in the message wins over its component
+            present = raw_columns[field.def_num][2]
+            existing = columns[field.name]
+            column = FitColumn(np.where(present, existing.values, column.values), np.where(present, existing.valid, column.valid), existing.is_time)
+        columns[field.name] = column
+    return columns
+
+
+def _scale(raw, scale, offset):
+    if not scale and not offset:
+        return raw
+    values = raw.astype(np.float64)
+    if scale:
+        values = values / scale
+    if offset:
+        values = values - offset
+    return values
+
+
+def _render(field, raw, valid, scaled=False):
+    if field.type.name == 'date_time':
+        return FitColumn(raw.astype(np.int64) + FIT_EPOCH_UNIX_SECONDS, valid, is_time=True)
+    values = raw if scaled else _scale(raw, field.scale, field.offset)
+    enum_values = getattr(field.type, 'values', None)
+    if enum_values and not scaled:
+        values = np.array([enum_values.get(value, value) for value in raw.tolist()], dtype=object)
+    return FitColumn(values, valid)
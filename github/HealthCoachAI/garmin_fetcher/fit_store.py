@@ -0,0 +1,223 @@
+import hashlib, io, logging, mmap, os, tempfile, threading, time, zlib
+from state_store import open_state_db
+
+READ_BLOCK_BYTES = 2**20
+
+
+class StoredFileError(OSError):
+    """A stored file can't be read back : its compressed data is corrupt or its content doesn't match its hash. It was dropped from the store."""
+
+
+class StoredFileReader(io.RawIOBase):
+    """Binary file object of a stored file, decompressed READ_BLOCK_BYTES at a time straight from the memory-mapped object.
+
+    The content is hashed while it is read and checked against its content hash at the end of the file : a mismatch or
+    corrupt compressed data drops the object from the store and raises StoredFileError. The file is only read forward,
+    seeking is limited to asking for its size (seek to the end and back, as fitparse does).
+    """
+
+    def __init__(self, store, activity_id, content_hash, size):
+        self._store = store
+        self._size = size
+        self._position = 0 # of the next decompressed byte
+        self._seek_position = 0 # differs from _position only while seeked to the end
+        self._activity_id = activity_id
+        self._content_hash = content_hash
+        self._file = open(store._object_path(content_hash), "rb")
+        try:
+            self._mapped = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            self._file.close()
+            raise
+        self._mapped_position = 0
+        self._decompressor = zlib.decompressobj()
+        self._digest = hashlib.sha256()
+        self._block = b""
+        self._block_position = 0
+        self._end_of_file = False
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        target = {io.SEEK_SET: offset, io.SEEK_CUR: self._seek_position + offset, io.SEEK_END: self._size + offset}[whence]
+        if target not in (self._position, self._size):
+            raise io.UnsupportedOperation("stored files are only read forward")
+        self._seek_position = target
+        return target
+
+    def tell(self):
+        return self._seek_position
+
+    def readinto(self, buffer):
+        if self._seek_position != self._position:
+            return 0 # seeked to the end
+        while self._block_position == len(self._block) and not self._end_of_file:
+            self._next_block()
+        size = min(len(buffer), len(self._block) - self._block_position)
+        buffer[:size] = self._block[self._block_position:self._block_position + size]
+        self._block_position += size
+        self._position = self._seek_position = self._position + size
+        return size
+
+    def _next_block(self):
+        try:
+            if self._decompressor.unconsumed_tail:
+                block = self._decompressor.decompress(self._decompressor.unconsumed_tail, READ_BLOCK_BYTES)
+            elif self._mapped_position < len(self._mapped) and not self._decompressor.eof:
+                compressed = self._mapped[self._mapped_position:self._mapped_position + READ_BLOCK_BYTES]
+                self._mapped_position += len(compressed)
+                block = self._decompressor.decompress(compressed, READ_BLOCK_BYTES)
+            else:
+                block = self._decompressor.flush()
+                self._end_of_file = True
+        except zlib.error as err:
+            self._corrupt(err)
+        self._digest.update(block)
+        self._block, self._block_position = block, 0
+        if self._end_of_file and not (self._decompressor.eof and self._digest.hexdigest() == self._content_hash):
+            self._corrupt("content does not match its hash")
+
+    def _corrupt(self, reason):
+        logging.warning(f"FIT store : stored file of activity ID {self._activity_id} is unreadable ({reason}) - dropping it")
+        self._store.drop(self._content_hash)
+        raise StoredFileError(f"Stored file of activity ID {self._activity_id} is unreadable : {reason}")
+
+    def close(self):
+        if not self.closed:
+            self._mapped.close()
+            self._file.close()
+        super().close()
+
+
+class FitStore:
+    """Content addressed store of the original activity files (FIT, or TCX when the FIT file could not be used), indexed by activity id.
+
+    Each distinct file is kept once, zlib compressed, at objects/<first 2 hex digits>/<sha256 of the file> in directory, and
+    index.sqlite maps activity ids to them. Files are read back through a StoredFileReader, which decompresses them block by
+    block straight from their memory mapping, a file whose content no longer matches its hash is dropped. The least recently used files are evicted once max_size_bytes
+    (compressed) is exceeded.
+    """
+
+    def __init__(self, directory, max_size_bytes=2048 * 2**20):
+        self.directory = directory
+        self.max_size_bytes = max_size_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = open_state_db(os.path.join(directory, "index.sqlite"))
+        self._db.execute("""CREATE TABLE IF NOT EXISTS objects (
+            content_hash TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            stored_size INTEGER NOT NULL,
+            last_access REAL NOT NULL)""")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS activities (
+            activity_id INTEGER PRIMARY KEY,
+            kind TEXT NOT NULL,
+            content_hash TEXT NOT NULL,
+            updated_at REAL NOT NULL)""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS objects_last_access ON objects (last_access)")
+        self.size_bytes = self._db.execute("SELECT COALESCE(SUM(stored_size), 0) FROM objects").fetchone()[0]
+
+    def _object_path(self, content_hash):
+        return os.path.join(self.directory, "objects", content_hash[:2], content_hash)
+
+    def get(self, activity_id):
+        """Returns (kind, file object, content hash) of the stored activity file, kind being "fit" or "tcx", or None.
+
+        The file object (a StoredFileReader to close after use) decompresses the stored file as it is read, the store
+        lock is only held for the index lookup.
+        """
+        with self._lock:
+            row = self._db.execute("SELECT kind, activities.content_hash, size FROM activities JOIN objects USING (content_hash) WHERE activity_id = ?", (activity_id,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            kind, content_hash, size = row
+            self._db.execute("UPDATE objects SET last_access = ? WHERE content_hash = ?", (time.time(), content_hash))
+        try:
+            reader = StoredFileReader(self, activity_id, content_hash, size)
+        except (OSError, ValueError) as err: # evicted in the meantime, or an empty object file
+            with self._lock:
+                self.misses += 1
+                if not isinstance(err, FileNotFoundError):
+                    logging.warning(f"FIT store : stored file of activity ID {activity_id} is unreadable ({err}) - dropping it")
+                    self._remove_object(content_hash)
+            return None
+        with self._lock:
+            self.hits += 1
+        return kind, reader, content_hash
+
+    def drop(self, content_hash):
+        with self._lock:
+            self._remove_object(content_hash)
+
+    def put(self, activity_id, kind, data):
+        """Stores the file data of the activity (bytes, or a binary file object), returns its content hash (sha256 hex digest).
+
+        The data is hashed and compressed READ_BLOCK_BYTES at a time into a temporary file, which is moved to its object
+        path once the hash is known, so a file object is never held in memory whole.
+        """
+        file_obj = io.BytesIO(data) if isinstance(data, (bytes, bytearray, memoryview)) else data
+        objects_directory = os.path.join(self.directory, "objects")
+        os.makedirs(objects_directory, exist_ok=True)
+        file_descriptor, temporary_path = tempfile.mkstemp(suffix=".tmp", dir=objects_directory)
+        try:
+            digest, compressor = hashlib.sha256(), zlib.compressobj()
+            size = stored_size = 0
+            with os.fdopen(file_descriptor, "wb") as object_file:
+                for block in iter(lambda: file_obj.read(READ_BLOCK_BYTES), b""):
+                    digest.update(block)
+                    size += len(block)
+                    stored_size += object_file.write(compressor.compress(block))
+                stored_size += object_file.write(compressor.flush())
+            content_hash = digest.hexdigest()
+            now = time.time()
+            with self._lock:
+                old = self._db.execute("SELECT content_hash FROM activities WHERE activity_id = ?", (activity_id,)).fetchone()
+                if self._db.execute("SELECT 1 FROM objects WHERE content_hash = ?", (content_hash,)).fetchone() is None:
+                    path = self._object_path(content_hash)
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    os.replace(temporary_path, path)
+                    temporary_path = None
+                    self._db.execute("INSERT INTO objects (content_hash, size, stored_size, last_access) VALUES (?, ?, ?, ?)", (content_hash, size, stored_size, now))
+                    self.size_bytes += stored_size
+                else:
+                    self._db.execute("UPDATE objects SET last_access = ? WHERE content_hash = ?", (now, content_hash))
+                self._db.execute(
+                    "INSERT OR REPLACE INTO activities (activity_id, kind, content_hash, updated_at) VALUES (?, ?, ?, ?)",
+                    (activity_id, kind, content_hash, now)
+                )
+                if old and old[0] != content_hash and self._db.execute("SELECT 1 FROM activities WHERE content_hash = ?", (old[0],)).fetchone() is None:
+                    self._remove_object(old[0]) # the activity was the only one using its previous file
+                if self.size_bytes > self.max_size_bytes:
+                    self._evict()
+        finally:
+            if temporary_path:
+                os.remove(temporary_path) # the file was already stored, or reading it failed
+        return content_hash
+
+    def _remove_object(self, content_hash):
+        row = self._db.execute("SELECT stored_size FROM objects WHERE content_hash = ?", (content_hash,)).fetchone()
+        self._db.execute("DELETE FROM objects WHERE content_hash = ?", (content_hash,))
+        self._db.execute("DELETE FROM activities WHERE content_hash = ?", (content_hash,))
+        if row:
+            self.size_bytes -= row[0]
+        try:
+            os.remove(self._object_path(content_hash))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        # Drop least recently used files until the store is back to 90% of its size cap
+        target = self.max_size_bytes * 0.9
+        evicted = 0
+        for (content_hash,) in self._db.execute("SELECT content_hash FROM objects ORDER BY last_access").fetchall():
+            if self.size_bytes <= target:
+                break
+            self._remove_object(content_hash)
+            evicted += 1
+        logging.info(f"FIT store : evicted {evicted} least recently used activity files ({self.size_bytes / 2**20:.1f} MB kept)")
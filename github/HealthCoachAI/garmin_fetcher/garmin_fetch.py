@@ -1,12 +1,32 @@
 # %%
-import base64, requests, time, pytz, logging, os, sys, dotenv, io, zipfile
-from fitparse import FitFile, FitParseError
+import base64, requests, time, pytz, logging, os, sys, dotenv, io, zipfile, shutil, inspect, threading, json, re, socket, hashlib, atexit, multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager, ExitStack
+from collections import deque
+from fitparse import FitParseError
+from urllib3.exceptions import HTTPError as Urllib3HTTPError
 from datetime import datetime, timedelta
 from influxdb import InfluxDBClient
 from influxdb.exceptions import InfluxDBClientError
 from influxdb_client_3 import InfluxDBClient3, InfluxDBError
-import xml.etree.ElementTree as ET
+import numpy as np
 from garth.exc import GarthHTTPError
+from rate_limiter import AdaptiveRateLimiter, is_rate_limit_response, retry_after_seconds
+from response_cache import ResponseCache
+from work_queue import BackfillQueue
+from state_store import FingerprintStore, SyncStateStore, ActivityIndex, MeanMaxStore, GeoTileStore, RouteFingerprintStore
+from columnar import ColumnarPoints, pair_columns
+from line_protocol import LineProtocolEncoder, V1_PRECISION
+from write_pipeline import WritePipeline
+from write_spool import WriteSpool
+from fit_store import FitStore, StoredFileError
+from activity_metrics import activity_metrics_chunks
+from power_curves import mean_max_chunks, best_envelope_chunks
+from geo_tiles import geo_tile_chunks
+from route_index import route_index_chunks
+from route_simplify import ROUTE_SIMPLIFICATION_MODES, simplify_route_chunks
+from activity_parsing import ACTIVITY_SCHEMA_VERSION, fit_file_member, iter_fit_activity, parse_fit_activity, iter_tcx_activity, parse_tcx_activity
 from garminconnect import (
     Garmin,
     GarminConnectAuthenticationError,
@@ -54,7 +74,69 @@ IGNORE_INTRADAY_DATA_REFRESH_DAYS = int(os.getenv("IGNORE_INTRADAY_DATA_REFRESH_
 TAG_MEASUREMENTS_WITH_USER_EMAIL = True if os.getenv("TAG_MEASUREMENTS_WITH_USER_EMAIL") in ['True', 'true', 'TRUE','t', 'T', 'yes', 'Yes', 'YES', '1'] else False # Adds an additional "User_ID" tag in each measurement for multi user database support - see #96
 FORCE_REPROCESS_ACTIVITIES = False if os.getenv("FORCE_REPROCESS_ACTIVITIES") in ['False','false','FALSE','f','F','no','No','NO','0'] else True # optional, will enable re-processing of fit files when set to true, may skip activities if set to false (issue #30)
 USER_TIMEZONE = os.getenv("USER_TIMEZONE", "") # optional, fetches timezone info from last activity automatically if left blank
-PARSED_ACTIVITY_ID_LIST = []
+GARMIN_ACCOUNT_TOKEN_DIRS = [token_dir.strip() for token_dir in os.getenv("GARMIN_ACCOUNT_TOKEN_DIRS", "").split(",") if token_dir.strip()] # optional, comma separated token directories of additional Garmin accounts fetched by this same process (tokens must be generated beforehand, e.g. by running the fetcher once with each account's TOKEN_DIR)
+FETCH_CONCURRENCY = int(os.getenv("FETCH_CONCURRENCY", 1)) # optional, number of metrics fetched in parallel for each day - 1 (default) keeps the sequential behaviour
+GARMIN_MAX_INFLIGHT_REQUESTS = int(os.getenv("GARMIN_MAX_INFLIGHT_REQUESTS", FETCH_CONCURRENCY)) # optional, global budget of simultaneous Garmin Connect API calls shared by all fetch workers
+ADAPTIVE_RATE_LIMIT = True if os.getenv("ADAPTIVE_RATE_LIMIT") in ['True', 'true', 'TRUE','t', 'T', 'yes', 'Yes', 'YES', '1'] else False # optional, paces every Garmin API call with an adaptive token bucket instead of the fixed RATE_LIMIT_CALLS_SECONDS / FETCH_FAILED_WAIT_SECONDS sleeps
+GARMIN_RATE_LIMIT_PER_MINUTE = float(os.getenv("GARMIN_RATE_LIMIT_PER_MINUTE", 60)) # optional, highest request rate the adaptive limiter ramps up to
+GARMIN_RATE_LIMIT_MIN_PER_MINUTE = float(os.getenv("GARMIN_RATE_LIMIT_MIN_PER_MINUTE", 2)) # optional, lowest request rate the adaptive limiter backs off to
+GARMIN_RATE_LIMIT_BURST = int(os.getenv("GARMIN_RATE_LIMIT_BURST", 10)) # optional, number of requests which can be sent back to back when the bucket is full
+GARMIN_MAX_RETRIES = int(os.getenv("GARMIN_MAX_RETRIES", 5)) # optional, retries of a single throttled (429) call before the whole date is retried
+FETCHER_STATE_DIR = os.getenv("FETCHER_STATE_DIR", os.path.join(os.path.expanduser("~"), "fetcher_state")) # optional, directory for the fetcher's local state files (response cache etc.) - mount it as a volume to keep them across restarts
+GARMIN_RESPONSE_CACHE = True if os.getenv("GARMIN_RESPONSE_CACHE") in ['True', 'true', 'TRUE','t', 'T', 'yes', 'Yes', 'YES', '1'] else False # optional, caches Garmin API responses on disk so re-running a backfill does not fetch unchanged days again
+RESPONSE_CACHE_IMMUTABLE_AFTER_DAYS = int(os.getenv("RESPONSE_CACHE_IMMUTABLE_AFTER_DAYS", 7)) # optional, cached responses for days at least this old never expire
+RESPONSE_CACHE_RECENT_TTL_SECONDS = int(os.getenv("RESPONSE_CACHE_RECENT_TTL_SECONDS", 300)) # optional, cache lifetime of responses for today and yesterday
+RESPONSE_CACHE_TTL_SECONDS = int(os.getenv("RESPONSE_CACHE_TTL_SECONDS", 21600)) # optional, cache lifetime of responses for days between yesterday and RESPONSE_CACHE_IMMUTABLE_AFTER_DAYS
+RESPONSE_CACHE_MAX_SIZE_MB = int(os.getenv("RESPONSE_CACHE_MAX_SIZE_MB", 512)) # optional, least recently used responses are evicted above this (compressed) size
+BACKFILL_QUEUE = True if os.getenv("BACKFILL_QUEUE") in ['True', 'true', 'TRUE','t', 'T', 'yes', 'Yes', 'YES', '1'] else False # optional, runs MANUAL_START_DATE backfills from a persistent (date, metric) task queue which survives restarts and can be shared by several fetcher processes
+BACKFILL_QUEUE_PATH = os.getenv("BACKFILL_QUEUE_PATH", os.path.join(FETCHER_STATE_DIR, "backfill_queue.sqlite")) # optional, must be on a shared volume if several processes/pods work on the same backfill
+BACKFILL_QUEUE_LEASE_SECONDS = int(os.getenv("BACKFILL_QUEUE_LEASE_SECONDS", 900)) # optional, a task leased by a worker which died is handed out again after this many seconds
+BACKFILL_QUEUE_MAX_ATTEMPTS = int(os.getenv("BACKFILL_QUEUE_MAX_ATTEMPTS", 3)) # optional, a task is marked failed after this many failed attempts
+BACKFILL_QUEUE_SHARD = os.getenv("BACKFILL_QUEUE_SHARD", "0/1") # optional, "index/count" - this worker only takes dates whose day number modulo count equals index
+WORKER_ID = os.getenv("WORKER_ID", f"{socket.gethostname()}-{os.getpid()}") # optional, name of this fetcher process in the backfill queue
+PERSISTENT_ACTIVITY_INDEX = True if os.getenv("PERSISTENT_ACTIVITY_INDEX") in ['True', 'true', 'TRUE','t', 'T', 'yes', 'Yes', 'YES', '1'] else False # optional, remembers the ingested activities in FETCHER_STATE_DIR and only downloads them again once Garmin changes them (even with FORCE_REPROCESS_ACTIVITIES)
+PERSISTENT_SYNC_STATE = True if os.getenv("PERSISTENT_SYNC_STATE") in ['True', 'true', 'TRUE','t', 'T', 'yes', 'Yes', 'YES', '1'] else False # optional, keeps the latest written point of each measurement and the sync point of each metric in FETCHER_STATE_DIR, so restarts resume each metric exactly without querying InfluxDB
+LINE_PROTOCOL_WRITES = True if os.getenv("LINE_PROTOCOL_WRITES") in ['True', 'true', 'TRUE','t', 'T', 'yes', 'Yes', 'YES', '1'] else False # optional, encodes points to line protocol directly and sends batches closed by byte size instead of 20000 point chunks
+WRITE_PRECISION = os.getenv("WRITE_PRECISION", "ms") # optional, timestamp precision of LINE_PROTOCOL_WRITES (s, ms, us or ns)
+WRITE_BATCH_MAX_BYTES = int(os.getenv("WRITE_BATCH_MAX_BYTES", 4 * 2**20)) # optional, uncompressed size at which a LINE_PROTOCOL_WRITES batch is closed
+INFLUXDB_GZIP = True if os.getenv("INFLUXDB_GZIP") in ['True', 'true', 'TRUE','t', 'T', 'yes', 'Yes', 'YES', '1'] else False # optional, gzip compresses write requests to InfluxDB
+ASYNC_WRITES = True if os.getenv("ASYNC_WRITES") in ['True', 'true', 'TRUE','t', 'T', 'yes', 'Yes', 'YES', '1'] else False # optional, writes to InfluxDB from a background thread which merges the points of all metrics and days into large batches while fetching goes on
+WRITE_FLUSH_POINTS = int(os.getenv("WRITE_FLUSH_POINTS", 50000)) # optional, ASYNC_WRITES sends a batch once this many points are queued
+WRITE_FLUSH_SECONDS = float(os.getenv("WRITE_FLUSH_SECONDS", 5)) # optional, ASYNC_WRITES sends queued points after they waited this long
+WRITE_QUEUE_MAX_POINTS = int(os.getenv("WRITE_QUEUE_MAX_POINTS", 500000)) # optional, fetching pauses while more points than this are waiting to be written
+WRITE_SPOOL = True if os.getenv("WRITE_SPOOL") in ['True', 'true', 'TRUE','t', 'T', 'yes', 'Yes', 'YES', '1'] else False # optional, batches which fail to write are kept in an on-disk spool and replayed in order once InfluxDB is reachable again, instead of being dropped
+WRITE_SPOOL_DIR = os.getenv("WRITE_SPOOL_DIR", os.path.join(FETCHER_STATE_DIR, "write_spool")) # optional
+WRITE_SPOOL_MAX_SIZE_MB = int(os.getenv("WRITE_SPOOL_MAX_SIZE_MB", 512)) # optional, oldest spooled batches are dropped above this size
+COLUMNAR_INGESTION = True if os.getenv("COLUMNAR_INGESTION") in ['True', 'true', 'TRUE','t', 'T', 'yes', 'Yes', 'YES', '1'] else False # optional, builds the intraday heart rate, stress, body battery and breathing arrays as NumPy columns and writes them to InfluxDB v3 as DataFrames instead of one dict per point
+ACTIVITY_DOWNLOAD_CONCURRENCY = int(os.getenv("ACTIVITY_DOWNLOAD_CONCURRENCY", 1)) # optional, activities of a day downloaded side by side (all downloads share the Garmin rate budget)
+ACTIVITY_CHUNK_POINTS = int(os.getenv("ACTIVITY_CHUNK_POINTS", 10000)) # optional, activity points are parsed and handed to the writer this many at a time so memory stays flat for very long activities
+ACTIVITY_PARSE_PROCESSES = int(os.getenv("ACTIVITY_PARSE_PROCESSES", 0)) # optional, parses activity FIT and TCX files in this many worker processes, 0 parses them in the fetching thread (a worker hands back a whole activity, only in-thread parsing streams it chunk by chunk)
+FIT_FILE_STORE = True if os.getenv("FIT_FILE_STORE") in ['True', 'true', 'TRUE','t', 'T', 'yes', 'Yes', 'YES', '1'] else False # optional, keeps the original file of every activity compressed in FIT_FILE_STORAGE_LOCATION and parses it from there instead of downloading it again
+FIT_FILE_STORE_MAX_SIZE_MB = int(os.getenv("FIT_FILE_STORE_MAX_SIZE_MB", 2048)) # optional, least recently used activity files are evicted above this (compressed) size
+ACTIVITY_METRICS = True if os.getenv("ACTIVITY_METRICS") in ['True', 'true', 'TRUE','t', 'T', 'yes', 'Yes', 'YES', '1'] else False # optional, writes one ActivityMetrics point per activity (time in heart rate zones, TRIMP, aerobic decoupling, normalized power, elevation gain, grade adjusted pace splits) computed from the full resolution track
+ACTIVITY_MAX_HEART_RATE = int(os.getenv("ACTIVITY_MAX_HEART_RATE", 185)) # optional, heart rate zones and TRIMP of ACTIVITY_METRICS
+ACTIVITY_RESTING_HEART_RATE = int(os.getenv("ACTIVITY_RESTING_HEART_RATE", 60)) # optional, TRIMP of ACTIVITY_METRICS
+ACTIVITY_SPLIT_METERS = int(os.getenv("ACTIVITY_SPLIT_METERS", 1000)) # optional, length of the grade adjusted pace splits of ACTIVITY_METRICS
+MEAN_MAX_CURVES = True if os.getenv("MEAN_MAX_CURVES") in ['True', 'true', 'TRUE','t', 'T', 'yes', 'Yes', 'YES', '1'] else False # optional, writes the mean-max power, heart rate and speed/pace curve of each activity as ActivityMeanMax, and the all-time and rolling best efforts of its sport as MeanMaxBests (curves are kept in FETCHER_STATE_DIR)
+MEAN_MAX_ROLLING_DAYS = int(os.getenv("MEAN_MAX_ROLLING_DAYS", 90)) # optional, window of the rolling MeanMaxBests envelope
+GEO_TILE_INDEX = True if os.getenv("GEO_TILE_INDEX") in ['True', 'true', 'TRUE','t', 'T', 'yes', 'Yes', 'YES', '1'] else False # optional, adds a Geohash field to the ActivityGPS points and keeps per tile visit counts (GeoTiles measurement, index in FETCHER_STATE_DIR) updated with each activity, for heatmaps and "activities near here" lookups
+GEO_TILE_PRECISIONS = [int(precision) for precision in os.getenv("GEO_TILE_PRECISIONS", "5,6,7").split(",")] # optional, geohash lengths of the GeoTiles zoom levels (5 ~ 4.9 km, 6 ~ 1.2 km, 7 ~ 150 m tiles), the ActivityGPS Geohash field uses the longest
+ROUTE_INDEX = True if os.getenv("ROUTE_INDEX") in ['True', 'true', 'TRUE','t', 'T', 'yes', 'Yes', 'YES', '1'] else False # optional, fingerprints the route of each activity (MinHash of the visited cells, LSH index in FETCHER_STATE_DIR) and gives it and its ActivityMetrics / ActivityMeanMax points a RouteID field, shared with the past activities on the same route
+ROUTE_MATCH_THRESHOLD = float(os.getenv("ROUTE_MATCH_THRESHOLD", 0.6)) # optional, share of visited ~150 m cells two activities must have in common to be on the same route
+ACTIVITY_GPS_SIMPLIFICATION = os.getenv("ACTIVITY_GPS_SIMPLIFICATION", "off").lower() # optional, "alongside" also writes a Douglas-Peucker simplified copy of each route as ActivityGPSSimplified, "replace" writes only the simplified route (as ActivityGPS, with position, altitude, distance, heart rate and speed fields)
+ACTIVITY_SIMPLIFY_DISTANCE_METERS = float(os.getenv("ACTIVITY_SIMPLIFY_DISTANCE_METERS", 5)) # optional, largest distance between a dropped point and the simplified route
+ACTIVITY_SIMPLIFY_HEART_RATE_BPM = float(os.getenv("ACTIVITY_SIMPLIFY_HEART_RATE_BPM", 3)) # optional, largest heart rate change a dropped point may hide, 0 ignores heart rate
+ACTIVITY_SIMPLIFY_SPEED_MPS = float(os.getenv("ACTIVITY_SIMPLIFY_SPEED_MPS", 0.5)) # optional, largest speed change (m/s) a dropped point may hide, 0 ignores speed
+FAST_FIT_DECODER = True if os.getenv("FAST_FIT_DECODER") in ['True', 'true', 'TRUE','t', 'T', 'yes', 'Yes', 'YES', '1'] else False # optional, decodes the record, session, lap and length messages of activity FIT files as NumPy columns instead of parsing them message by message with fitparse
+INTRADAY_DELTA_MODE = True if os.getenv("INTRADAY_DELTA_MODE") in ['True', 'true', 'TRUE','t', 'T', 'yes', 'Yes', 'YES', '1'] else False # optional, the live update loop only writes the intraday heart rate, steps, stress, body battery and breathing points newer than the ones it already wrote for the day
+WIDE_ROW_SCHEMA = True if os.getenv("WIDE_ROW_SCHEMA") in ['True', 'true', 'TRUE','t', 'T', 'yes', 'Yes', 'YES', '1'] else False # optional, merges the points of WIDE_ROW_MEASUREMENTS sharing a timestamp (and tags) into one row with all their fields before writing them
+WIDE_ROW_MEASUREMENTS = os.getenv("WIDE_ROW_MEASUREMENTS", "SleepIntraday").split(",") # optional, measurements built from several single field series, merged with WIDE_ROW_SCHEMA
+SKIP_UNCHANGED_WRITES = True if os.getenv("SKIP_UNCHANGED_WRITES") in ['True', 'true', 'TRUE','t', 'T', 'yes', 'Yes', 'YES', '1'] else False # optional, the live update loop skips a metric when the Garmin payloads it is built from did not change since they were last written (bulk updates always rewrite)
+PARSED_ACTIVITY_IDS = set()
+if ACTIVITY_GPS_SIMPLIFICATION not in ROUTE_SIMPLIFICATION_MODES:
+    raise ValueError(f"ACTIVITY_GPS_SIMPLIFICATION must be one of {', '.join(ROUTE_SIMPLIFICATION_MODES)}")
+if GARMIN_ACCOUNT_TOKEN_DIRS and not TAG_MEASUREMENTS_WITH_USER_EMAIL:
+    TAG_MEASUREMENTS_WITH_USER_EMAIL = True # measurements of different accounts must be told apart
 
 # %%
 for handler in logging.root.handlers[:]:
@@ -68,27 +150,41 @@ logging.basicConfig(
     ]
 )
 
+# %%
+def start_activity_parse_pool():
+    pool = ProcessPoolExecutor(max_workers=ACTIVITY_PARSE_PROCESSES, mp_context=multiprocessing.get_context("fork"))
+    pool.submit(int).result() # a fork pool starts all its workers on the first task
+    return pool
+
+# Forked here, before any other thread exists - the workers only run the pure functions of activity_parsing
+ACTIVITY_PARSE_POOL = start_activity_parse_pool() if ACTIVITY_PARSE_PROCESSES > 0 else None
+ACTIVITY_PARSE_POOL_LOCK = threading.Lock()
+if ACTIVITY_PARSE_POOL:
+    atexit.register(lambda: ACTIVITY_PARSE_POOL.shutdown()) # the pool in use at exit, it may have been replaced
+
 # %%
 try:
     if INFLUXDB_ENDPOINT_IS_HTTP:
         if INFLUXDB_VERSION == '1':
-            influxdbclient = InfluxDBClient(host=INFLUXDB_HOST, port=INFLUXDB_PORT, username=INFLUXDB_USERNAME, password=INFLUXDB_PASSWORD)
+            influxdbclient = InfluxDBClient(host=INFLUXDB_HOST, port=INFLUXDB_PORT, username=INFLUXDB_USERNAME, password=INFLUXDB_PASSWORD, gzip=INFLUXDB_GZIP)
             influxdbclient.switch_database(INFLUXDB_DATABASE)
         else:
             influxdbclient = InfluxDBClient3(
             host=f"http://{INFLUXDB_HOST}:{INFLUXDB_PORT}",
             token=INFLUXDB_V3_ACCESS_TOKEN,
-            database=INFLUXDB_DATABASE
+            database=INFLUXDB_DATABASE,
+            enable_gzip=INFLUXDB_GZIP
             )
     else:
         if INFLUXDB_VERSION == '1':
-            influxdbclient = InfluxDBClient(host=INFLUXDB_HOST, port=INFLUXDB_PORT, username=INFLUXDB_USERNAME, password=INFLUXDB_PASSWORD, ssl=True, verify_ssl=True)
+            influxdbclient = InfluxDBClient(host=INFLUXDB_HOST, port=INFLUXDB_PORT, username=INFLUXDB_USERNAME, password=INFLUXDB_PASSWORD, ssl=True, verify_ssl=True, gzip=INFLUXDB_GZIP)
             influxdbclient.switch_database(INFLUXDB_DATABASE)
         else:
             influxdbclient = InfluxDBClient3(
             host=f"https://{INFLUXDB_HOST}:{INFLUXDB_PORT}",
             token=INFLUXDB_V3_ACCESS_TOKEN,
-            database=INFLUXDB_DATABASE
+            database=INFLUXDB_DATABASE,
+            enable_gzip=INFLUXDB_GZIP
             )
     demo_point = {
     'measurement': 'DemoPoint',
@@ -117,14 +213,17 @@ def iter_days(start_date: str, end_date: str):
 
 
 # %%
-def garmin_login():
+def garmin_login(token_dir=TOKEN_DIR, rate_limiter=None):
+    # Only the primary account (TOKEN_DIR) can fall back to an interactive login, additional accounts need stored tokens
     try:
-        logging.info(f"Trying to login to Garmin Connect using token data from directory '{TOKEN_DIR}'...")
+        logging.info(f"Trying to login to Garmin Connect using token data from directory '{token_dir}'...")
         garmin = Garmin()
-        garmin.login(TOKEN_DIR)
+        garmin.login(token_dir)
         logging.info("login to Garmin Connect successful using stored session tokens.")
 
     except (FileNotFoundError, GarthHTTPError, GarminConnectAuthenticationError):
+        if token_dir != TOKEN_DIR:
+            raise Exception(f"Session is expired or tokens are missing for the account in '{token_dir}' : generate its tokens and restart the script")
         logging.warning("Session is expired or login information not present/incorrect. You'll need to log in again...login with your Garmin Connect credentials to generate them.")
         try:
             user_email = GARMINCONNECT_EMAIL or input("Enter Garminconnect Login e-mail: ")
@@ -153,25 +252,327 @@ def garmin_login():
             logging.error(str(err))
             raise Exception("Session is expired : please login again and restart the script")
 
-    return garmin
+    return GarminClientProxy(garmin, token_dir, rate_limiter or new_rate_limiter())
+
+def relogin():
+    return garmin_login(garmin_obj.token_dir, garmin_obj.rate_limiter)
+
+# %%
+GARMIN_REQUEST_BUDGET = threading.BoundedSemaphore(max(1, GARMIN_MAX_INFLIGHT_REQUESTS))
+
+def new_rate_limiter():
+    # Every account gets its own budget
+    if not ADAPTIVE_RATE_LIMIT:
+        return None
+    return AdaptiveRateLimiter(
+        max_rate_per_minute=GARMIN_RATE_LIMIT_PER_MINUTE,
+        min_rate_per_minute=GARMIN_RATE_LIMIT_MIN_PER_MINUTE,
+        burst=GARMIN_RATE_LIMIT_BURST,
+        backoff_max_seconds=FETCH_FAILED_WAIT_SECONDS
+    )
+
+RESPONSE_CACHE = ResponseCache(
+    os.path.join(FETCHER_STATE_DIR, "garmin_response_cache.sqlite"),
+    max_size_bytes=RESPONSE_CACHE_MAX_SIZE_MB * 2**20,
+    immutable_after_days=RESPONSE_CACHE_IMMUTABLE_AFTER_DAYS,
+    recent_ttl_seconds=RESPONSE_CACHE_RECENT_TTL_SECONDS,
+    ttl_seconds=RESPONSE_CACHE_TTL_SECONDS
+) if GARMIN_RESPONSE_CACHE else None
+# Read-only, date keyed endpoints used by the getters - these are memoized per date and cached on disk,
+# anything else (downloads, device info, POST requests) always goes to Garmin
+DATE_KEYED_GARMIN_METHODS = {
+    'get_stats', 'get_sleep_data', 'get_heart_rates', 'get_steps_data', 'get_stress_data', 'get_respiration_data',
+    'get_hrv_data', 'get_weigh_ins', 'get_activities_by_date', 'get_training_status', 'get_training_readiness',
+    'get_hill_score', 'get_race_predictions', 'get_fitnessage_data', 'get_max_metrics', 'get_endurance_score',
+    'get_blood_pressure', 'get_hydration_data', 'get_device_solar_data', 'connectapi'
+}
+DATE_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+def is_rate_limit_error(err):
+    return isinstance(err, GarminConnectTooManyRequestsError) or is_rate_limit_response(err)
+
+def date_keyed_request(name, args, kwargs):
+    # Returns (key, date) for a call to a date keyed endpoint, (None, None) otherwise
+    if name not in DATE_KEYED_GARMIN_METHODS or kwargs.get('method', 'GET').upper() != 'GET':
+        return None, None
+    for value in list(args) + list(kwargs.values()):
+        date_match = DATE_PATTERN.search(value) if isinstance(value, str) else None
+        if date_match:
+            return f"{name}|{json.dumps([args, kwargs], sort_keys=True, default=str)}", date_match.group(0)
+    return None, None
+
+class DateRequestContext:
+    """Per-date memo of Garmin responses : each endpoint is fetched at most once while the date is being processed
+    and every getter asking for it (from any worker thread) gets the same parsed payload, e.g. the payloads the
+    fingerprint check fetched before the getter runs."""
+    def __init__(self):
+        self.users = 0
+        self._results = {}
+        self._lock = threading.Lock()
+
+    def get_or_fetch(self, key, fetch):
+        with self._lock:
+            entry = self._results.get(key)
+            is_owner = entry is None
+            if is_owner:
+                entry = self._results[key] = {"done": threading.Event(), "result": None, "error": None}
+        if is_owner:
+            try:
+                entry["result"] = fetch()
+            except Exception as err:
+                entry["error"] = err
+                with self._lock:
+                    self._results.pop(key, None) # failed requests are not memoized, a retry fetches again
+                raise
+            finally:
+                entry["done"].set()
+        else:
+            entry["done"].wait()
+            if entry["error"]:
+                raise entry["error"]
+        return entry["result"]
+
+DATE_REQUEST_CONTEXTS = {}
+DATE_REQUEST_CONTEXTS_LOCK = threading.Lock()
+
+@contextmanager
+def date_request_context(date_str):
+    # Memoizes the date keyed Garmin calls for date_str until the outermost context for that date exits
+    context_key = (garmin_obj.user_id, date_str)
+    with DATE_REQUEST_CONTEXTS_LOCK:
+        context = DATE_REQUEST_CONTEXTS.setdefault(context_key, DateRequestContext())
+        context.users += 1
+    try:
+        yield context
+    finally:
+        with DATE_REQUEST_CONTEXTS_LOCK:
+            context.users -= 1
+            if context.users == 0:
+                DATE_REQUEST_CONTEXTS.pop(context_key, None)
+
+class GarminClientProxy:
+    """Wraps the Garmin client so every API method call goes through the shared request budget.
+    Attributes which are not methods (garth, ActivityDownloadFormat etc.) are passed through untouched."""
+    def __init__(self, garmin, token_dir, rate_limiter):
+        self._garmin = garmin
+        self.token_dir = token_dir
+        self.rate_limiter = rate_limiter
+        self.network_calls = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self._garmin, name)
+        if not inspect.ismethod(attr):
+            return attr
+        def budgeted_call(*args, **kwargs):
+            request_key, date_str = date_keyed_request(name, args, kwargs)
+            if request_key is None:
+                return self._call(name, attr, args, kwargs)
+            context = DATE_REQUEST_CONTEXTS.get((self.user_id, date_str))
+            if context:
+                result = context.get_or_fetch(request_key, lambda: self._cached_call(name, attr, args, kwargs, request_key, date_str))
+            else:
+                result = self._cached_call(name, attr, args, kwargs, request_key, date_str)
+            recorded_payloads = getattr(PAYLOAD_RECORDER, "payloads", None)
+            if recorded_payloads is not None:
+                recorded_payloads.append(([name, list(args), kwargs], result))
+            return result
+        return budgeted_call
+
+    @property
+    def user_id(self):
+        return self._garmin.garth.profile.get('userName', 'Unknown')
+
+    def _cached_call(self, name, method, args, kwargs, request_key, date_str):
+        if not RESPONSE_CACHE:
+            return self._call(name, method, args, kwargs)
+        cache_key = f"{self.user_id}|{request_key}"
+        result = RESPONSE_CACHE.get(cache_key)
+        if result is not ResponseCache.MISS:
+            logging.debug(f"Response cache : hit for {name} on {date_str}")
+            return result
+        result = self._call(name, method, args, kwargs)
+        RESPONSE_CACHE.put(cache_key, date_str, result)
+        return result
+
+    def _call(self, name, method, args, kwargs):
+        attempt = 0
+        while True:
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+            try:
+                with GARMIN_REQUEST_BUDGET:
+                    self.network_calls += 1
+                    result = method(*args, **kwargs)
+            except Exception as err:
+                if not (self.rate_limiter and is_rate_limit_error(err)):
+                    raise
+                wait_seconds = self.rate_limiter.on_throttle(retry_after_seconds(err))
+                attempt += 1
+                if attempt > GARMIN_MAX_RETRIES:
+                    raise GarminConnectTooManyRequestsError(f"Too many requests : {name} still throttled after {GARMIN_MAX_RETRIES} retries") from err
+                logging.warning(f"Too many requests (429) : {name} throttled - retrying in {wait_seconds:.0f} seconds (attempt {attempt}/{GARMIN_MAX_RETRIES})")
+                continue
+            if self.rate_limiter:
+                self.rate_limiter.on_success()
+            return result
+
+PAYLOAD_RECORDER = threading.local() # collects the date keyed payloads seen by the getter running in the current thread
+
+def log_rate_budget():
+    if garmin_obj.rate_limiter:
+        budget = garmin_obj.rate_limiter.budget()
+        logging.info(f"Rate budget : {budget['tokens']:.1f} requests available at {budget['rate_per_minute']:.1f} requests/minute, cooldown {budget['cooldown_seconds']:.0f} seconds")
 
 # %%
-def write_points_to_influxdb(points):
+SYNC_STATE = SyncStateStore(os.path.join(FETCHER_STATE_DIR, "sync_state.sqlite")) if PERSISTENT_SYNC_STATE else None
+FIT_STORE = FitStore(os.path.join(FIT_FILE_STORAGE_LOCATION, "store"), max_size_bytes=FIT_FILE_STORE_MAX_SIZE_MB * 2**20) if FIT_FILE_STORE else None
+MEAN_MAX_STORE = MeanMaxStore(os.path.join(FETCHER_STATE_DIR, "mean_max.sqlite")) if MEAN_MAX_CURVES else None
+GEO_TILE_STORE = GeoTileStore(os.path.join(FETCHER_STATE_DIR, "geo_tiles.sqlite")) if GEO_TILE_INDEX else None
+ROUTE_STORE = RouteFingerprintStore(os.path.join(FETCHER_STATE_DIR, "routes.sqlite")) if ROUTE_INDEX else None
+ACTIVITY_INDEX = ActivityIndex(os.path.join(FETCHER_STATE_DIR, "activity_index.sqlite")) if PERSISTENT_ACTIVITY_INDEX else None
+
+def point_time_ms(point):
+    point_time = point['time'] if isinstance(point['time'], datetime) else datetime.fromisoformat(point['time'])
+    return int(point_time.timestamp() * 1000)
+
+def latest_point_times(points):
+    # {measurement: epoch ms of its latest point}
+    latest = {}
+    for point in points:
+        measurement, point_ms = (point.measurement, point.latest_time_ms()) if isinstance(point, ColumnarPoints) else (point['measurement'], point_time_ms(point))
+        latest[measurement] = max(latest.get(measurement, point_ms), point_ms)
+    return latest
+
+def points_count(points):
+    return sum(len(point) if isinstance(point, ColumnarPoints) else 1 for point in points)
+
+def merge_wide_rows(points, measurements):
+    # Points of the measurements sharing tags and time become one point with all their fields, a later point wins a field the way it would in InfluxDB
+    merged = []
+    rows = {}
+    for point in points:
+        if isinstance(point, ColumnarPoints) or point['measurement'] not in measurements:
+            merged.append(point)
+            continue
+        key = (point['measurement'], point_time_ms(point), tuple(sorted(point['tags'].items())))
+        row = rows.get(key)
+        if row is None:
+            row = rows[key] = {"measurement": point['measurement'], "time": point['time'], "tags": point['tags'], "fields": dict(point['fields'])}
+            merged.append(row)
+        else:
+            row['fields'].update(point['fields'])
+    return merged
+
+def intraday_columns(measurement, entries, value_index, field_name, dtype, keep_zero=True, since_ms=0):
+    # Columnar version of the intraday getters' point loops, returns a list holding a single ColumnarPoints block (or nothing)
+    times_ms, values = pair_columns(entries, value_index, dtype, keep_zero=keep_zero, since_ms=since_ms)
+    if len(times_ms) == 0:
+        return []
+    return [ColumnarPoints(measurement, times_ms, {field_name: values}, {"Device": GARMIN_DEVICENAME, "Database_Name": INFLUXDB_DATABASE})]
+
+LINE_PROTOCOL_ENCODER = LineProtocolEncoder(precision=WRITE_PRECISION, max_batch_bytes=WRITE_BATCH_MAX_BYTES)
+WRITE_SPOOL_STORE = WriteSpool(WRITE_SPOOL_DIR, max_total_bytes=WRITE_SPOOL_MAX_SIZE_MB * 2**20) if WRITE_SPOOL else None
+INFLUXDB_UNREACHABLE_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout, Urllib3HTTPError) # database down or restarting, spooled as well
+
+def write_point_chunks(points):
     write_chunk_size = 20000
+    blocks = [item for item in points if isinstance(item, ColumnarPoints)]
+    point_dicts = [item for item in points if not isinstance(item, ColumnarPoints)]
+    if INFLUXDB_VERSION == '1':
+        for block in blocks:
+            point_dicts.extend(block.to_points())
+        blocks = []
+    # Write in chunks - Issue reported for large activities data containing >20000 points - Error 413 : payload too large
+    for i in range(0, len(point_dicts), write_chunk_size):
+        if INFLUXDB_VERSION == '1':
+            influxdbclient.write_points(point_dicts[i:i + write_chunk_size])
+        else:
+            influxdbclient.write(record=point_dicts[i:i + write_chunk_size])
+    for block in blocks:
+        data_frame = block.to_dataframe()
+        for i in range(0, len(data_frame), write_chunk_size):
+            influxdbclient.write(record=data_frame.iloc[i:i + write_chunk_size], data_frame_measurement_name=block.measurement, data_frame_tag_columns=list(block.tags), data_frame_timestamp_column="time")
+
+def write_line_protocol_batch(precision, batch):
+    if INFLUXDB_VERSION == '1':
+        influxdbclient.write(batch.decode("utf-8"), params={'db': INFLUXDB_DATABASE, 'precision': V1_PRECISION[precision]}, expected_response_code=204, protocol='line')
+    else:
+        influxdbclient.write(record=batch, write_precision=precision)
+
+def write_line_protocol(points):
+    # Batches are closed by byte size, so large activities never hit 413 : payload too large
+    for batch in LINE_PROTOCOL_ENCODER.batches(points):
+        write_line_protocol_batch(WRITE_PRECISION, batch)
+
+def replay_write_spool():
+    # Returns False if spooled batches are left because InfluxDB is still unavailable
+    if not WRITE_SPOOL_STORE or not WRITE_SPOOL_STORE.pending_bytes():
+        return True
+    def send(precision, batch):
+        try:
+            write_line_protocol_batch(precision, batch)
+            return True
+        except (InfluxDBClientError, InfluxDBError) + INFLUXDB_UNREACHABLE_ERRORS as err:
+            logging.error("Write spool : replay failed, InfluxDB is still unavailable - " + str(err))
+            return False
+    replayed = WRITE_SPOOL_STORE.replay(send)
+    pending_bytes = WRITE_SPOOL_STORE.pending_bytes()
+    logging.info(f"Write spool : replayed {replayed} batches ({WRITE_SPOOL_STORE.replayed_batches} in total), {pending_bytes / 2**20:.1f} MB left, {WRITE_SPOOL_STORE.dropped_bytes / 2**20:.1f} MB dropped by the size cap")
+    return pending_bytes == 0
+
+def send_points(points):
+    # Returns False if the write failed. With WRITE_SPOOL a failed write is spooled and counts as written
     try:
-        if len(points) != 0:
-            if TAG_MEASUREMENTS_WITH_USER_EMAIL:
-                for item in points:
-                    item['tags'].update({'User_ID': garmin_obj.garth.profile.get('userName','Unknown')})
-            # Write in chunks - Issue reported for large activities data containing >20000 points - Error 413 : payload too large
-            for i in range(0, len(points), write_chunk_size):
-                if INFLUXDB_VERSION == '1':
-                    influxdbclient.write_points(points[i:i + write_chunk_size])
-                else:
-                    influxdbclient.write(record=points[i:i + write_chunk_size])
-            logging.info("Success : updated influxDB database with new points")
-    except (InfluxDBClientError, InfluxDBError) as err:
-        logging.error("Write failed : Unable to connect with database! " + str(err))
+        if not replay_write_spool(): # keep the spooled order, newer points go behind the spooled ones
+            raise InfluxDBError(message="spooled batches are still waiting for replay")
+        if LINE_PROTOCOL_WRITES:
+            write_line_protocol(points)
+        else:
+            write_point_chunks(points)
+        logging.info("Success : updated influxDB database with new points")
+        return True
+    except (InfluxDBClientError, InfluxDBError) + INFLUXDB_UNREACHABLE_ERRORS as err:
+        if not WRITE_SPOOL_STORE:
+            if isinstance(err, INFLUXDB_UNREACHABLE_ERRORS):
+                raise
+            logging.error("Write failed : Unable to connect with database! " + str(err))
+            return False
+        for batch in LINE_PROTOCOL_ENCODER.batches(points):
+            WRITE_SPOOL_STORE.append(WRITE_PRECISION, batch)
+        logging.warning(f"Write failed : spooled {points_count(points)} points for replay ({WRITE_SPOOL_STORE.spooled_batches} batches spooled so far) - " + str(err))
+        return True
+
+WRITE_PIPELINE = WritePipeline(send_points, flush_points=WRITE_FLUSH_POINTS, flush_seconds=WRITE_FLUSH_SECONDS, max_pending_points=WRITE_QUEUE_MAX_POINTS) if ASYNC_WRITES else None
+if WRITE_PIPELINE:
+    atexit.register(WRITE_PIPELINE.close) # exit() in bulk mode must not drop queued points
+
+def write_points_to_influxdb(points, on_success=None, on_failure=None):
+    # Returns False if the write failed. on_success is called once the points are stored (or if there is nothing to write), on_failure if the write failed
+    # points may mix point dicts and ColumnarPoints blocks. With ASYNC_WRITES the points are only queued : True means accepted, the callbacks run on the writer thread once the batch is written or failed
+    if len(points) == 0:
+        if on_success:
+            on_success()
+        return True
+    if WIDE_ROW_SCHEMA:
+        points = merge_wide_rows(points, WIDE_ROW_MEASUREMENTS)
+    if TAG_MEASUREMENTS_WITH_USER_EMAIL:
+        for item in points:
+            (item.tags if isinstance(item, ColumnarPoints) else item['tags']).update({'User_ID': garmin_obj.garth.profile.get('userName','Unknown')})
+    user_id = garmin_obj.user_id # the writer thread must not look at garmin_obj, it may belong to another account by then
+    def on_written():
+        if SYNC_STATE:
+            SYNC_STATE.advance(user_id, latest_point_times(points))
+        if on_success:
+            on_success()
+    if WRITE_PIPELINE:
+        WRITE_PIPELINE.submit(points, points_count(points), on_written, on_failure)
+        return True
+    if not send_points(points):
+        if on_failure:
+            on_failure()
+        return False
+    on_written()
+    return True
 
 # %%
 def get_daily_stats(date_str):
@@ -459,35 +860,42 @@ def get_sleep_data(date_str):
     return points_list
 
 # %%
-def get_intraday_hr(date_str):
+def get_intraday_hr(date_str, watermarks=None):
+    # watermarks (measurement -> epoch ms) drops the points older than the ones already written
     points_list = []
+    since_ms = (watermarks or {}).get("HeartRateIntraday", 0)
     hr_list = garmin_obj.get_heart_rates(date_str).get("heartRateValues") or []
-    for entry in hr_list:
-        if entry[1]:
-            points_list.append({
-                    "measurement":  "HeartRateIntraday",
-                    "time": datetime.fromtimestamp(entry[0]/1000, tz=pytz.timezone("UTC")).isoformat(),
-                    "tags": {
-                        "Device": GARMIN_DEVICENAME,
-                        "Database_Name": INFLUXDB_DATABASE
-                    },
-                    "fields": {
-                        "HeartRate": entry[1]
-                    }
-                })
+    if COLUMNAR_INGESTION:
+        points_list = intraday_columns("HeartRateIntraday", hr_list, 1, "HeartRate", np.int64, keep_zero=False, since_ms=since_ms)
+    else:
+        for entry in hr_list:
+            if entry[1] and entry[0] >= since_ms:
+                points_list.append({
+                        "measurement":  "HeartRateIntraday",
+                        "time": datetime.fromtimestamp(entry[0]/1000, tz=pytz.timezone("UTC")).isoformat(),
+                        "tags": {
+                            "Device": GARMIN_DEVICENAME,
+                            "Database_Name": INFLUXDB_DATABASE
+                        },
+                        "fields": {
+                            "HeartRate": entry[1]
+                        }
+                    })
     if points_list:
         logging.info(f"Success : Fetching intraday Heart Rate for date {date_str}")
     return points_list
 
 # %%
-def get_intraday_steps(date_str):
+def get_intraday_steps(date_str, watermarks=None):
     points_list = []
+    since_ms = (watermarks or {}).get("StepsIntraday", 0)
     steps_list = garmin_obj.get_steps_data(date_str)
     for entry in steps_list:
-        if entry["steps"] or entry["steps"] == 0:
+        start_time = pytz.timezone("UTC").localize(datetime.strptime(entry['startGMT'], "%Y-%m-%dT%H:%M:%S.%f"))
+        if (entry["steps"] or entry["steps"] == 0) and start_time.timestamp() * 1000 >= since_ms:
             points_list.append({
                     "measurement":  "StepsIntraday",
-                    "time": pytz.timezone("UTC").localize(datetime.strptime(entry['startGMT'], "%Y-%m-%dT%H:%M:%S.%f")).isoformat(),
+                    "time": start_time.isoformat(),
                     "tags": {
                         "Device": GARMIN_DEVICENAME,
                         "Database_Name": INFLUXDB_DATABASE
@@ -501,57 +909,67 @@ def get_intraday_steps(date_str):
     return points_list
 
 # %%
-def get_intraday_stress(date_str):
+def get_intraday_stress(date_str, watermarks=None):
     points_list = []
-    stress_list = garmin_obj.get_stress_data(date_str).get('stressValuesArray') or []
-    for entry in stress_list:
-        if entry[1] or entry[1] == 0:
-            points_list.append({
-                    "measurement":  "StressIntraday",
-                    "time": datetime.fromtimestamp(entry[0]/1000, tz=pytz.timezone("UTC")).isoformat(),
-                    "tags": {
-                        "Device": GARMIN_DEVICENAME,
-                        "Database_Name": INFLUXDB_DATABASE
-                    },
-                    "fields": {
-                        "stressLevel": entry[1]
-                    }
-                })
-    bb_list = garmin_obj.get_stress_data(date_str).get('bodyBatteryValuesArray') or []
-    for entry in bb_list:
-        if entry[2] or entry[2] == 0:
-            points_list.append({
-                    "measurement":  "BodyBatteryIntraday",
-                    "time": datetime.fromtimestamp(entry[0]/1000, tz=pytz.timezone("UTC")).isoformat(),
-                    "tags": {
-                        "Device": GARMIN_DEVICENAME,
-                        "Database_Name": INFLUXDB_DATABASE
-                    },
-                    "fields": {
-                        "BodyBatteryLevel": entry[2]
-                    }
-                })
+    watermarks = watermarks or {}
+    stress_data = garmin_obj.get_stress_data(date_str)
+    stress_list = stress_data.get('stressValuesArray') or []
+    bb_list = stress_data.get('bodyBatteryValuesArray') or []
+    if COLUMNAR_INGESTION:
+        points_list = intraday_columns("StressIntraday", stress_list, 1, "stressLevel", np.int64, since_ms=watermarks.get("StressIntraday", 0))
+        points_list += intraday_columns("BodyBatteryIntraday", bb_list, 2, "BodyBatteryLevel", np.int64, since_ms=watermarks.get("BodyBatteryIntraday", 0))
+    else:
+        for entry in stress_list:
+            if (entry[1] or entry[1] == 0) and entry[0] >= watermarks.get("StressIntraday", 0):
+                points_list.append({
+                        "measurement":  "StressIntraday",
+                        "time": datetime.fromtimestamp(entry[0]/1000, tz=pytz.timezone("UTC")).isoformat(),
+                        "tags": {
+                            "Device": GARMIN_DEVICENAME,
+                            "Database_Name": INFLUXDB_DATABASE
+                        },
+                        "fields": {
+                            "stressLevel": entry[1]
+                        }
+                    })
+        for entry in bb_list:
+            if (entry[2] or entry[2] == 0) and entry[0] >= watermarks.get("BodyBatteryIntraday", 0):
+                points_list.append({
+                        "measurement":  "BodyBatteryIntraday",
+                        "time": datetime.fromtimestamp(entry[0]/1000, tz=pytz.timezone("UTC")).isoformat(),
+                        "tags": {
+                            "Device": GARMIN_DEVICENAME,
+                            "Database_Name": INFLUXDB_DATABASE
+                        },
+                        "fields": {
+                            "BodyBatteryLevel": entry[2]
+                        }
+                    })
     if points_list:
         logging.info(f"Success : Fetching intraday stress and Body Battery values for date {date_str}")
     return points_list
 
 # %%
-def get_intraday_br(date_str):
+def get_intraday_br(date_str, watermarks=None):
     points_list = []
+    since_ms = (watermarks or {}).get("BreathingRateIntraday", 0)
     br_list = garmin_obj.get_respiration_data(date_str).get('respirationValuesArray') or []
-    for entry in br_list:
-        if entry[1]:
-            points_list.append({
-                    "measurement":  "BreathingRateIntraday",
-                    "time": datetime.fromtimestamp(entry[0]/1000, tz=pytz.timezone("UTC")).isoformat(),
-                    "tags": {
-                        "Device": GARMIN_DEVICENAME,
-                        "Database_Name": INFLUXDB_DATABASE
-                    },
-                    "fields": {
-                        "BreathingRate": entry[1]
-                    }
-                })
+    if COLUMNAR_INGESTION:
+        points_list = intraday_columns("BreathingRateIntraday", br_list, 1, "BreathingRate", np.float64, keep_zero=False, since_ms=since_ms)
+    else:
+        for entry in br_list:
+            if entry[1] and entry[0] >= since_ms:
+                points_list.append({
+                        "measurement":  "BreathingRateIntraday",
+                        "time": datetime.fromtimestamp(entry[0]/1000, tz=pytz.timezone("UTC")).isoformat(),
+                        "tags": {
+                            "Device": GARMIN_DEVICENAME,
+                            "Database_Name": INFLUXDB_DATABASE
+                        },
+                        "fields": {
+                            "BreathingRate": entry[1]
+                        }
+                    })
     if points_list:
         logging.info(f"Success : Fetching intraday Breathing Rate for date {date_str}")
     return points_list
@@ -559,6 +977,8 @@ def get_intraday_br(date_str):
 # %%
 def get_intraday_hrv(date_str):
     points_list = []
+    # The readings come from the HRV endpoint only : the sleep payload's hrvData has other timestamps, which would write
+    # a second series of points next to the stored ones. The date's request memo still spares the fingerprint check's request
     hrv_list = (garmin_obj.get_hrv_data(date_str) or {}).get('hrvReadings') or []
     for entry in hrv_list:
         if entry.get('hrvValue'):
@@ -614,12 +1034,14 @@ def get_body_composition(date_str):
 def get_activity_summary(date_str):
     points_list = []
     activity_with_gps_id_dict = {}
+    activity_markers = {}
     activity_list = garmin_obj.get_activities_by_date(date_str, date_str)
     for activity in activity_list:
         if activity.get('hasPolyline') or ALWAYS_PROCESS_FIT_FILES: # will process FIT files lacking GPS data if ALWAYS_PROCESS_FIT_FILES is set to True
             if not activity.get('hasPolyline'):
                 logging.warning(f"Activity ID {activity.get('activityId')} got no GPS data - yet, activity FIT file data will be processed as ALWAYS_PROCESS_FIT_FILES is on")
             activity_with_gps_id_dict[activity.get('activityId')] = (activity.get('activityType') or {}).get('typeKey', "Unknown")
+            activity_markers[activity.get('activityId')] = f"{ACTIVITY_SCHEMA_VERSION}:" + hashlib.sha256(json.dumps(activity, sort_keys=True, default=str).encode("utf-8")).hexdigest() # changes with any edit Garmin makes to the activity, or a new activity schema
         if "startTimeGMT" in activity: # "startTimeGMT" should be available for all activities (fix #13)
             points_list.append({
                 "measurement":  "ActivitySummary",
@@ -672,240 +1094,208 @@ def get_activity_summary(date_str):
             logging.info(f"Success : Fetching Activity summary with id {activity.get('activityId')} for date {date_str}")
         else:
             logging.warning(f"Skipped : Start Timestamp missing for activity id {activity.get('activityId')} for date {date_str}")
-    return points_list, activity_with_gps_id_dict
+    return points_list, activity_with_gps_id_dict, activity_markers
 
 # %%
-def fetch_activity_GPS(activityIDdict): # Uses FIT file by default, falls back to TCX
-    points_list = []
-    for activityID in activityIDdict.keys():
-        activity_type = activityIDdict[activityID]
-        if (activityID in PARSED_ACTIVITY_ID_LIST) and (not FORCE_REPROCESS_ACTIVITIES):
-            logging.info(f"Skipping : Activity ID {activityID} has already been processed within current runtime")
-            return []
-        if (activityID in PARSED_ACTIVITY_ID_LIST) and (FORCE_REPROCESS_ACTIVITIES):
-            logging.info(f"Re-processing : Activity ID {activityID} (FORCE_REPROCESS_ACTIVITIES is on)")
+def file_digest(file_obj):
+    digest = hashlib.sha256()
+    for block in iter(lambda: file_obj.read(2**20), b""):
+        digest.update(block)
+    return digest.hexdigest()
+
+def write_activity_chunks(chunks, on_success=None):
+    # Writes the point chunks of an activity while they are parsed, returns (False if a write failed, ActivitySelector of the activity)
+    # on_success(point count) is called once every chunk is stored - with ASYNC_WRITES that is after the writer thread wrote the last one
+    if ACTIVITY_METRICS: # from the full resolution points, before they may be simplified
+        chunks = activity_metrics_chunks(chunks, ACTIVITY_MAX_HEART_RATE, ACTIVITY_RESTING_HEART_RATE, ACTIVITY_SPLIT_METERS)
+    if MEAN_MAX_STORE:
+        chunks = best_envelope_chunks(mean_max_chunks(chunks), MEAN_MAX_STORE, garmin_obj.user_id, MEAN_MAX_ROLLING_DAYS)
+    if ROUTE_STORE: # after the summary points it gives the RouteID field
+        chunks = route_index_chunks(chunks, ROUTE_STORE, garmin_obj.user_id, ROUTE_MATCH_THRESHOLD)
+    if GEO_TILE_STORE:
+        chunks = geo_tile_chunks(chunks, GEO_TILE_STORE, garmin_obj.user_id, GEO_TILE_PRECISIONS, ACTIVITY_CHUNK_POINTS)
+    if ACTIVITY_GPS_SIMPLIFICATION != "off":
+        chunks = simplify_route_chunks(chunks, ACTIVITY_GPS_SIMPLIFICATION, ACTIVITY_SIMPLIFY_DISTANCE_METERS, ACTIVITY_SIMPLIFY_HEART_RATE_BPM, ACTIVITY_SIMPLIFY_SPEED_MPS, ACTIVITY_CHUNK_POINTS)
+    activity_selector = None
+    progress = {"written": 0, "chunks": None, "points": 0}
+    progress_lock = threading.Lock()
+    def chunk_written():
+        with progress_lock:
+            progress["written"] += 1
+            complete = progress["written"] == progress["chunks"]
+        if complete and on_success:
+            on_success(progress["points"])
+    chunk_count = 0
+    for chunk in chunks:
+        activity_selector = chunk[0]['tags'].get('ActivitySelector') or activity_selector # MeanMaxBests points belong to no single activity
+        chunk_count += 1
+        progress["points"] += len(chunk)
+        if not write_points_to_influxdb(chunk, chunk_written):
+            return False, activity_selector
+    with progress_lock:
+        progress["chunks"] = chunk_count
+        complete = progress["written"] == chunk_count
+    if complete and on_success:
+        on_success(progress["points"])
+    return True, activity_selector
+
+def parse_in_pool(parse, *args):
+    # Returns the point chunks of parse(*args) run in ACTIVITY_PARSE_POOL, None if the pool broke (a worker crashed or was killed,
+    # e.g. out of memory) : the pool is replaced for the next activities and the caller parses this one in-process, with less memory
+    global ACTIVITY_PARSE_POOL
+    pool = ACTIVITY_PARSE_POOL
+    try:
+        return pool.submit(parse, *args).result()
+    except BrokenProcessPool as err:
+        with ACTIVITY_PARSE_POOL_LOCK:
+            if ACTIVITY_PARSE_POOL is pool: # another download thread may have replaced it already
+                logging.error(f"Activity parse pool : a worker process died ({err}) - starting a new pool, this activity is parsed in-process")
+                pool.shutdown(wait=False)
+                ACTIVITY_PARSE_POOL = start_activity_parse_pool()
+        return None
+
+def download_parse_activity(activityID, activity_type, marker=None): # Uses FIT file by default, falls back to TCX
+    # Fetches, parses and writes one activity chunk by chunk, returns False if it could not be fetched or written
+    # Parsing is CPU bound : it runs in ACTIVITY_PARSE_POOL when enabled so it neither holds the GIL nor blocks the downloads
+    # With FIT_STORE the file is parsed from the local store when it holds one, so deriving the points again needs no download
+    parser_args = (activityID, activity_type, GARMIN_DEVICENAME, INFLUXDB_DATABASE)
+    user_id = garmin_obj.user_id
+    indexed = ACTIVITY_INDEX.get(user_id, activityID) if ACTIVITY_INDEX else None
+    def content_unchanged(content_hash):
+        # Garmin changed the activity summary but the file is the same one : only the new marker is recorded
+        content_hash = content_hash and f"{ACTIVITY_SCHEMA_VERSION}:{content_hash}"
+        if not (indexed and content_hash and indexed[2] == content_hash):
+            return False
+        ACTIVITY_INDEX.put(user_id, activityID, marker, indexed[1], content_hash)
+        ACTIVITY_INDEX.record_skip()
+        logging.info(f"Unchanged : Activity ID {activityID} file is the same as the one already ingested - skipped")
+        return True
+    def index_activity(content_hash):
+        if not ACTIVITY_INDEX:
+            return None
+        return lambda point_count: ACTIVITY_INDEX.put(user_id, activityID, marker, point_count, content_hash and f"{ACTIVITY_SCHEMA_VERSION}:{content_hash}")
+    def write_fit_file(open_fit_file, content_hash):
+        # open_fit_file() opens the FIT file, straight out of the downloaded archive or from the stored data
+        with open_fit_file() as fit_file:
+            chunks = None
+            if ACTIVITY_PARSE_POOL:
+                fit_data = fit_file.read()
+                chunks = parse_in_pool(parse_fit_activity, fit_data, *parser_args, FAST_FIT_DECODER, ACTIVITY_CHUNK_POINTS)
+                fit_file = io.BytesIO(fit_data) # parsed in-process if the pool broke
+            if chunks is None:
+                chunks = iter_fit_activity(fit_file, *parser_args, FAST_FIT_DECODER, ACTIVITY_CHUNK_POINTS)
+            return write_activity_chunks(chunks, index_activity(content_hash))
+    def write_tcx_file(tcx_file_data, content_hash):
+        # tcx_file_data is the downloaded file (bytes) or the stored file object, only read whole for the parse pool
+        chunks = None
+        if ACTIVITY_PARSE_POOL:
+            if not isinstance(tcx_file_data, bytes):
+                tcx_file_data = tcx_file_data.read()
+            chunks = parse_in_pool(parse_tcx_activity, tcx_file_data, *parser_args, ACTIVITY_CHUNK_POINTS)
+        if chunks is None:
+            chunks = iter_tcx_activity(tcx_file_data, *parser_args, ACTIVITY_CHUNK_POINTS)
+        return write_activity_chunks(chunks, index_activity(content_hash))
+    def download_again(err):
+        # The stored file turned out to be corrupt while it was read : FIT_STORE dropped it, so it is downloaded and written again
+        logging.warning(f"Fallback : {err} - downloading Activity ID {activityID} again")
+        return download_parse_activity(activityID, activity_type, marker)
+    stored = FIT_STORE.get(activityID) if FIT_STORE else None # (kind, file object, content hash)
+    use_tcx = stored is not None and stored[0] == "tcx" # the FIT file of the activity could not be used when it was stored
+    if not use_tcx:
         try:
-            zip_data = garmin_obj.download_activity(activityID, dl_fmt=garmin_obj.ActivityDownloadFormat.ORIGINAL)
-            logging.info(f"Processing : Activity ID {activityID} FIT file data - this may take a while...")
-            zip_buffer = io.BytesIO(zip_data)
-            with zipfile.ZipFile(zip_buffer) as zip_ref:
-                fit_filename = next((f for f in zip_ref.namelist() if f.endswith('.fit')), None)
-                if not fit_filename:
-                    raise FileNotFoundError(f"No FIT file found in the downloaded zip archive for Activity ID {activityID}")
-                else:
-                    fit_data = zip_ref.read(fit_filename)
-                    fit_file_buffer = io.BytesIO(fit_data)
-                    fitfile = FitFile(fit_file_buffer)
-                    fitfile.parse()
-                    all_records_list = [record.get_values() for record in fitfile.get_messages('record')]
-                    all_sessions_list = [record.get_values() for record in fitfile.get_messages('session')]
-                    all_lengths_list = [record.get_values() for record in fitfile.get_messages('length')]
-                    all_laps_list = [record.get_values() for record in fitfile.get_messages('lap')]
-                    if len(all_records_list) == 0:
-                        raise FileNotFoundError(f"No records found in FIT file for Activity ID {activityID} - Discarding FIT file")
-                    else:
-                        activity_start_time = all_records_list[0]['timestamp'].replace(tzinfo=pytz.UTC)
-                    for parsed_record in all_records_list:
-                        if parsed_record.get('timestamp'):
-                            point = {
-                                "measurement": "ActivityGPS",
-                                "time": parsed_record['timestamp'].replace(tzinfo=pytz.UTC).isoformat(), 
-                                "tags": {
-                                    "Device": GARMIN_DEVICENAME,
-                                    "Database_Name": INFLUXDB_DATABASE,
-                                    "ActivityID": activityID,
-                                    "ActivitySelector": activity_start_time.strftime('%Y%m%dT%H%M%SUTC-') + activity_type
-                                },
-                                "fields": {
-                                    "ActivityName": activity_type,
-                                    "Activity_ID": activityID,
-                                    "Latitude": int(parsed_record['position_lat']) * ( 180 / 2**31 ) if parsed_record.get('position_lat') else None,
-                                    "Longitude": int(parsed_record['position_long']) * ( 180 / 2**31 ) if parsed_record.get('position_long') else None,
-                                    "Altitude": parsed_record.get('enhanced_altitude', None) or parsed_record.get('altitude', None),
-                                    "Distance": parsed_record.get('distance', None),
-                                    "DurationSeconds": (parsed_record['timestamp'].replace(tzinfo=pytz.UTC) - activity_start_time).total_seconds(),
-                                    "HeartRate": float(parsed_record.get('heart_rate', None)) if parsed_record.get('heart_rate', None) else None,
-                                    "Speed": parsed_record.get('enhanced_speed', None) or parsed_record.get('speed', None),
-                                    "GradeAdjustedSpeed": (parsed_record.get("unknown_140") / 1000.0) if parsed_record.get("unknown_140") else None,
-                                    "RunningEfficiency": ((parsed_record.get("unknown_140") / 1000.0)/parsed_record.get('heart_rate')) if (parsed_record.get("unknown_140") and parsed_record.get('heart_rate')) else None,
-                                    "Cadence": parsed_record.get('cadence', None),
-                                    "Fractional_Cadence": parsed_record.get('fractional_cadence', None),
-                                    "Temperature": parsed_record.get('temperature', None),
-                                    "Accumulated_Power": parsed_record.get('accumulated_power', None),
-                                    "Power": parsed_record.get('power', None)
-                                }
-                            }
-                            points_list.append(point)
-                    for session_record in all_sessions_list:
-                        if session_record.get('start_time') or session_record.get('timestamp'):
-                            point = {
-                                "measurement": "ActivitySession",
-                                "time": session_record['start_time'].replace(tzinfo=pytz.UTC).isoformat() or session_record['timestamp'].replace(tzinfo=pytz.UTC).isoformat(), 
-                                "tags": {
-                                    "Device": GARMIN_DEVICENAME,
-                                    "Database_Name": INFLUXDB_DATABASE,
-                                    "ActivityID": activityID,
-                                    "ActivitySelector": activity_start_time.strftime('%Y%m%dT%H%M%SUTC-') + activity_type
-                                },
-                                "fields": {
-                                    "Index": int(session_record.get('message_index', -1)) + 1,
-                                    "ActivityName": activity_type,
-                                    "Activity_ID": activityID,
-                                    "Sport": str(session_record.get('sport', None)), # Avoid partial write error 400 see #152#issuecomment-3084539416
-                                    "Sub_Sport": session_record.get('sub_sport', None),
-                                    "Pool_Length": session_record.get('pool_length', None),
-                                    "Pool_Length_Unit": session_record.get('pool_length_unit', None),
-                                    "Lengths": session_record.get('num_laps', None),
-                                    "Laps": session_record.get('num_lengths', None),
-                                    "Aerobic_Training": session_record.get('total_training_effect', None),
-                                    "Anaerobic_Training": session_record.get('total_anaerobic_training_effect', None),
-                                    "Primary_Benefit": session_record.get('primary_benefit', None),
-                                    "Recovery_Time": session_record.get('recovery_time', None)
-                                }
-                            }
-                            points_list.append(point)
-                    for length_record in all_lengths_list:
-                        if length_record.get('start_time') or length_record.get('timestamp'):
-                            point = {
-                                "measurement": "ActivityLength",
-                                "time": length_record['start_time'].replace(tzinfo=pytz.UTC).isoformat() or length_record['timestamp'].replace(tzinfo=pytz.UTC).isoformat(), 
-                                "tags": {
-                                    "Device": GARMIN_DEVICENAME,
-                                    "Database_Name": INFLUXDB_DATABASE,
-                                    "ActivityID": activityID,
-                                    "ActivitySelector": activity_start_time.strftime('%Y%m%dT%H%M%SUTC-') + activity_type
-                                },
-                                "fields": {
-                                    "Index": int(length_record.get('message_index', -1)) + 1,
-                                    "ActivityName": activity_type,
-                                    "Activity_ID": activityID,
-                                    "Elapsed_Time": length_record.get('total_elapsed_time', None),
-                                    "Strokes": length_record.get('total_strokes', None),
-                                    "Swim_Stroke": length_record.get('swim_stroke', None),
-                                    "Avg_Speed": length_record.get('avg_speed', None),
-                                    "Calories": length_record.get('total_calories', None),
-                                    "Avg_Cadence": length_record.get('avg_swimming_cadence', None)
-                                }
-                            }
-                            points_list.append(point)
-                    for lap_record in all_laps_list:
-                        if lap_record.get('start_time') or lap_record.get('timestamp'):
-                            point = {
-                                "measurement": "ActivityLap",
-                                "time": lap_record['start_time'].replace(tzinfo=pytz.UTC).isoformat() or lap_record['timestamp'].replace(tzinfo=pytz.UTC).isoformat(), 
-                                "tags": {
-                                    "Device": GARMIN_DEVICENAME,
-                                    "Database_Name": INFLUXDB_DATABASE,
-                                    "ActivityID": activityID,
-                                    "ActivitySelector": activity_start_time.strftime('%Y%m%dT%H%M%SUTC-') + activity_type
-                                },
-                                "fields": {
-                                    "Index": int(lap_record.get('message_index', -1)) + 1,
-                                    "ActivityName": activity_type,
-                                    "Activity_ID": activityID,
-                                    "Elapsed_Time": lap_record.get('total_elapsed_time', None),
-                                    "Sport": lap_record.get('sport', None),
-                                    "Lengths": lap_record.get('num_lengths', None),
-                                    "Length_Index": lap_record.get('first_length_index', None),
-                                    "Distance": lap_record.get('total_distance', None),
-                                    "Cycles": lap_record.get('total_cycles', None),
-                                    "Avg_Stroke_Distance": lap_record.get('avg_stroke_distance', None),
-                                    "Moving_Duration": lap_record.get('total_moving_time', None),
-                                    "Standing_Duration": lap_record.get('time_standing', None),
-                                    "Avg_Speed": lap_record.get('enhanced_avg_speed', None),
-                                    "Max_Speed": lap_record.get('enhanced_max_speed', None),
-                                    "Calories": lap_record.get('total_calories', None),
-                                    "Avg_Power": lap_record.get('avg_power', None),
-                                    "Avg_HR": lap_record.get('avg_heart_rate', None),
-                                    "Max_HR": lap_record.get('max_heart_rate', None),
-                                    "Avg_Cadence": lap_record.get('avg_cadence', None),
-                                    "Avg_Temperature": lap_record.get('avg_temperature', None)
-                                }
-                            }
-                            points_list.append(point)
-                    if KEEP_FIT_FILES:
+            if stored:
+                logging.info(f"Processing : Activity ID {activityID} FIT file data from the local store")
+                if content_unchanged(stored[2]):
+                    stored[1].close()
+                    return True
+                written, activity_selector = write_fit_file(lambda: stored[1], stored[2]) # decompressed while it is parsed
+            else:
+                zip_data = garmin_obj.download_activity(activityID, dl_fmt=garmin_obj.ActivityDownloadFormat.ORIGINAL)
+                logging.info(f"Processing : Activity ID {activityID} FIT file data - this may take a while...")
+                with zipfile.ZipFile(io.BytesIO(zip_data)) as zip_ref:
+                    fit_member = fit_file_member(zip_ref, activityID)
+                    content_hash = None
+                    if FIT_STORE or ACTIVITY_INDEX:
+                        with zip_ref.open(fit_member) as fit_file: # read block by block, the uncompressed FIT file is never held whole
+                            content_hash = FIT_STORE.put(activityID, "fit", fit_file) if FIT_STORE else file_digest(fit_file)
+                    if content_unchanged(content_hash):
+                        return True
+                    written, activity_selector = write_fit_file(lambda: zip_ref.open(fit_member), content_hash) # parsed straight out of the archive
+                    if KEEP_FIT_FILES and activity_selector:
                         os.makedirs(FIT_FILE_STORAGE_LOCATION, exist_ok=True)
-                        fit_path = os.path.join(FIT_FILE_STORAGE_LOCATION, activity_start_time.strftime('%Y%m%dT%H%M%SUTC-') + activity_type + ".fit")
-                        with open(fit_path, "wb") as f:
-                            f.write(fit_data)
+                        fit_path = os.path.join(FIT_FILE_STORAGE_LOCATION, activity_selector + ".fit")
+                        with zip_ref.open(fit_member) as fit_file, open(fit_path, "wb") as f:
+                            shutil.copyfileobj(fit_file, f)
                         logging.info(f"Success : Activity ID {activityID} stored in output file {fit_path}")
+        except StoredFileError as err:
+            return download_again(err)
         except (FileNotFoundError, FitParseError) as err:
             logging.error(err)
             logging.warning(f"Fallback : Failed to use FIT file for activityID {activityID} - Trying TCX file...")
-            
-            ns = {"tcx": "http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2", "ns3": "http://www.garmin.com/xmlschemas/ActivityExtension/v2"}
-            try:
-                tcx_file_data = garmin_obj.download_activity(activityID, dl_fmt=garmin_obj.ActivityDownloadFormat.TCX).decode("UTF-8")
-                root = ET.fromstring(tcx_file_data)
-                if KEEP_FIT_FILES:
+            use_tcx = True
+            stored = None
+    if use_tcx:
+        try:
+            if stored:
+                logging.info(f"Processing : Activity ID {activityID} TCX file data from the local store")
+                with stored[1] as tcx_file:
+                    if content_unchanged(stored[2]):
+                        return True
+                    written, activity_selector = write_tcx_file(tcx_file, stored[2])
+            else:
+                tcx_file_data = garmin_obj.download_activity(activityID, dl_fmt=garmin_obj.ActivityDownloadFormat.TCX)
+                if FIT_STORE:
+                    content_hash = FIT_STORE.put(activityID, "tcx", tcx_file_data)
+                else:
+                    content_hash = hashlib.sha256(tcx_file_data).hexdigest() if ACTIVITY_INDEX else None
+                if content_unchanged(content_hash):
+                    return True
+                written, activity_selector = write_tcx_file(tcx_file_data, content_hash)
+                if KEEP_FIT_FILES and activity_selector:
                     os.makedirs(FIT_FILE_STORAGE_LOCATION, exist_ok=True)
-                    activity_start_time = datetime.fromisoformat(root.findall("tcx:Activities/tcx:Activity", ns)[0].find("tcx:Id", ns).text.strip("Z"))
-                    tcx_path = os.path.join(FIT_FILE_STORAGE_LOCATION, activity_start_time.strftime('%Y%m%dT%H%M%SUTC-') + activity_type + ".tcx")
-                    with open(tcx_path, "w") as f:
+                    tcx_path = os.path.join(FIT_FILE_STORAGE_LOCATION, activity_selector + ".tcx")
+                    with open(tcx_path, "wb") as f:
                         f.write(tcx_file_data)
                     logging.info(f"Success : Activity ID {activityID} stored in output file {tcx_path}")
-            except requests.exceptions.Timeout as err:
-                logging.warning(f"Request timeout for fetching large activity record {activityID} - skipping record")
-                return []
-            except Exception as err:
-                logging.exception(f"Unable to fetch TCX for activity record {activityID} : skipping record")
-                return []
-
-            for activity in root.findall("tcx:Activities/tcx:Activity", ns):
-                activity_start_time = datetime.fromisoformat(activity.find("tcx:Id", ns).text.strip("Z"))
-                lap_index = 1
-                for lap in activity.findall("tcx:Lap", ns):
-                    lap_start_time = datetime.fromisoformat(lap.attrib.get("StartTime").strip("Z"))
-                    for tp in lap.findall(".//tcx:Trackpoint", ns):
-                        time_obj = datetime.fromisoformat(tp.findtext("tcx:Time", default=None, namespaces=ns).strip("Z"))
-                        lat = tp.findtext("tcx:Position/tcx:LatitudeDegrees", default=None, namespaces=ns)
-                        lon = tp.findtext("tcx:Position/tcx:LongitudeDegrees", default=None, namespaces=ns)
-                        alt = tp.findtext("tcx:AltitudeMeters", default=None, namespaces=ns)
-                        dist = tp.findtext("tcx:DistanceMeters", default=None, namespaces=ns)
-                        hr = tp.findtext("tcx:HeartRateBpm/tcx:Value", default=None, namespaces=ns)
-                        speed = tp.findtext("tcx:Extensions/ns3:TPX/ns3:Speed", default=None, namespaces=ns)
-
-                        try: lat = float(lat)
-                        except: lat = None
-                        try: lon = float(lon)
-                        except: lon = None
-                        try: alt = float(alt)
-                        except: alt = None
-                        try: dist = float(dist)
-                        except: dist = None
-                        try: hr = float(hr)
-                        except: hr = None
-                        try: speed = float(speed)
-                        except: speed = None
-
-                        point = {
-                            "measurement": "ActivityGPS",
-                            "time": time_obj.isoformat(), 
-                            "tags": {
-                                "Device": GARMIN_DEVICENAME,
-                                "Database_Name": INFLUXDB_DATABASE,
-                                "ActivityID": activityID,
-                                "ActivitySelector": activity_start_time.strftime('%Y%m%dT%H%M%SUTC-') + activity_type
-                            },
-                            "fields": {
-                                "ActivityName": activity_type,
-                                "Activity_ID": activityID,
-                                "Latitude": lat,
-                                "Longitude": lon,
-                                "Altitude": alt,
-                                "Distance": dist,
-                                "DurationSeconds": (time_obj - activity_start_time).total_seconds(),
-                                "HeartRate": hr,
-                                "Speed": speed,
-                                "lap": lap_index
-                            }
-                        }
-                        points_list.append(point)
-                    
-                    lap_index += 1
+        except StoredFileError as err:
+            return download_again(err)
+        except requests.exceptions.Timeout as err:
+            logging.warning(f"Request timeout for fetching large activity record {activityID} - skipping record")
+            return False
+        except Exception as err:
+            logging.exception(f"Unable to fetch TCX for activity record {activityID} : skipping record")
+            return False
+    if written:
         logging.info(f"Success : Fetching detailed activity for Activity ID {activityID}")
-        PARSED_ACTIVITY_ID_LIST.append(activityID)
-    return points_list
+    return written
+
+def fetch_activity_GPS(activityIDdict, activity_markers=None):
+    # Activities are written chunk by chunk while they are parsed, so nothing is returned
+    # With ACTIVITY_DOWNLOAD_CONCURRENCY > 1 they are downloaded side by side (within the rate budget of garmin_obj)
+    # activity_markers {activity id: summary digest} lets ACTIVITY_INDEX skip the activities Garmin did not change since they were ingested
+    activity_markers = activity_markers or {}
+    user_id = garmin_obj.user_id
+    pending_activities = {}
+    for activityID, activity_type in activityIDdict.items():
+        if (activityID in PARSED_ACTIVITY_IDS) and (not FORCE_REPROCESS_ACTIVITIES):
+            logging.info(f"Skipping : Activity ID {activityID} has already been processed within current runtime")
+            continue
+        marker = activity_markers.get(activityID)
+        indexed = ACTIVITY_INDEX.get(user_id, activityID) if ACTIVITY_INDEX and marker else None
+        if indexed and indexed[0] == marker:
+            ACTIVITY_INDEX.record_skip()
+            logging.info(f"Unchanged : Activity ID {activityID} did not change on Garmin since it was ingested ({indexed[1]} points) - skipped")
+            continue
+        if (activityID in PARSED_ACTIVITY_IDS) and (FORCE_REPROCESS_ACTIVITIES):
+            logging.info(f"Re-processing : Activity ID {activityID} (FORCE_REPROCESS_ACTIVITIES is on)")
+        if ACTIVITY_DOWNLOAD_EXECUTOR:
+            pending_activities[ACTIVITY_DOWNLOAD_EXECUTOR.submit(download_parse_activity, activityID, activity_type, marker)] = activityID
+        elif download_parse_activity(activityID, activity_type, marker):
+            PARSED_ACTIVITY_IDS.add(activityID)
+    for future in as_completed(pending_activities):
+        if future.result():
+            PARSED_ACTIVITY_IDS.add(pending_activities[future])
+    return []
 
 def get_lactate_threshold(date_str):
     points_list = []
@@ -1192,9 +1582,133 @@ def get_solar_intensity(date_str):
         logging.warning(f"No Solar Intensity data available for date {date_str}")
     return points_list
 
+def get_activity_data(date_str):
+    activity_summary_points_list, activity_with_gps_id_dict, activity_markers = get_activity_summary(date_str)
+    write_points_to_influxdb(activity_summary_points_list)
+    return fetch_activity_GPS(activity_with_gps_id_dict, activity_markers)
+
+# %%
+# Fetch selection keys mapped to their getters, in the order they are fetched for each day
+DAILY_FETCH_METRICS = {
+    'daily_avg': get_daily_stats,
+    'sleep': get_sleep_data,
+    'steps': get_intraday_steps,
+    'heartrate': get_intraday_hr,
+    'stress': get_intraday_stress,
+    'breathing': get_intraday_br,
+    'hrv': get_intraday_hrv,
+    'fitness_age': get_fitness_age,
+    'vo2': get_vo2_max,
+    'race_prediction': get_race_predictions,
+    'body_composition': get_body_composition,
+    'lactate_threshold': get_lactate_threshold,
+    'training_status': get_training_status,
+    'training_readiness': get_training_readiness,
+    'hill_score': get_hillscore,
+    'endurance_score': get_endurance_score,
+    'blood_pressure': get_blood_pressure,
+    'hydration': get_hydration,
+    'activity': get_activity_data,
+    'solar_intensity': get_solar_intensity,
+}
+
+def selected_fetch_metrics():
+    return [metric for metric in DAILY_FETCH_METRICS if metric in FETCH_SELECTION]
+
+FETCH_EXECUTOR = ThreadPoolExecutor(max_workers=FETCH_CONCURRENCY, thread_name_prefix="garmin-fetch") if FETCH_CONCURRENCY > 1 else None
+ACTIVITY_DOWNLOAD_EXECUTOR = ThreadPoolExecutor(max_workers=ACTIVITY_DOWNLOAD_CONCURRENCY, thread_name_prefix="activity-download") if ACTIVITY_DOWNLOAD_CONCURRENCY > 1 else None
+
+# %%
+PAYLOAD_FINGERPRINTS = FingerprintStore(os.path.join(FETCHER_STATE_DIR, "payload_fingerprints.sqlite")) if SKIP_UNCHANGED_WRITES else None
+
+def payload_digest(payloads):
+    digest = hashlib.sha256()
+    for request, result in payloads:
+        digest.update(json.dumps([request, result], sort_keys=True, default=str).encode("utf-8"))
+    return digest.hexdigest()
+
+# Intraday getters which can emit only the points at or after a per-measurement watermark (epoch ms)
+INTRADAY_DELTA_METRICS = {
+    'heartrate': ['HeartRateIntraday'],
+    'steps': ['StepsIntraday'],
+    'stress': ['StressIntraday', 'BodyBatteryIntraday'],
+    'breathing': ['BreathingRateIntraday'],
+}
+INTRADAY_WATERMARKS = {} # (user_id, date) -> {measurement: epoch ms of the latest written point}
+INTRADAY_WATERMARKS_LOCK = threading.Lock()
+
+def intraday_watermarks(user_id, date_str):
+    with INTRADAY_WATERMARKS_LOCK:
+        watermarks = INTRADAY_WATERMARKS.get((user_id, date_str))
+    if watermarks is None and SYNC_STATE: # first poll after a restart
+        watermarks = {measurement: time_ms for measurement, (time_ms, watermark_date) in SYNC_STATE.watermarks(user_id).items() if watermark_date == date_str}
+    return dict(watermarks or {})
+
+def advance_intraday_watermarks(user_id, date_str, points):
+    latest = latest_point_times(points)
+    if SYNC_STATE:
+        SYNC_STATE.advance(user_id, latest, date_str)
+    with INTRADAY_WATERMARKS_LOCK:
+        watermarks = INTRADAY_WATERMARKS.setdefault((user_id, date_str), {})
+        for measurement, point_ms in latest.items():
+            watermarks[measurement] = max(watermarks.get(measurement, point_ms), point_ms)
+
+def fetch_metric(metric, date_str, incremental=False):
+    # Returns (points, on_success) for the metric - points is None if its Garmin payloads are the same as the ones last written.
+    # incremental is set by the update loop : unchanged metrics are skipped and intraday metrics only return their new points
+    user_id = garmin_obj.user_id
+    getter = DAILY_FETCH_METRICS[metric]
+    on_success_steps = []
+    if INTRADAY_DELTA_MODE and metric in INTRADAY_DELTA_METRICS:
+        if incremental:
+            watermarks = intraday_watermarks(user_id, date_str)
+            getter = lambda date_str: DAILY_FETCH_METRICS[metric](date_str, watermarks=watermarks)
+        on_success_steps.append(lambda points: advance_intraday_watermarks(user_id, date_str, points))
+    if PAYLOAD_FINGERPRINTS:
+        fingerprint = PAYLOAD_FINGERPRINTS.get(user_id, date_str, metric) if incremental else None
+        if fingerprint:
+            digest, recorded_requests, point_count = fingerprint
+            # Served by the date's memo, so the getter reuses these payloads if they did change
+            payloads = [([name, args, kwargs], getattr(garmin_obj, name)(*args, **kwargs)) for name, args, kwargs in recorded_requests]
+            if payload_digest(payloads) == digest:
+                PAYLOAD_FINGERPRINTS.record_skip(point_count)
+                logging.info(f"Unchanged : Garmin payloads for {metric} on date {date_str} did not change since the last write - skipped")
+                return None, None
+        PAYLOAD_RECORDER.payloads = []
+        try:
+            points = getter(date_str)
+            payloads = PAYLOAD_RECORDER.payloads
+        finally:
+            PAYLOAD_RECORDER.payloads = None
+        if payloads: # nothing to compare next time otherwise
+            digest, recorded_requests = payload_digest(payloads), [request for request, result in payloads]
+            on_success_steps.append(lambda points: PAYLOAD_FINGERPRINTS.put(user_id, date_str, metric, digest, recorded_requests, points_count(points)))
+    else:
+        points = getter(date_str)
+    if not on_success_steps:
+        return points, None
+    def on_success():
+        for step in on_success_steps:
+            step(points)
+    return points, on_success
+
+def fetch_write_metric(metric, date_str, incremental=False, on_written=None, on_failure=None):
+    # Returns False if the points could not be written. on_written / on_failure are called once the write succeeded / failed, with ASYNC_WRITES after the return
+    points, on_success = fetch_metric(metric, date_str, incremental)
+    if points is None:
+        if on_written:
+            on_written()
+        return True
+    def on_stored():
+        if on_success:
+            on_success()
+        if on_written:
+            on_written()
+    return write_points_to_influxdb(points, on_stored, on_failure)
 
 # %%
-def daily_fetch_write(date_str):
+def request_intraday_data_refresh(date_str):
+    # Returns False if Garmin has no data at all to refresh for the date
     if REQUEST_INTRADAY_DATA_REFRESH and (datetime.strptime(date_str, "%Y-%m-%d") <= (datetime.today() - timedelta(days=IGNORE_INTRADAY_DATA_REFRESH_DAYS))):
         data_refresh_response = garmin_obj.connectapi(f"wellness-service/wellness/epoch/request/{date_str}", method="POST").get("status", "Unknown")
         logging.info(f"Intraday data refresh request status: {data_refresh_response}")
@@ -1205,7 +1719,7 @@ def daily_fetch_write(date_str):
             logging.info(f"Data for date {date_str} is already available")
         elif data_refresh_response == "NO_FILES_FOUND":
             logging.info(f"No Data is available for date {date_str} to refresh")
-            return None
+            return False
         elif data_refresh_response == "DENIED":
             logging.info(f"Daily refresh limit reached. Pausing script for 24 hours to ensure Intraday data fetching. Disable REQUEST_INTRADAY_DATA_REFRESH to avoid this!")
             time.sleep(86500)
@@ -1216,109 +1730,246 @@ def daily_fetch_write(date_str):
         else:
             logging.info(f"Refresh response is unknown!")
             time.sleep(5)
-    if 'daily_avg' in FETCH_SELECTION:
-        write_points_to_influxdb(get_daily_stats(date_str))
-    if 'sleep' in FETCH_SELECTION:
-        write_points_to_influxdb(get_sleep_data(date_str))
-    if 'steps' in FETCH_SELECTION:
-        write_points_to_influxdb(get_intraday_steps(date_str))
-    if 'heartrate' in FETCH_SELECTION:
-        write_points_to_influxdb(get_intraday_hr(date_str))
-    if 'stress' in FETCH_SELECTION:
-        write_points_to_influxdb(get_intraday_stress(date_str))
-    if 'breathing' in FETCH_SELECTION:
-        write_points_to_influxdb(get_intraday_br(date_str))
-    if 'hrv' in FETCH_SELECTION:
-        write_points_to_influxdb(get_intraday_hrv(date_str))
-    if 'fitness_age' in FETCH_SELECTION:
-        write_points_to_influxdb(get_fitness_age(date_str))
-    if 'vo2' in FETCH_SELECTION:
-        write_points_to_influxdb(get_vo2_max(date_str))
-    if 'race_prediction' in FETCH_SELECTION:
-        write_points_to_influxdb(get_race_predictions(date_str))
-    if 'body_composition' in FETCH_SELECTION:
-        write_points_to_influxdb(get_body_composition(date_str))
-    if 'lactate_threshold' in FETCH_SELECTION:
-        write_points_to_influxdb(get_lactate_threshold(date_str))
-    if 'training_status' in FETCH_SELECTION:
-        write_points_to_influxdb(get_training_status(date_str))
-    if 'training_readiness' in FETCH_SELECTION:
-        write_points_to_influxdb(get_training_readiness(date_str))
-    if 'hill_score' in FETCH_SELECTION:
-        write_points_to_influxdb(get_hillscore(date_str))
-    if 'endurance_score' in FETCH_SELECTION:
-        write_points_to_influxdb(get_endurance_score(date_str))
-    if 'blood_pressure' in FETCH_SELECTION:
-        write_points_to_influxdb(get_blood_pressure(date_str))
-    if 'hydration' in FETCH_SELECTION:
-        write_points_to_influxdb(get_hydration(date_str))
-    if 'activity' in FETCH_SELECTION:
-        activity_summary_points_list, activity_with_gps_id_dict = get_activity_summary(date_str)
-        write_points_to_influxdb(activity_summary_points_list)
-        write_points_to_influxdb(fetch_activity_GPS(activity_with_gps_id_dict))
-    if 'solar_intensity' in FETCH_SELECTION:
-        write_points_to_influxdb(get_solar_intensity(date_str))
+    return True
 
+# %%
+def daily_fetch_write(date_str, incremental=False, metrics=None):
+    # Returns the set of metrics written for the date, metrics defaults to all selected ones
+    selected_metrics = selected_fetch_metrics() if metrics is None else metrics
+    if not request_intraday_data_refresh(date_str):
+        return set(selected_metrics)
+    written_metrics = set()
+    skipped_writes_before = PAYLOAD_FINGERPRINTS.skipped_writes if PAYLOAD_FINGERPRINTS else 0
+    with date_request_context(date_str):
+        if FETCH_EXECUTOR:
+            written_metrics = concurrent_fetch_write(date_str, selected_metrics, incremental)
+        else:
+            for metric in selected_metrics:
+                if fetch_write_metric(metric, date_str, incremental):
+                    written_metrics.add(metric)
+    if incremental and PAYLOAD_FINGERPRINTS:
+        logging.info(f"Unchanged : skipped {PAYLOAD_FINGERPRINTS.skipped_writes - skipped_writes_before} of {len(selected_metrics)} metric writes for date {date_str} - {PAYLOAD_FINGERPRINTS.skipped_writes} writes ({PAYLOAD_FINGERPRINTS.skipped_points} points) avoided so far")
+    return written_metrics
 
 # %%
-def fetch_write_bulk(start_date_str, end_date_str):
+def concurrent_fetch_write(date_str, selected_metrics, incremental=False):
+    # Each metric runs in its own worker - failures are handled per metric, the day is only retried for rate limit or login errors
+    retry_error = None
+    written_metrics = set()
+    futures = {FETCH_EXECUTOR.submit(fetch_metric, metric, date_str, incremental): metric for metric in selected_metrics}
+    for future in as_completed(futures):
+        metric = futures[future]
+        try:
+            points, on_success = future.result()
+            if points is None or write_points_to_influxdb(points, on_success):
+                written_metrics.add(metric)
+        except (GarminConnectTooManyRequestsError, GarminConnectAuthenticationError) as err:
+            logging.error(err)
+            logging.info(f"Failed to fetch {metric} for date {date_str} - the date will be retried")
+            retry_error = retry_error or err
+        except (
+                GarminConnectConnectionError,
+                requests.exceptions.HTTPError,
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+                GarthHTTPError
+                ) as err:
+            logging.error(err)
+            logging.info(f"Connection Error : Failed to fetch {metric} - skipping it for date {date_str}")
+        except Exception:
+            logging.exception(f"Unexpected error while fetching {metric} for date {date_str} - skipping it")
+    if retry_error:
+        raise retry_error
+    return written_metrics
+
+
+# %%
+def fetch_write_day(current_date, incremental=False, metrics=None):
+    # Fetches and writes the metrics (default all selected) of one date, returns (done, seconds to wait before the next call, metrics written)
+    # done is False if the date has to be retried
     global garmin_obj
+    try:
+        network_calls_before = garmin_obj.network_calls
+        written_metrics = daily_fetch_write(current_date, incremental, metrics)
+        logging.info(f"Success : Fetched all available health metrics for date {current_date} (skipped any if unavailable)")
+        if garmin_obj.network_calls == network_calls_before:
+            logging.info(f"Skipped waiting : all metrics for date {current_date} were served from the response cache")
+            return True, 0, written_metrics
+        if garmin_obj.rate_limiter:
+            log_rate_budget()
+            return True, 0, written_metrics
+        return True, RATE_LIMIT_CALLS_SECONDS, written_metrics
+    except GarminConnectTooManyRequestsError as err:
+        logging.error(err)
+        logging.info(f"Too many requests (429) : Failed to fetch one or more metrics - will retry for date {current_date}")
+        if garmin_obj.rate_limiter:
+            log_rate_budget() # the limiter holds every call until its cooldown is over
+            return False, 0, set()
+        return False, FETCH_FAILED_WAIT_SECONDS, set()
+    except (
+            GarminConnectConnectionError,
+            requests.exceptions.HTTPError,
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+            GarthHTTPError
+            ) as err:
+        logging.error(err)
+        logging.info(f"Connection Error : Failed to fetch one or more metrics - skipping date {current_date}")
+        return True, RATE_LIMIT_CALLS_SECONDS, set()
+    except GarminConnectAuthenticationError as err:
+        logging.error(err)
+        logging.info(f"Authentication Failed : Retrying login with given credentials (won't work automatically for MFA/2FA enabled accounts)")
+        garmin_obj = relogin()
+        return False, 5, set()
+
+# %%
+def fetch_write_bulk(start_date_str, end_date_str):
     logging.info("Fetching data for the given period in reverse chronological order")
     time.sleep(3)
     write_points_to_influxdb(get_last_sync())
     for current_date in iter_days(start_date_str, end_date_str):
-        repeat_loop = True
-        while repeat_loop:
-            try:
-                daily_fetch_write(current_date)
-                logging.info(f"Success : Fetched all available health metrics for date {current_date} (skipped any if unavailable)")
-                logging.info(f"Waiting : for {RATE_LIMIT_CALLS_SECONDS} seconds")
+        done = False
+        while not done:
+            done, wait_seconds, _ = fetch_write_day(current_date)
+            if wait_seconds:
+                logging.info(f"Waiting : for {wait_seconds} seconds")
+                time.sleep(wait_seconds)
+    if RESPONSE_CACHE:
+        logging.info(f"Response cache : {RESPONSE_CACHE.hits} hits and {RESPONSE_CACHE.misses} misses so far")
+    if WRITE_PIPELINE:
+        WRITE_PIPELINE.flush()
+        logging.info(f"Write pipeline : {WRITE_PIPELINE.written_batches} batches written, {WRITE_PIPELINE.failed_batches} failed so far")
+    if FIT_STORE:
+        logging.info(f"FIT store : {FIT_STORE.hits} activity files read from the store and {FIT_STORE.misses} downloaded so far")
+    if ACTIVITY_INDEX:
+        logging.info(f"Activity index : {ACTIVITY_INDEX.skipped_activities} unchanged activities skipped so far")
+
+
+# %%
+def queued_task_callbacks(queue, date_str, metric):
+    # (on_written, on_failure) finishing the backfill queue task of the metric once its write succeeded or failed
+    def on_written():
+        if queue.complete(date_str, metric):
+            logging.info(f"Success : Fetched {metric} for date {date_str}")
+        else:
+            logging.warning(f"Backfill queue : the lease on {metric} for date {date_str} expired and was taken by another worker - it is left to that worker")
+    def on_failure():
+        logging.info(f"Write failed : {metric} for date {date_str} was not written to InfluxDB - it will be retried later")
+        queue.fail(date_str, metric, "InfluxDB write failed", delay_seconds=RATE_LIMIT_CALLS_SECONDS)
+    return on_written, on_failure
+
+def fetch_write_bulk_queued(start_date_str, end_date_str):
+    # Same as fetch_write_bulk, but every (date, metric) pair is a task of the persistent backfill queue
+    global garmin_obj
+    shard_index, shard_count = (int(part) for part in BACKFILL_QUEUE_SHARD.split("/"))
+    queue_path = BACKFILL_QUEUE_PATH if garmin_obj.token_dir == TOKEN_DIR else f"{os.path.splitext(BACKFILL_QUEUE_PATH)[0]}-{garmin_obj.user_id}.sqlite" # one queue per account
+    queue = BackfillQueue(queue_path, WORKER_ID, lease_seconds=BACKFILL_QUEUE_LEASE_SECONDS, shard_index=shard_index, shard_count=shard_count, max_attempts=BACKFILL_QUEUE_MAX_ATTEMPTS)
+    write_points_to_influxdb(get_last_sync())
+    new_tasks = queue.enqueue(list(iter_days(start_date_str, end_date_str)), selected_fetch_metrics())
+    logging.info(f"Backfill queue : {new_tasks} new tasks added for {start_date_str} to {end_date_str} - task counts {queue.counts()} - working on shard {shard_index}/{shard_count} as {WORKER_ID}")
+    refreshed_dates = {}
+    last_date = None
+    date_context = ExitStack()
+    while True:
+        task = queue.lease()
+        if task is None:
+            if WRITE_PIPELINE:
+                WRITE_PIPELINE.flush() # finishes the tasks waiting for their writes
+            if queue.outstanding() == 0:
+                break
+            logging.info("Backfill queue : remaining tasks are leased by other workers or waiting for a retry - checking again in 30 seconds")
+            time.sleep(30)
+            continue
+        current_date, metric = task
+        if current_date != last_date:
+            date_context.close() # tasks of the same date share their Garmin responses
+            date_context.enter_context(date_request_context(current_date))
+            if last_date and not garmin_obj.rate_limiter:
                 time.sleep(RATE_LIMIT_CALLS_SECONDS)
-                repeat_loop = False
-            except GarminConnectTooManyRequestsError as err:
-                logging.error(err)
-                logging.info(f"Too many requests (429) : Failed to fetch one or more metrics - will retry for date {current_date}")
+        last_date = current_date
+        try:
+            if current_date not in refreshed_dates:
+                refreshed_dates[current_date] = request_intraday_data_refresh(current_date)
+            # The task is only finished once its points are stored : with ASYNC_WRITES that is on the writer thread, the lease is renewed until then
+            on_written, on_failure = queued_task_callbacks(queue, current_date, metric)
+            if refreshed_dates[current_date]:
+                fetch_write_metric(metric, current_date, on_written=on_written, on_failure=on_failure)
+            else:
+                on_written()
+        except GarminConnectTooManyRequestsError as err:
+            logging.error(err)
+            logging.info(f"Too many requests (429) : Failed to fetch {metric} - will retry for date {current_date}")
+            queue.release(current_date, metric)
+            if garmin_obj.rate_limiter:
+                log_rate_budget()
+            else:
                 logging.info(f"Waiting : for {FETCH_FAILED_WAIT_SECONDS} seconds")
                 time.sleep(FETCH_FAILED_WAIT_SECONDS)
-                repeat_loop = True
-            except (
-                    GarminConnectConnectionError,
-                    requests.exceptions.HTTPError,
-                    requests.exceptions.ConnectionError,
-                    requests.exceptions.Timeout,
-                    GarthHTTPError
-                    ) as err:
-                logging.error(err)
-                logging.info(f"Connection Error : Failed to fetch one or more metrics - skipping date {current_date}")
-                logging.info(f"Waiting : for {RATE_LIMIT_CALLS_SECONDS} seconds")
-                time.sleep(RATE_LIMIT_CALLS_SECONDS)
-                repeat_loop = False
-            except GarminConnectAuthenticationError as err:
-                logging.error(err)
-                logging.info(f"Authentication Failed : Retrying login with given credentials (won't work automatically for MFA/2FA enabled accounts)")
-                garmin_obj = garmin_login()
-                time.sleep(5)
-                repeat_loop = True
+        except (
+                GarminConnectConnectionError,
+                requests.exceptions.HTTPError,
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+                GarthHTTPError
+                ) as err:
+            logging.error(err)
+            logging.info(f"Connection Error : Failed to fetch {metric} for date {current_date} - it will be retried later")
+            queue.fail(current_date, metric, err, delay_seconds=RATE_LIMIT_CALLS_SECONDS)
+        except GarminConnectAuthenticationError as err:
+            logging.error(err)
+            logging.info(f"Authentication Failed : Retrying login with given credentials (won't work automatically for MFA/2FA enabled accounts)")
+            queue.release(current_date, metric)
+            garmin_obj = relogin()
+            time.sleep(5)
+        except Exception as err:
+            logging.exception(f"Unexpected error while fetching {metric} for date {current_date}")
+            queue.fail(current_date, metric, err, delay_seconds=RATE_LIMIT_CALLS_SECONDS)
+    date_context.close()
+    queue.close()
+    logging.info(f"Backfill queue : no tasks left for this worker - task counts {queue.counts()}")
 
 
 # %%
-garmin_obj = garmin_login()
+class GarminAccount:
+    """Polling and backfill state of one Garmin Connect account served by this process"""
+    def __init__(self, garmin):
+        self.garmin_obj = garmin
+        self.device_name = GARMIN_DEVICENAME
+        self.device_id = GARMIN_DEVICEID
+        self.last_influxdb_sync_time_UTC = None
+        self.local_timediff = timedelta(0)
+        self.pending_dates = deque()
+        self.pending_sync_time_UTC = None
+        self.metric_synced_until = {} # metric -> UTC watch sync time up to which it was written
+        self.failed_metrics = set() # metrics which failed on a date of the pending update
+        self.next_poll_time = 0
+        self.not_before = 0
+
+@contextmanager
+def active_account(account):
+    # The getters work on module globals - swap in the account's client and device while working on it
+    global garmin_obj, GARMIN_DEVICENAME, GARMIN_DEVICEID
+    garmin_obj, GARMIN_DEVICENAME, GARMIN_DEVICEID = account.garmin_obj, account.device_name, account.device_id
+    try:
+        yield account
+    finally:
+        account.garmin_obj, account.device_name, account.device_id = garmin_obj, GARMIN_DEVICENAME, GARMIN_DEVICEID
 
 # %%
-if MANUAL_START_DATE:
-    fetch_write_bulk(MANUAL_START_DATE, MANUAL_END_DATE)
-    logging.info(f"Bulk update success : Fetched all available health metrics for date range {MANUAL_START_DATE} to {MANUAL_END_DATE}")
-    exit(0)
-else:
+def get_last_influxdb_sync_time():
+    user_id = garmin_obj.user_id.replace("'", "\\'")
+    user_filter = f"WHERE \"User_ID\" = '{user_id}' " if TAG_MEASUREMENTS_WITH_USER_EMAIL else ""
     try:
         if INFLUXDB_VERSION == "1":
-            last_influxdb_sync_time_UTC = pytz.utc.localize(datetime.strptime(list(influxdbclient.query(f"SELECT * FROM HeartRateIntraday ORDER BY time DESC LIMIT 1").get_points())[0]['time'],"%Y-%m-%dT%H:%M:%SZ"))
+            return pytz.utc.localize(datetime.strptime(list(influxdbclient.query(f"SELECT * FROM HeartRateIntraday {user_filter}ORDER BY time DESC LIMIT 1").get_points())[0]['time'],"%Y-%m-%dT%H:%M:%SZ"))
         else:
-            last_influxdb_sync_time_UTC = pytz.utc.localize(influxdbclient.query(query="SELECT * FROM HeartRateIntraday ORDER BY time DESC LIMIT 1", language="influxql").to_pylist()[0]['time'])
+            return pytz.utc.localize(influxdbclient.query(query=f"SELECT * FROM HeartRateIntraday {user_filter}ORDER BY time DESC LIMIT 1", language="influxql").to_pylist()[0]['time'])
     except Exception as err:
         logging.error(err)
         logging.warning("No previously synced data found in local InfluxDB database, defaulting to 7 day initial fetching. Use specific start date ENV variable to bulk update past data")
-        last_influxdb_sync_time_UTC = (datetime.today() - timedelta(days=7)).astimezone(pytz.timezone("UTC"))
+        return (datetime.today() - timedelta(days=7)).astimezone(pytz.timezone("UTC"))
+
+def get_local_timediff():
     try:
         if USER_TIMEZONE: # If provided by user, using that. 
             local_timediff = datetime.now(tz=pytz.timezone(USER_TIMEZONE)).utcoffset()
@@ -1332,15 +1983,102 @@ else:
     except (KeyError, TypeError) as err:
         logging.warning(f"Unable to determine user's timezone - Defaulting to UTC. Consider providing TZ identifier with USER_TIMEZONE environment variable")
         local_timediff = timedelta(hours=0)
-    
-    while True:
-        last_watch_sync_time_UTC = datetime.fromtimestamp(int(garmin_obj.get_device_last_used().get('lastUsedDeviceUploadTime')/1000)).astimezone(pytz.timezone("UTC"))
-        if last_influxdb_sync_time_UTC < last_watch_sync_time_UTC:
-            logging.info(f"Update found : Current watch sync time is {last_watch_sync_time_UTC} UTC")
-            fetch_write_bulk((last_influxdb_sync_time_UTC + local_timediff).strftime('%Y-%m-%d'), (last_watch_sync_time_UTC + local_timediff).strftime('%Y-%m-%d')) # Using local dates for deciding which dates to fetch in current iteration (see issue #25)
-            last_influxdb_sync_time_UTC = last_watch_sync_time_UTC
-        else:
-            logging.info(f"No new data found : Current watch and influxdb sync time is {last_watch_sync_time_UTC} UTC")
-        logging.info(f"waiting for {UPDATE_INTERVAL_SECONDS} seconds before next automatic update calls")
-        time.sleep(UPDATE_INTERVAL_SECONDS)
+    return local_timediff
+
+def load_sync_state(account):
+    # Resume point of each selected metric from the sync state store - InfluxDB is only queried if a metric has none yet
+    metric_syncs = SYNC_STATE.metric_syncs(garmin_obj.user_id) if SYNC_STATE else {}
+    account.metric_synced_until = {metric: datetime.fromtimestamp(metric_syncs[metric], tz=pytz.utc) for metric in selected_fetch_metrics() if metric in metric_syncs}
+    if len(account.metric_synced_until) == len(selected_fetch_metrics()):
+        account.last_influxdb_sync_time_UTC = min(account.metric_synced_until.values())
+        logging.info(f"Resuming from sync state : oldest metric was synced up to {account.last_influxdb_sync_time_UTC} UTC")
+    else:
+        account.last_influxdb_sync_time_UTC = min([get_last_influxdb_sync_time()] + list(account.metric_synced_until.values()))
+
+def metrics_due(account, date_str):
+    # Metrics already synced past date_str are not fetched again for it
+    return [metric for metric in selected_fetch_metrics() if (account.metric_synced_until.get(metric, account.last_influxdb_sync_time_UTC) + account.local_timediff).strftime('%Y-%m-%d') <= date_str]
+
+def mark_metrics_synced(account):
+    # Called once all pending dates are done, metrics which failed on any of them keep their previous sync point
+    if WRITE_PIPELINE and not WRITE_PIPELINE.flush():
+        account.failed_metrics.update(selected_fetch_metrics()) # can't tell which metrics were in the failed batches
+    synced_metrics = [metric for metric in selected_fetch_metrics() if metric not in account.failed_metrics]
+    for metric in synced_metrics:
+        account.metric_synced_until[metric] = account.pending_sync_time_UTC
+    if SYNC_STATE:
+        SYNC_STATE.mark_synced(garmin_obj.user_id, synced_metrics, account.pending_sync_time_UTC.timestamp())
+    if account.failed_metrics:
+        logging.warning(f"Sync state : {', '.join(sorted(account.failed_metrics))} failed on some dates - they will be fetched again from their previous sync point after a restart")
+    account.failed_metrics.clear()
 
+def poll_account(account):
+    last_watch_sync_time_UTC = datetime.fromtimestamp(int(garmin_obj.get_device_last_used().get('lastUsedDeviceUploadTime')/1000)).astimezone(pytz.timezone("UTC"))
+    if account.last_influxdb_sync_time_UTC < last_watch_sync_time_UTC:
+        logging.info(f"Update found : Current watch sync time is {last_watch_sync_time_UTC} UTC")
+        write_points_to_influxdb(get_last_sync())
+        # Using local dates for deciding which dates to fetch in current iteration (see issue #25)
+        account.pending_dates.extend(iter_days((account.last_influxdb_sync_time_UTC + account.local_timediff).strftime('%Y-%m-%d'), (last_watch_sync_time_UTC + account.local_timediff).strftime('%Y-%m-%d')))
+        account.pending_sync_time_UTC = last_watch_sync_time_UTC
+    else:
+        logging.info(f"No new data found : Current watch and influxdb sync time is {last_watch_sync_time_UTC} UTC")
+    account.next_poll_time = time.time() + UPDATE_INTERVAL_SECONDS
+
+def run_accounts(accounts, poll=True):
+    # Round robin over the accounts, one date per turn - an account waiting for its own rate budget never blocks the others
+    while poll or any(account.pending_dates for account in accounts):
+        replay_write_spool() # also drains the spool while there is nothing new to write
+        for account in accounts:
+            if account.not_before > time.time():
+                continue
+            with active_account(account):
+                if poll and not account.pending_dates and account.next_poll_time <= time.time():
+                    poll_account(account)
+                if not account.pending_dates:
+                    continue
+                cooldown_seconds = garmin_obj.rate_limiter.budget()['cooldown_seconds'] if garmin_obj.rate_limiter else 0
+                if cooldown_seconds > 0:
+                    account.not_before = time.time() + cooldown_seconds
+                    continue
+                due_metrics = metrics_due(account, account.pending_dates[0]) if poll else None
+                done, wait_seconds, written_metrics = fetch_write_day(account.pending_dates[0], incremental=poll, metrics=due_metrics)
+                if done:
+                    account.failed_metrics.update(set(due_metrics or []) - written_metrics)
+                    account.pending_dates.popleft()
+                    if not account.pending_dates and account.pending_sync_time_UTC:
+                        account.last_influxdb_sync_time_UTC = account.pending_sync_time_UTC
+                        mark_metrics_synced(account)
+                account.not_before = time.time() + wait_seconds
+        wake_times = [account.not_before if (account.pending_dates or not poll) else max(account.not_before, account.next_poll_time) for account in accounts]
+        sleep_seconds = min(wake_times) - time.time()
+        if sleep_seconds > 0:
+            logging.info(f"waiting for {sleep_seconds:.0f} seconds before next automatic update calls")
+            time.sleep(sleep_seconds)
+
+
+# %%
+garmin_obj = garmin_login()
+accounts = [GarminAccount(garmin_obj)] + [GarminAccount(garmin_login(token_dir)) for token_dir in GARMIN_ACCOUNT_TOKEN_DIRS]
+
+# %%
+if MANUAL_START_DATE:
+    if BACKFILL_QUEUE:
+        for account in accounts:
+            with active_account(account):
+                fetch_write_bulk_queued(MANUAL_START_DATE, MANUAL_END_DATE)
+    elif len(accounts) == 1:
+        fetch_write_bulk(MANUAL_START_DATE, MANUAL_END_DATE)
+    else:
+        for account in accounts:
+            with active_account(account):
+                write_points_to_influxdb(get_last_sync())
+            account.pending_dates.extend(iter_days(MANUAL_START_DATE, MANUAL_END_DATE))
+        run_accounts(accounts, poll=False)
+    logging.info(f"Bulk update success : Fetched all available health metrics for date range {MANUAL_START_DATE} to {MANUAL_END_DATE}")
+    exit(0)
+else:
+    for account in accounts:
+        with active_account(account):
+            account.local_timediff = get_local_timediff()
+            load_sync_state(account)
+    run_accounts(accounts)
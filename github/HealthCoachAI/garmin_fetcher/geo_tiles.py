@@ -0,0 +1,92 @@
+import numpy as np
+from datetime import datetime, timezone
+from activity_parsing import chunked, point_timestamp
+
+GEOHASH_ALPHABET = np.array(list("0123456789bcdefghjkmnpqrstuvwxyz"))
+GEOHASH_DECODE = {character: value for value, character in enumerate(GEOHASH_ALPHABET.tolist())}
+
+
+def geohash_codes(latitude, longitude, precision):
+    """Geohash of each (latitude, longitude) as an integer of 5 * precision bits, longitude bit first."""
+    bits = 5 * precision
+    longitude_bits, latitude_bits = (bits + 1) // 2, bits // 2
+    latitude_cells = np.clip(((latitude + 90) / 180 * 2**latitude_bits).astype(np.int64), 0, 2**latitude_bits - 1)
+    longitude_cells = np.clip(((longitude + 180) / 360 * 2**longitude_bits).astype(np.int64), 0, 2**longitude_bits - 1)
+    codes = np.zeros(len(latitude), dtype=np.int64)
+    for bit in range(bits):
+        if bit % 2 == 0:
+            value = (longitude_cells >> (longitude_bits - 1 - bit // 2)) & 1
+        else:
+            value = (latitude_cells >> (latitude_bits - 1 - bit // 2)) & 1
+        codes = (codes << 1) | value
+    return codes
+
+
+def geohash_strings(codes, precision):
+    # Base32 geohash strings of integer codes
+    if len(codes) == 0:
+        return np.empty(0, dtype=f"<U{precision}")
+    characters = GEOHASH_ALPHABET[(codes[:, None] >> (5 * np.arange(precision - 1, -1, -1))) & 31]
+    return np.ascontiguousarray(characters).view(f"<U{precision}").reshape(-1)
+
+
+def geohash_center(geohash):
+    """(latitude, longitude) of the center of a geohash tile."""
+    code = 0
+    for character in geohash:
+        code = (code << 5) | GEOHASH_DECODE[character]
+    bits = 5 * len(geohash)
+    longitude_bits, latitude_bits = (bits + 1) // 2, bits // 2
+    latitude_cell = longitude_cell = 0
+    for bit in range(bits):
+        value = (code >> (bits - 1 - bit)) & 1
+        if bit % 2 == 0:
+            longitude_cell = (longitude_cell << 1) | value
+        else:
+            latitude_cell = (latitude_cell << 1) | value
+    return (latitude_cell + 0.5) / 2**latitude_bits * 180 - 90, (longitude_cell + 0.5) / 2**longitude_bits * 360 - 180
+
+
+def geo_tile_chunks(chunks, store, user_id, precisions=(5, 6, 7), chunk_size=10000):
+    """Passes the point chunks of an activity through and yields the GeoTiles points of the tiles it visited after them.
+
+    Each ActivityGPS point with a position gets a Geohash field (finest precision). The number of points of the activity
+    in each tile of every precision is added to store (a GeoTileStore), and each tile the activity visited is written
+    with its updated totals : Visits (activities through the tile) and Points, tagged Precision and Geohash, so a heatmap
+    reads one row per tile. The totals are written at the ingest time, not the activity's : the latest row of a tile is
+    its current total whatever order activities are ingested or re-ingested in. Only the position columns are kept until the last chunk.
+    """
+    finest = max(precisions)
+    latitudes, longitudes = [], []
+    template = None
+    for chunk in chunks:
+        positioned = [point for point in chunk if point["measurement"] == "ActivityGPS" and point["fields"].get("Latitude") is not None and point["fields"].get("Longitude") is not None]
+        if positioned:
+            template = template or positioned[0]
+            latitude = np.array([point["fields"]["Latitude"] for point in positioned], dtype=float)
+            longitude = np.array([point["fields"]["Longitude"] for point in positioned], dtype=float)
+            for point, geohash in zip(positioned, geohash_strings(geohash_codes(latitude, longitude, finest), finest).tolist()):
+                point["fields"]["Geohash"] = geohash
+            latitudes.append(latitude)
+            longitudes.append(longitude)
+        yield chunk
+    if template is None:
+        return
+    codes = geohash_codes(np.concatenate(latitudes), np.concatenate(longitudes), finest)
+    tiles = {}
+    for precision in precisions:
+        tile_codes, counts = np.unique(codes >> (5 * (finest - precision)), return_counts=True)
+        tiles[precision] = dict(zip(geohash_strings(tile_codes, precision).tolist(), counts.tolist()))
+    start_time = point_timestamp(template["time"])
+    totals = store.add_activity(user_id, template["fields"].get("Activity_ID"), start_time, tiles)
+    ingest_time = datetime.now(timezone.utc).isoformat()
+    points = []
+    for (precision, geohash), (visits, point_count) in totals.items():
+        latitude, longitude = geohash_center(geohash)
+        points.append({
+            "measurement": "GeoTiles",
+            "time": ingest_time,
+            "tags": {"Device": template["tags"].get("Device"), "Database_Name": template["tags"].get("Database_Name"), "Precision": precision, "Geohash": geohash},
+            "fields": {"Visits": visits, "Points": point_count, "Latitude": latitude, "Longitude": longitude}
+        })
+    yield from chunked(points, chunk_size)
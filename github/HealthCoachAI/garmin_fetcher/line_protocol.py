@@ -0,0 +1,104 @@
+import math, numbers
+import numpy as np
+from datetime import datetime, timezone
+from columnar import ColumnarPoints
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+# Timestamp units per second of each write precision (InfluxDB v3 names, v1 uses n and u for ns and us)
+PRECISION_UNITS = {'s': 1, 'ms': 10**3, 'us': 10**6, 'ns': 10**9}
+V1_PRECISION = {'s': 's', 'ms': 'ms', 'us': 'u', 'ns': 'n'}
+
+
+def escape_measurement(name):
+    return str(name).replace('\\', '\\\\').replace(',', '\\,').replace(' ', '\\ ')
+
+
+def escape_key(key):
+    # Tag keys, tag values and field keys
+    return str(key).replace('\\', '\\\\').replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ').replace('\n', '\\n')
+
+
+def encode_field_value(value):
+    """Line protocol literal of a field value, None for values InfluxDB can't store (None, NaN, infinity)."""
+    if value is None:
+        return None
+    # numpy scalars (np.int64, np.float32, np.bool_ ...) are numbers too, like in influxdb_client.Point
+    if isinstance(value, (bool, np.bool_)):
+        return 'true' if value else 'false'
+    if isinstance(value, numbers.Integral):
+        return f"{int(value)}i"
+    if isinstance(value, numbers.Real):
+        value = float(value)
+        return repr(value) if math.isfinite(value) else None
+    value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return f'"{value}"'
+
+
+def encode_timestamp(point_time, precision):
+    # Exact integer epoch at the given precision, point times are ISO strings or datetimes (naive ones are UTC)
+    if not isinstance(point_time, datetime):
+        point_time = datetime.fromisoformat(point_time)
+    if point_time.tzinfo is None:
+        point_time = point_time.replace(tzinfo=timezone.utc)
+    delta = point_time - EPOCH
+    microseconds = (delta.days * 86400 + delta.seconds) * 10**6 + delta.microseconds
+    return microseconds * PRECISION_UNITS[precision] // 10**6
+
+
+class LineProtocolEncoder:
+    """Encodes point dicts and ColumnarPoints blocks straight to line protocol batches.
+
+    Fields with no value are dropped, timestamps are integer epochs at the configured precision and each
+    batch is closed before it grows past max_batch_bytes. The measurement and tag prefix of a tag set is
+    encoded once per batch and reused for every point sharing it.
+    """
+
+    def __init__(self, precision='ms', max_batch_bytes=4 * 2**20):
+        assert precision in PRECISION_UNITS, f"Unsupported write precision '{precision}' - use one of {', '.join(PRECISION_UNITS)}"
+        self.precision = precision
+        self.max_batch_bytes = max_batch_bytes
+
+    def batches(self, points):
+        """Yields the encoded batches (bytes, newline separated lines) of points."""
+        lines = []
+        batch_bytes = 0
+        prefixes = {}
+        for line in self._lines(points, prefixes):
+            if lines and batch_bytes + len(line) + 1 > self.max_batch_bytes:
+                yield b'\n'.join(lines)
+                lines = []
+                batch_bytes = 0
+                prefixes.clear()
+            lines.append(line)
+            batch_bytes += len(line) + 1
+        if lines:
+            yield b'\n'.join(lines)
+
+    def _prefix(self, prefixes, measurement, tags):
+        key = (measurement, tuple(tags.items()))
+        prefix = prefixes.get(key)
+        if prefix is None:
+            encoded_tags = ''.join(f",{escape_key(tag)}={escape_key(value)}" for tag, value in sorted(tags.items()) if value is not None and value != '')
+            prefix = prefixes[key] = escape_measurement(measurement) + encoded_tags + ' '
+        return prefix
+
+    def _lines(self, points, prefixes):
+        for point in points:
+            if isinstance(point, ColumnarPoints):
+                yield from self._block_lines(point, prefixes)
+                continue
+            fields = ','.join(f"{escape_key(field)}={encoded}" for field, encoded in ((field, encode_field_value(value)) for field, value in point['fields'].items()) if encoded is not None)
+            if not fields:
+                continue
+            prefix = self._prefix(prefixes, point['measurement'], point.get('tags') or {})
+            yield f"{prefix}{fields} {encode_timestamp(point['time'], self.precision)}".encode('utf-8')
+
+    def _block_lines(self, block, prefixes):
+        scale = PRECISION_UNITS[self.precision]
+        timestamps = (block.times_ms * scale // 1000 if scale < 1000 else block.times_ms * (scale // 1000)).tolist()
+        columns = [(escape_key(field), column.tolist()) for field, column in block.fields.items()]
+        for i, timestamp in enumerate(timestamps):
+            fields = ','.join(f"{field}={encoded}" for field, encoded in ((field, encode_field_value(column[i])) for field, column in columns) if encoded is not None)
+            if fields:
+                # Looked up per line so the prefix is encoded again after a batch boundary
+                yield f"{self._prefix(prefixes, block.measurement, block.tags)}{fields} {timestamp}".encode('utf-8')
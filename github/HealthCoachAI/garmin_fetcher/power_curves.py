@@ -0,0 +1,124 @@
+import re
+import numpy as np
+from datetime import datetime, timezone
+from activity_parsing import point_timestamp
+
+MEAN_MAX_DURATIONS = [1, 5, 10, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 5400, 7200] # seconds
+MEAN_MAX_SOURCE_FIELDS = ["Power", "HeartRate", "Speed"] # ActivityGPS fields a curve is computed for
+MAX_HOLD_SECONDS = 30 # a value is held until the next point for at most this long, longer gaps count as 0
+EFFORT_PATTERN = re.compile(r"(Power|HeartRate|Speed)_\d+s")
+
+
+def resample_held(duration, values):
+    """One value per second from the first to the last point : the value of the latest point with one, 0 over longer gaps or before it."""
+    has_value = np.isfinite(values)
+    seconds = np.arange(duration[0], duration[-1] + 1)
+    if not has_value.any():
+        return np.zeros(len(seconds))
+    value_times, known = duration[has_value], values[has_value]
+    latest = np.searchsorted(value_times, seconds, side="right") - 1
+    held = known[np.maximum(latest, 0)]
+    return np.where((latest >= 0) & (seconds - value_times[np.maximum(latest, 0)] <= MAX_HOLD_SECONDS), held, 0.0)
+
+
+def mean_max(values, durations=MEAN_MAX_DURATIONS):
+    """{duration: best mean of values (one per second) over any window of that many seconds}, from the differences of one cumulative sum."""
+    cumulative = np.concatenate([[0.0], np.cumsum(values)])
+    return {duration: float(np.max(cumulative[duration:] - cumulative[:-duration]) / duration) for duration in durations if duration <= len(values)}
+
+
+def curve_fields(efforts):
+    # Curve fields of {effort: value}, along with the pace (s/km) of the speed efforts
+    fields = dict(efforts)
+    for effort, value in efforts.items():
+        if effort.startswith("Speed_") and value > 0:
+            fields["Pace_" + effort[len("Speed_"):]] = 1000 / value
+    return fields
+
+
+def mean_max_chunks(chunks, durations=MEAN_MAX_DURATIONS):
+    """Passes the point chunks of an activity through and yields its ActivityMeanMax point after them.
+
+    The point holds the mean-max curve of the power, heart rate and speed of the activity : Power_300s is the best mean
+    power over 5 minutes, Pace_300s the pace of the best 5 minute speed. Only compact value columns are kept until the last chunk.
+    """
+    columns = {field: [] for field in ["DurationSeconds"] + MEAN_MAX_SOURCE_FIELDS}
+    template = None
+    for chunk in chunks:
+        for point in chunk:
+            if point["measurement"] != "ActivityGPS":
+                continue
+            if template is None:
+                template = point
+            fields = point["fields"]
+            for field, values in columns.items():
+                values.append(fields.get(field))
+        yield chunk
+    if template is None:
+        return
+    values = {field: np.array([np.nan if value is None else value for value in column_values], dtype=float) for field, column_values in columns.items()}
+    timed = np.isfinite(values["DurationSeconds"])
+    if not timed.any():
+        return
+    duration = values["DurationSeconds"][timed]
+    efforts = {}
+    for field in MEAN_MAX_SOURCE_FIELDS:
+        if np.isfinite(values[field][timed]).any():
+            efforts.update((f"{field}_{seconds}s", best) for seconds, best in mean_max(resample_held(duration, values[field][timed]), durations).items())
+    if not efforts:
+        return
+    fields = {"ActivityName": template["fields"].get("ActivityName"), "Activity_ID": template["fields"].get("Activity_ID")}
+    fields.update(curve_fields(efforts))
+    yield [{"measurement": "ActivityMeanMax", "time": template["time"], "tags": dict(template["tags"]), "fields": fields}]
+
+
+def rolling_envelopes(curves, starts, window_seconds):
+    """[(start_time, {effort: best value})] of the rolling envelope at the start of each curve which started up to
+    window_seconds after one of starts, from the [(activity_id, start_time, efforts)] curves, oldest first."""
+    envelopes = []
+    for activity_id, start_time, efforts in curves:
+        if not any(start <= start_time <= start + window_seconds for start in starts):
+            continue
+        bests = {}
+        for other_activity_id, other_start_time, other_efforts in curves:
+            if start_time - window_seconds <= other_start_time <= start_time:
+                for effort, value in other_efforts.items():
+                    bests[effort] = max(bests.get(effort, value), value)
+        if bests:
+            envelopes.append((start_time, bests))
+    return envelopes
+
+
+def best_envelope_chunks(chunks, store, user_id, rolling_days=90):
+    """Passes the point chunks through, adds each ActivityMeanMax curve to store (a MeanMaxStore) and yields the updated
+    MeanMaxBests points of its sport.
+
+    The AllTime point holds the current all-time bests and is written at the ingest time, so the latest one is right
+    whatever order activities arrive in (backfills go newest first). The rolling_days point of an activity is written at
+    its start time with the bests of the rolling_days days up to it : adding, replacing or moving an activity changes the
+    envelope of every activity in the rolling_days days after it, and all of those are written again from the stored curves.
+    """
+    window_seconds = rolling_days * 86400
+    for chunk in chunks:
+        yield chunk
+        for point in chunk:
+            if point["measurement"] != "ActivityMeanMax":
+                continue
+            sport = point["fields"].get("ActivityName") or "Unknown"
+            start_time = point_timestamp(point["time"])
+            efforts = {effort: value for effort, value in point["fields"].items() if EFFORT_PATTERN.fullmatch(effort)}
+            previous_start_time = store.add_curve(user_id, point["fields"].get("Activity_ID"), sport, start_time, efforts)
+            starts = [start_time] if previous_start_time in (None, start_time) else [start_time, previous_start_time]
+            curves = store.curves_between(user_id, sport, min(starts) - window_seconds, max(starts) + window_seconds)
+            envelopes = [(f"Rolling{rolling_days}d", datetime.fromtimestamp(envelope_start, tz=timezone.utc).isoformat(), bests) for envelope_start, bests in rolling_envelopes(curves, starts, window_seconds)]
+            all_time = store.all_time_bests(user_id, sport)
+            if all_time:
+                envelopes.append(("AllTime", datetime.now(timezone.utc).isoformat(), all_time))
+            best_points = [{
+                "measurement": "MeanMaxBests",
+                "time": envelope_time,
+                "tags": {"Device": point["tags"].get("Device"), "Database_Name": point["tags"].get("Database_Name"), "Sport": sport, "Period": period},
+                "fields": curve_fields(bests)
+            } for period, envelope_time, bests in envelopes]
+            if best_points:
+                yield best_points
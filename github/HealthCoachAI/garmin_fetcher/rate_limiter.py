@@ -0,0 +1,109 @@
+import random, threading, time
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+
+
+class AdaptiveRateLimiter:
+    """Token bucket pacing Garmin Connect API calls.
+
+    The refill rate follows AIMD : it grows by a fixed step after every successful call and is
+    cut by a factor whenever Garmin answers with 429. A throttled call blocks the whole bucket
+    for an exponential backoff with jitter, or for the Retry-After period if Garmin sent a longer one.
+    """
+
+    def __init__(self, max_rate_per_minute=60, min_rate_per_minute=2, burst=10, increase_per_minute=1, decrease_factor=0.5, backoff_base_seconds=5, backoff_max_seconds=1800):
+        self.max_rate = max_rate_per_minute / 60
+        self.min_rate = min(min_rate_per_minute / 60, self.max_rate)
+        self.increase_step = increase_per_minute / 60
+        self.decrease_factor = decrease_factor
+        self.burst = max(1, burst)
+        self.backoff_base_seconds = backoff_base_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+        self.rate = self.max_rate
+        self.tokens = float(self.burst)
+        self.blocked_until = 0.0
+        self.consecutive_throttles = 0
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """Blocks until a request token is available and takes it."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self.blocked_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def on_success(self):
+        with self._lock:
+            self.consecutive_throttles = 0
+            self.rate = min(self.max_rate, self.rate + self.increase_step)
+
+    def on_throttle(self, retry_after=None):
+        """Registers a 429 response and returns the number of seconds all callers will now wait."""
+        with self._lock:
+            self.consecutive_throttles += 1
+            self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+            backoff = min(self.backoff_max_seconds, self.backoff_base_seconds * 2 ** (self.consecutive_throttles - 1))
+            backoff = random.uniform(backoff / 2, backoff)
+            if retry_after is not None:
+                backoff = max(backoff, retry_after)
+            now = time.monotonic()
+            self.blocked_until = max(self.blocked_until, now + backoff)
+            self.tokens = 0.0
+            self.updated = now
+            return self.blocked_until - now
+
+    def budget(self):
+        """Returns the tokens left, the current rate per minute and the remaining cooldown in seconds."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            return {
+                "tokens": self.tokens,
+                "rate_per_minute": self.rate * 60,
+                "cooldown_seconds": max(0.0, self.blocked_until - now),
+            }
+
+
+def _http_response(err):
+    # garth wraps the requests HTTPError in GarthHTTPError.error, garminconnect chains it with raise ... from
+    seen = set()
+    while err is not None and id(err) not in seen:
+        seen.add(id(err))
+        response = getattr(err, "response", None)
+        if response is not None:
+            return response
+        err = getattr(err, "error", None) or err.__cause__ or err.__context__
+    return None
+
+
+def is_rate_limit_response(err):
+    response = _http_response(err)
+    return response is not None and getattr(response, "status_code", None) == 429
+
+
+def retry_after_seconds(err):
+    """Parses the Retry-After header (delay in seconds or HTTP date) of the response behind err, if any."""
+    response = _http_response(err)
+    value = (getattr(response, "headers", None) or {}).get("Retry-After") if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
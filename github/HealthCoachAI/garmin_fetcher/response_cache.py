@@ -0,0 +1,76 @@
+import json, logging, os, sqlite3, threading, time, zlib
+from datetime import datetime
+
+
+class ResponseCache:
+    """Persistent cache of Garmin Connect JSON responses, keyed by endpoint call and date.
+
+    Responses for days older than immutable_after_days never expire, today and yesterday use
+    recent_ttl_seconds and the days in between use ttl_seconds. Payloads are stored zlib compressed
+    in a single SQLite file and the least recently used entries are evicted once max_size_bytes is exceeded.
+    """
+
+    MISS = object()
+
+    def __init__(self, path, max_size_bytes=512 * 1024 * 1024, immutable_after_days=7, recent_ttl_seconds=300, ttl_seconds=6 * 3600):
+        self.max_size_bytes = max_size_bytes
+        self.immutable_after_days = immutable_after_days
+        self.recent_ttl_seconds = recent_ttl_seconds
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, date TEXT, expires_at REAL, last_access REAL, size INTEGER, payload BLOB)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self.size_bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def ttl_for(self, date_str):
+        """Seconds a response for date_str stays valid, None if the day is old enough to be immutable."""
+        age_days = (datetime.today().date() - datetime.strptime(date_str, "%Y-%m-%d").date()).days
+        if age_days >= self.immutable_after_days:
+            return None
+        if age_days <= 1:
+            return self.recent_ttl_seconds
+        return self.ttl_seconds
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT expires_at, payload FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or (row[0] is not None and row[0] < now):
+                self.misses += 1
+                return self.MISS
+            self._db.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+            self.hits += 1
+        return json.loads(zlib.decompress(row[1]))
+
+    def put(self, key, date_str, payload):
+        ttl = self.ttl_for(date_str)
+        if ttl == 0:
+            return
+        now = time.time()
+        blob = zlib.compress(json.dumps(payload).encode("utf-8"))
+        with self._lock:
+            old = self._db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, date, expires_at, last_access, size, payload) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, date_str, None if ttl is None else now + ttl, now, len(blob), blob)
+            )
+            self.size_bytes += len(blob) - (old[0] if old else 0)
+            if self.size_bytes > self.max_size_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Drop least recently used entries until the cache is back to 90% of its size cap
+        target = self.max_size_bytes * 0.9
+        evicted = 0
+        for key, size in self._db.execute("SELECT key, size FROM responses ORDER BY last_access").fetchall():
+            if self.size_bytes <= target:
+                break
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.size_bytes -= size
+            evicted += 1
+        logging.info(f"Response cache : evicted {evicted} least recently used entries ({self.size_bytes / 2**20:.1f} MB kept)")
@@ -0,0 +1,115 @@
+import hashlib
+import numpy as np
+from activity_parsing import point_timestamp
+from geo_tiles import geohash_codes
+from route_simplify import simplify_mask
+
+ROUTE_CELL_PRECISION = 7 # geohash length of the cells a route is made of (~150 m)
+MIN_ROUTE_CELLS = 10 # fewer cells is no route (treadmill, pool, indoor activities)
+MINHASH_BANDS, MINHASH_ROWS = 16, 4 # LSH banding of the 64 value signature : routes with a Jaccard similarity of 0.6 share a bucket 89% of the time
+MINHASH_SEEDS = np.random.default_rng(0x5EED).integers(0, 2**63, size=MINHASH_BANDS * MINHASH_ROWS, dtype=np.uint64)
+POLYLINE_TOLERANCE_METERS = 20
+# Summary points of the activity which get its RouteID field, so trends on a route are read from them. RouteID is a field
+# and not a tag : an activity matching another route once re-ingested then overwrites its points instead of adding a series
+ROUTE_ID_MEASUREMENTS = ["ActivityMetrics", "ActivityMeanMax"]
+
+
+def route_signature(cell_codes):
+    """MinHash signature (uint64 array) of a set of geohash cell codes, the share of equal values of two signatures estimates their Jaccard similarity."""
+    with np.errstate(over="ignore"):
+        hashes = np.unique(cell_codes).astype(np.uint64)[:, None] ^ MINHASH_SEEDS[None, :]
+        # splitmix64 finalizer
+        hashes = hashes + np.uint64(0x9E3779B97F4A7C15)
+        hashes = (hashes ^ (hashes >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        hashes = (hashes ^ (hashes >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        hashes = hashes ^ (hashes >> np.uint64(31))
+    return hashes.min(axis=0)
+
+
+def signature_buckets(signature):
+    # (band, bucket) LSH keys of a signature
+    return [(band, hashlib.blake2b(signature[band * MINHASH_ROWS:(band + 1) * MINHASH_ROWS].tobytes(), digest_size=8).hexdigest()) for band in range(MINHASH_BANDS)]
+
+
+def signature_similarity(signature, other_signature):
+    return float(np.mean(signature == other_signature))
+
+
+def encode_polyline(latitude, longitude):
+    """Google encoded polyline (1e-5 degrees) of the points."""
+    coordinates = np.round(np.column_stack([latitude, longitude]) * 1e5).astype(np.int64)
+    deltas = np.diff(coordinates, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).reshape(-1).tolist()
+    encoded = []
+    for delta in deltas:
+        value = ~(delta << 1) if delta < 0 else delta << 1
+        while value >= 0x20:
+            encoded.append(chr((0x20 | (value & 0x1F)) + 63))
+            value >>= 5
+        encoded.append(chr(value + 63))
+    return "".join(encoded)
+
+
+def route_index_chunks(chunks, store, user_id, match_threshold=0.6):
+    """Passes the point chunks of an activity through and yields its ActivityRoute point after them.
+
+    The route fingerprint is the MinHash signature of the geohash cells the activity went through, indexed by LSH band
+    in store (a RouteFingerprintStore) : similar past activities are found from the few sharing a bucket, not by
+    comparing tracks. The activity takes the RouteID of the most similar one at or above match_threshold, or starts a
+    new route with its own id. The ActivityRoute point holds the RouteID, the match and a simplified polyline, and the
+    ActivityMetrics / ActivityMeanMax points of the activity are held back to get the RouteID field.
+    """
+    latitudes, longitudes, durations = [], [], []
+    held = []
+    template = None
+    for chunk in chunks:
+        passed = []
+        for point in chunk:
+            if point["measurement"] in ROUTE_ID_MEASUREMENTS:
+                held.append(point)
+                continue
+            passed.append(point)
+            fields = point["fields"]
+            if point["measurement"] == "ActivityGPS" and fields.get("Latitude") is not None and fields.get("Longitude") is not None:
+                template = template or point
+                latitudes.append(fields["Latitude"])
+                longitudes.append(fields["Longitude"])
+                durations.append(fields.get("DurationSeconds"))
+        if passed:
+            yield passed
+    route_points = []
+    if template is not None:
+        latitude, longitude = np.array(latitudes, dtype=float), np.array(longitudes, dtype=float)
+        cells = np.unique(geohash_codes(latitude, longitude, ROUTE_CELL_PRECISION))
+        if len(cells) >= MIN_ROUTE_CELLS:
+            activity_id = template["fields"].get("Activity_ID")
+            signature = route_signature(cells)
+            buckets = signature_buckets(signature)
+            matches = sorted(
+                ((signature_similarity(signature, np.frombuffer(other_signature, dtype=np.uint64)), other_activity_id, route_id) for other_activity_id, route_id, other_signature in store.candidates(user_id, buckets) if other_activity_id != activity_id),
+                reverse=True
+            )
+            matches = [match for match in matches if match[0] >= match_threshold]
+            route_id = matches[0][2] if matches else activity_id
+            duration = np.array([np.nan if value is None else value for value in durations], dtype=float)
+            kept = simplify_mask({"Latitude": latitude, "Longitude": longitude, "DurationSeconds": duration}, POLYLINE_TOLERANCE_METERS, 0, 0)
+            polyline = encode_polyline(latitude[kept], longitude[kept])
+            store.put(user_id, activity_id, route_id, point_timestamp(template["time"]), signature.tobytes(), buckets, polyline)
+            for point in held:
+                point["fields"]["RouteID"] = route_id
+            route_points.append({
+                "measurement": "ActivityRoute",
+                "time": template["time"],
+                "tags": dict(template["tags"]),
+                "fields": {
+                    "ActivityName": template["fields"].get("ActivityName"),
+                    "Activity_ID": activity_id,
+                    "RouteID": route_id,
+                    "Cells": len(cells),
+                    "Matched_Activity_ID": matches[0][1] if matches else None,
+                    "Similarity": matches[0][0] if matches else None,
+                    "Similar_Activities": len(matches),
+                    "Polyline": polyline
+                }
+            })
+    if held or route_points:
+        yield held + route_points
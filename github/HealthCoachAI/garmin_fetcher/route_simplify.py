@@ -0,0 +1,91 @@
+import numpy as np
+from activity_parsing import chunked
+
+EARTH_RADIUS_METERS = 6371008.8
+ROUTE_SIMPLIFICATION_MODES = ["off", "alongside", "replace"]
+# Fields carried by the simplified points, DurationSeconds is the time axis the other values are interpolated on
+SIMPLIFIED_FIELDS = ["Latitude", "Longitude", "Altitude", "Distance", "DurationSeconds", "HeartRate", "Speed"]
+
+
+def simplify_route_chunks(chunks, mode="alongside", distance_tolerance=5.0, heart_rate_tolerance=3.0, speed_tolerance=0.5, chunk_size=10000):
+    """Passes the point chunks of an activity through and yields a simplified copy of its ActivityGPS points after them.
+
+    The route is simplified with Douglas-Peucker over position, heart rate and speed at once : a point is kept when the
+    route between the kept points around it is more than distance_tolerance meters away from it, or its heart rate or
+    speed differs by more than their tolerance from the value interpolated over time (a tolerance of 0 ignores that value).
+    mode "alongside" writes the simplified points as ActivityGPSSimplified next to the full series, "replace" drops the
+    ActivityGPS points and writes the simplified ones as ActivityGPS instead. Only compact value columns are kept until
+    the last chunk, not the points themselves.
+    """
+    columns = {field: [] for field in SIMPLIFIED_FIELDS}
+    times = []
+    template = None
+    for chunk in chunks:
+        for point in chunk:
+            if point["measurement"] != "ActivityGPS":
+                continue
+            if template is None:
+                template = point
+            times.append(point["time"])
+            fields = point["fields"]
+            for field, values in columns.items():
+                values.append(fields.get(field))
+        if mode == "replace":
+            chunk = [point for point in chunk if point["measurement"] != "ActivityGPS"]
+        if chunk:
+            yield chunk
+    if template is None:
+        return
+    values = {field: np.array([np.nan if value is None else value for value in column_values], dtype=float) for field, column_values in columns.items()}
+    keep = simplify_mask(values, distance_tolerance, heart_rate_tolerance, speed_tolerance)
+    measurement = "ActivityGPS" if mode == "replace" else "ActivityGPSSimplified"
+    kept_values = {field: [None if value != value else value for value in field_values[keep].tolist()] for field, field_values in values.items()}
+    kept_times = [point_time for point_time, kept in zip(times, keep.tolist()) if kept]
+    points = []
+    for i, point_time in enumerate(kept_times):
+        fields = {"ActivityName": template["fields"].get("ActivityName"), "Activity_ID": template["fields"].get("Activity_ID")}
+        fields.update((field, kept_values[field][i]) for field in SIMPLIFIED_FIELDS)
+        points.append({"measurement": measurement, "time": point_time, "tags": dict(template["tags"]), "fields": fields})
+    yield from chunked(points, chunk_size)
+
+
+def simplify_mask(values, distance_tolerance, heart_rate_tolerance, speed_tolerance):
+    """Boolean mask of the points Douglas-Peucker keeps, values being {field: float array} with NaN for missing values."""
+    length = len(values["DurationSeconds"])
+    keep = np.zeros(length, dtype=bool)
+    if length == 0:
+        return keep
+    keep[0] = keep[-1] = True
+    latitude, longitude = values["Latitude"], values["Longitude"]
+    reference_latitude = np.radians(np.nanmean(latitude)) if np.isfinite(latitude).any() else 0.0
+    # Local equirectangular projection in meters, accurate enough over the extent of one activity
+    x = np.radians(longitude) * EARTH_RADIUS_METERS * np.cos(reference_latitude)
+    y = np.radians(latitude) * EARTH_RADIUS_METERS
+    duration = np.nan_to_num(values["DurationSeconds"])
+    interpolated = [(values[field], tolerance) for field, tolerance in [("HeartRate", heart_rate_tolerance), ("Speed", speed_tolerance)] if tolerance > 0]
+    segments = [(0, length - 1)]
+    while segments:
+        first, last = segments.pop()
+        if last - first < 2:
+            continue
+        inner = slice(first + 1, last)
+        error = np.zeros(last - first - 1)
+        if distance_tolerance > 0:
+            dx, dy = x[last] - x[first], y[last] - y[first]
+            px, py = x[inner] - x[first], y[inner] - y[first]
+            squared_length = dx * dx + dy * dy
+            along = np.clip((px * dx + py * dy) / squared_length, 0, 1) if squared_length > 0 else 0
+            error = np.fmax(error, np.hypot(px - along * dx, py - along * dy) / distance_tolerance)
+        span = duration[last] - duration[first]
+        fraction = (duration[inner] - duration[first]) / span if span > 0 else np.zeros(last - first - 1)
+        for field_values, tolerance in interpolated:
+            expected = field_values[first] + fraction * (field_values[last] - field_values[first])
+            error = np.fmax(error, np.abs(field_values[inner] - expected) / tolerance)
+        error = np.nan_to_num(error)
+        worst = int(np.argmax(error))
+        if error[worst] > 1:
+            split = first + 1 + worst
+            keep[split] = True
+            segments.append((first, split))
+            segments.append((split, last))
+    return keep
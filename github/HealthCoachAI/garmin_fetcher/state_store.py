@@ -0,0 +1,382 @@
+import json, os, sqlite3, threading, time
+from contextlib import contextmanager
+
+
+def open_state_db(path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    db = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    return db
+
+
+@contextmanager
+def immediate_transaction(db):
+    # BEGIN IMMEDIATE ... COMMIT around the block, rolled back if it raises so no partial change is kept
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        yield db
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+    db.execute("COMMIT")
+
+
+class FingerprintStore:
+    """Hash of the upstream Garmin payloads last written for each (user, date, metric).
+
+    Along with the hash it keeps the list of requests the metric's getter made, so the payloads can be
+    fetched and compared before running the getter again, and the number of points that were written.
+    """
+
+    def __init__(self, path):
+        self.skipped_writes = 0
+        self.skipped_points = 0
+        self._lock = threading.Lock()
+        self._db = open_state_db(path)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS fingerprints (
+            user_id TEXT NOT NULL,
+            date TEXT NOT NULL,
+            metric TEXT NOT NULL,
+            digest TEXT NOT NULL,
+            requests TEXT NOT NULL,
+            point_count INTEGER NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (user_id, date, metric))""")
+
+    def get(self, user_id, date_str, metric):
+        """Returns (digest, requests, point_count) or None if the metric was never written for that date."""
+        with self._lock:
+            row = self._db.execute("SELECT digest, requests, point_count FROM fingerprints WHERE user_id = ? AND date = ? AND metric = ?", (user_id, date_str, metric)).fetchone()
+        return (row[0], json.loads(row[1]), row[2]) if row else None
+
+    def put(self, user_id, date_str, metric, digest, requests, point_count):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO fingerprints (user_id, date, metric, digest, requests, point_count, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (user_id, date_str, metric, digest, json.dumps(requests, default=str), point_count, time.time())
+            )
+
+    def record_skip(self, point_count):
+        with self._lock:
+            self.skipped_writes += 1
+            self.skipped_points += point_count
+
+
+class SyncStateStore:
+    """Persistent sync state of each Garmin account.
+
+    watermarks holds the time of the latest point written to InfluxDB for every (user, measurement), along with
+    the date the points were fetched for when the writer knows it. metric_syncs holds, for every (user, metric),
+    the watch sync time (epoch seconds) up to which the metric was fetched and written for all dates.
+    """
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db = open_state_db(path)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS watermarks (
+            user_id TEXT NOT NULL,
+            measurement TEXT NOT NULL,
+            time_ms INTEGER NOT NULL,
+            date TEXT,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (user_id, measurement))""")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS metric_syncs (
+            user_id TEXT NOT NULL,
+            metric TEXT NOT NULL,
+            synced_until REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (user_id, metric))""")
+
+    def advance(self, user_id, latest_times, date_str=None):
+        """Moves the watermarks of the given {measurement: epoch ms} forward in a single transaction, older times are ignored."""
+        if not latest_times:
+            return
+        now = time.time()
+        with self._lock:
+            with immediate_transaction(self._db):
+                self._db.executemany(
+                    """INSERT INTO watermarks (user_id, measurement, time_ms, date, updated_at) VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT (user_id, measurement) DO UPDATE SET time_ms = excluded.time_ms, date = excluded.date, updated_at = excluded.updated_at
+                    WHERE excluded.time_ms >= watermarks.time_ms""",
+                    [(user_id, measurement, time_ms, date_str, now) for measurement, time_ms in latest_times.items()]
+                )
+
+    def watermarks(self, user_id):
+        """Returns {measurement: (epoch ms, date or None)} for the user."""
+        with self._lock:
+            rows = self._db.execute("SELECT measurement, time_ms, date FROM watermarks WHERE user_id = ?", (user_id,)).fetchall()
+        return {measurement: (time_ms, date_str) for measurement, time_ms, date_str in rows}
+
+    def mark_synced(self, user_id, metrics, synced_until):
+        now = time.time()
+        with self._lock:
+            with immediate_transaction(self._db):
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO metric_syncs (user_id, metric, synced_until, updated_at) VALUES (?, ?, ?, ?)",
+                    [(user_id, metric, synced_until, now) for metric in metrics]
+                )
+
+    def metric_syncs(self, user_id):
+        """Returns {metric: epoch seconds} for the user."""
+        with self._lock:
+            return dict(self._db.execute("SELECT metric, synced_until FROM metric_syncs WHERE user_id = ?", (user_id,)).fetchall())
+
+
+class ActivityIndex:
+    """Activities ingested for each user, so they are only downloaded and parsed again when Garmin changes them.
+
+    marker is the digest of the activity summary Garmin lists (any edit on Garmin's side changes it), content_hash
+    the sha256 of the downloaded FIT or TCX file and point_count the number of points written for the activity.
+    """
+
+    def __init__(self, path):
+        self.skipped_activities = 0
+        self._lock = threading.Lock()
+        self._db = open_state_db(path)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS activities (
+            user_id TEXT NOT NULL,
+            activity_id INTEGER NOT NULL,
+            marker TEXT,
+            point_count INTEGER NOT NULL,
+            content_hash TEXT,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (user_id, activity_id))""")
+
+    def get(self, user_id, activity_id):
+        """Returns (marker, point_count, content_hash) or None if the activity was never ingested."""
+        with self._lock:
+            row = self._db.execute("SELECT marker, point_count, content_hash FROM activities WHERE user_id = ? AND activity_id = ?", (user_id, activity_id)).fetchone()
+        return tuple(row) if row else None
+
+    def put(self, user_id, activity_id, marker, point_count, content_hash):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO activities (user_id, activity_id, marker, point_count, content_hash, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (user_id, activity_id, marker, point_count, content_hash, time.time())
+            )
+
+    def record_skip(self):
+        with self._lock:
+            self.skipped_activities += 1
+
+
+class MeanMaxStore:
+    """Mean-max curves of the ingested activities and the all-time best of each effort, per user and sport.
+
+    An effort is a curve field such as Power_300s (best 5 minute mean power). mean_max_curves keeps the curve of every
+    activity so the best efforts of any time window can be read without going back to the activity points, and
+    mean_max_bests is moved forward as each activity arrives.
+    """
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db = open_state_db(path)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS mean_max_curves (
+            user_id TEXT NOT NULL,
+            activity_id INTEGER NOT NULL,
+            sport TEXT NOT NULL,
+            effort TEXT NOT NULL,
+            value REAL NOT NULL,
+            start_time REAL NOT NULL,
+            PRIMARY KEY (user_id, activity_id, effort))""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS mean_max_curves_window ON mean_max_curves (user_id, sport, start_time)")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS mean_max_bests (
+            user_id TEXT NOT NULL,
+            sport TEXT NOT NULL,
+            effort TEXT NOT NULL,
+            value REAL NOT NULL,
+            activity_id INTEGER NOT NULL,
+            start_time REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (user_id, sport, effort))""")
+
+    def add_curve(self, user_id, activity_id, sport, start_time, efforts):
+        """Stores the {effort: value} curve of an activity (start_time in epoch seconds) and updates the all-time bests.
+
+        Returns the start time the activity's curve was stored with before, None if it is a new activity.
+        """
+        now = time.time()
+        with self._lock:
+            with immediate_transaction(self._db):
+                previous = self._db.execute("SELECT MAX(start_time) FROM mean_max_curves WHERE user_id = ? AND activity_id = ?", (user_id, activity_id)).fetchone()[0]
+                self._db.execute("DELETE FROM mean_max_curves WHERE user_id = ? AND activity_id = ?", (user_id, activity_id))
+                self._db.executemany(
+                    "INSERT INTO mean_max_curves (user_id, activity_id, sport, effort, value, start_time) VALUES (?, ?, ?, ?, ?, ?)",
+                    [(user_id, activity_id, sport, effort, value, start_time) for effort, value in efforts.items()]
+                )
+                # A re-ingested activity may hold a best it no longer reaches : those are taken again from the stored curves
+                self._db.execute(
+                    """DELETE FROM mean_max_bests WHERE user_id = ? AND activity_id = ? AND value > COALESCE(
+                        (SELECT value FROM mean_max_curves WHERE mean_max_curves.user_id = mean_max_bests.user_id AND activity_id = mean_max_bests.activity_id AND effort = mean_max_bests.effort), -1)""",
+                    (user_id, activity_id)
+                )
+                self._db.execute(
+                    """INSERT OR IGNORE INTO mean_max_bests (user_id, sport, effort, value, activity_id, start_time, updated_at)
+                    SELECT user_id, sport, effort, MAX(value), activity_id, start_time, ? FROM mean_max_curves
+                    WHERE user_id = ? AND sport = ? AND effort NOT IN (SELECT effort FROM mean_max_bests WHERE user_id = ? AND sport = ?)
+                    GROUP BY effort""",
+                    (now, user_id, sport, user_id, sport)
+                )
+                self._db.executemany(
+                    """INSERT INTO mean_max_bests (user_id, sport, effort, value, activity_id, start_time, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (user_id, sport, effort) DO UPDATE SET value = excluded.value, activity_id = excluded.activity_id, start_time = excluded.start_time, updated_at = excluded.updated_at
+                    WHERE excluded.value > mean_max_bests.value""",
+                    [(user_id, sport, effort, value, activity_id, start_time, now) for effort, value in efforts.items()]
+                )
+        return previous
+
+    def all_time_bests(self, user_id, sport):
+        """Returns {effort: best value} over every activity of the sport."""
+        with self._lock:
+            return dict(self._db.execute("SELECT effort, value FROM mean_max_bests WHERE user_id = ? AND sport = ?", (user_id, sport)).fetchall())
+
+    def curves_between(self, user_id, sport, since, until):
+        """Returns [(activity_id, start_time, {effort: value})] of the activities of the sport which started between since and until (epoch seconds), oldest first."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT activity_id, start_time, effort, value FROM mean_max_curves WHERE user_id = ? AND sport = ? AND start_time BETWEEN ? AND ? ORDER BY start_time, activity_id",
+                (user_id, sport, since, until)
+            ).fetchall()
+        curves = {}
+        for activity_id, start_time, effort, value in rows:
+            curves.setdefault((activity_id, start_time), {})[effort] = value
+        return [(activity_id, start_time, efforts) for (activity_id, start_time), efforts in curves.items()]
+
+    def bests_between(self, user_id, sport, since, until):
+        """Returns {effort: best value} over the activities of the sport which started between since and until (epoch seconds)."""
+        with self._lock:
+            return dict(self._db.execute(
+                "SELECT effort, MAX(value) FROM mean_max_curves WHERE user_id = ? AND sport = ? AND start_time BETWEEN ? AND ? GROUP BY effort",
+                (user_id, sport, since, until)
+            ).fetchall())
+
+
+class GeoTileStore:
+    """Geohash tiles visited by the ingested activities, per user and geohash precision.
+
+    geo_tiles holds the running totals of each tile : the number of activities which went through it and of their points
+    in it. activity_geo_tiles keeps the tiles of every activity, so a re-ingested activity replaces its previous counts
+    and activities_near answers "which activities went through these tiles" without reading any point.
+    """
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db = open_state_db(path)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS geo_tiles (
+            user_id TEXT NOT NULL,
+            precision INTEGER NOT NULL,
+            geohash TEXT NOT NULL,
+            visits INTEGER NOT NULL,
+            points INTEGER NOT NULL,
+            last_visit REAL NOT NULL,
+            PRIMARY KEY (user_id, precision, geohash))""")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS activity_geo_tiles (
+            user_id TEXT NOT NULL,
+            activity_id INTEGER NOT NULL,
+            precision INTEGER NOT NULL,
+            geohash TEXT NOT NULL,
+            points INTEGER NOT NULL,
+            start_time REAL NOT NULL,
+            PRIMARY KEY (user_id, activity_id, precision, geohash))""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS activity_geo_tiles_tile ON activity_geo_tiles (user_id, precision, geohash)")
+
+    def add_activity(self, user_id, activity_id, start_time, tiles):
+        """Adds the {precision: {geohash: point count}} tiles of an activity, returns {(precision, geohash): (visits, points)} for every tile it changed."""
+        with self._lock:
+            with immediate_transaction(self._db):
+                previous = self._db.execute("SELECT precision, geohash, points FROM activity_geo_tiles WHERE user_id = ? AND activity_id = ?", (user_id, activity_id)).fetchall()
+                self._db.executemany(
+                    "UPDATE geo_tiles SET visits = visits - 1, points = points - ? WHERE user_id = ? AND precision = ? AND geohash = ?",
+                    [(points, user_id, precision, geohash) for precision, geohash, points in previous]
+                )
+                self._db.execute("DELETE FROM activity_geo_tiles WHERE user_id = ? AND activity_id = ?", (user_id, activity_id))
+                rows = [(precision, geohash, points) for precision, counts in tiles.items() for geohash, points in counts.items()]
+                self._db.executemany(
+                    "INSERT INTO activity_geo_tiles (user_id, activity_id, precision, geohash, points, start_time) VALUES (?, ?, ?, ?, ?, ?)",
+                    [(user_id, activity_id, precision, geohash, points, start_time) for precision, geohash, points in rows]
+                )
+                self._db.executemany(
+                    """INSERT INTO geo_tiles (user_id, precision, geohash, visits, points, last_visit) VALUES (?, ?, ?, 1, ?, ?)
+                    ON CONFLICT (user_id, precision, geohash) DO UPDATE SET visits = visits + 1, points = points + excluded.points, last_visit = MAX(last_visit, excluded.last_visit)""",
+                    [(user_id, precision, geohash, points, start_time) for precision, geohash, points in rows]
+                )
+                changed = {(precision, geohash) for precision, geohash, points in previous + rows}
+                totals = {}
+                for precision, geohash in changed:
+                    row = self._db.execute("SELECT visits, points FROM geo_tiles WHERE user_id = ? AND precision = ? AND geohash = ?", (user_id, precision, geohash)).fetchone()
+                    totals[(precision, geohash)] = tuple(row) if row else (0, 0)
+                self._db.execute("DELETE FROM geo_tiles WHERE user_id = ? AND visits <= 0", (user_id,))
+        return totals
+
+    def tiles(self, user_id, precision):
+        """Returns {geohash: (visits, points)} of every tile of the precision, the heatmap of the user."""
+        with self._lock:
+            return {geohash: (visits, points) for geohash, visits, points in self._db.execute("SELECT geohash, visits, points FROM geo_tiles WHERE user_id = ? AND precision = ?", (user_id, precision)).fetchall()}
+
+    def activities_near(self, user_id, precision, geohashes):
+        """Returns the ids of the activities which went through any of the geohash tiles of the precision, latest first."""
+        geohashes = list(geohashes)
+        if not geohashes:
+            return []
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT activity_id, MAX(start_time) FROM activity_geo_tiles WHERE user_id = ? AND precision = ? AND geohash IN ({', '.join('?' * len(geohashes))}) GROUP BY activity_id ORDER BY MAX(start_time) DESC",
+                [user_id, precision] + geohashes
+            ).fetchall()
+        return [activity_id for activity_id, start_time in rows]
+
+
+class RouteFingerprintStore:
+    """Route fingerprints of the ingested activities : MinHash signature, LSH buckets, RouteID and simplified polyline.
+
+    route_buckets indexes every activity under one bucket per LSH band, so the candidates similar to a new route are
+    read from the index instead of comparing it with every past activity.
+    """
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db = open_state_db(path)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS routes (
+            user_id TEXT NOT NULL,
+            activity_id INTEGER NOT NULL,
+            route_id INTEGER NOT NULL,
+            start_time REAL NOT NULL,
+            signature BLOB NOT NULL,
+            polyline TEXT NOT NULL,
+            PRIMARY KEY (user_id, activity_id))""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS routes_route ON routes (user_id, route_id, start_time)")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS route_buckets (
+            user_id TEXT NOT NULL,
+            band INTEGER NOT NULL,
+            bucket TEXT NOT NULL,
+            activity_id INTEGER NOT NULL,
+            PRIMARY KEY (user_id, band, bucket, activity_id))""")
+
+    def candidates(self, user_id, buckets):
+        """Returns [(activity_id, route_id, signature)] of the activities sharing at least one of the (band, bucket) keys."""
+        if not buckets:
+            return []
+        with self._lock:
+            return self._db.execute(
+                f"""SELECT activity_id, route_id, signature FROM routes WHERE user_id = ? AND activity_id IN (
+                    SELECT activity_id FROM route_buckets WHERE user_id = ? AND ({' OR '.join(['(band = ? AND bucket = ?)'] * len(buckets))}))""",
+                [user_id, user_id] + [key for band_bucket in buckets for key in band_bucket]
+            ).fetchall()
+
+    def put(self, user_id, activity_id, route_id, start_time, signature, buckets, polyline):
+        with self._lock:
+            with immediate_transaction(self._db):
+                self._db.execute("DELETE FROM route_buckets WHERE user_id = ? AND activity_id = ?", (user_id, activity_id))
+                self._db.execute(
+                    "INSERT OR REPLACE INTO routes (user_id, activity_id, route_id, start_time, signature, polyline) VALUES (?, ?, ?, ?, ?, ?)",
+                    (user_id, activity_id, route_id, start_time, signature, polyline)
+                )
+                self._db.executemany(
+                    "INSERT INTO route_buckets (user_id, band, bucket, activity_id) VALUES (?, ?, ?, ?)",
+                    [(user_id, band, bucket, activity_id) for band, bucket in buckets]
+                )
+
+    def route_activities(self, user_id, route_id):
+        """Returns the ids of the activities on a route, oldest first."""
+        with self._lock:
+            return [row[0] for row in self._db.execute("SELECT activity_id FROM routes WHERE user_id = ? AND route_id = ? ORDER BY start_time", (user_id, route_id)).fetchall()]
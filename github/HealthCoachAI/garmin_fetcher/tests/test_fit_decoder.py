@@ -0,0 +1,186 @@
+import io
+import math
+import random
+import struct
+import unittest
+
+import fitparse
+import numpy as np
+from fitparse import FitParseError
+
+from fit_decoder import decode_fit, fit_crc
+
+MESSAGES = ['record', 'session', 'lap', 'length']
+# (field number, size, base type, struct format)
+RECORD_FIELDS = [(253, 4, 0x86, 'I'), (0, 4, 0x85, 'i'), (1, 4, 0x85, 'i'), (2, 2, 0x84, 'H'), (3, 1, 0x02, 'B'), (5, 4, 0x86, 'I'), (6, 2, 0x84, 'H'), (7, 2, 0x84, 'H'), (13, 1, 0x01, 'b')]
+BIG_ENDIAN_RECORD_FIELDS = [(253, 4, 0x86, 'I'), (3, 1, 0x02, 'B'), (73, 4, 0x86, 'I'), (5, 4, 0x86, 'I')]
+COMPRESSED_RECORD_FIELDS = [(3, 1, 0x02, 'B'), (6, 2, 0x84, 'H')] # no timestamp field, the header carries it
+EVENT_FIELDS = [(253, 4, 0x86, 'I'), (0, 1, 0x00, 'B')]
+LAP_FIELDS = [(253, 4, 0x86, 'I'), (254, 2, 0x84, 'H'), (2, 4, 0x86, 'I'), (7, 4, 0x86, 'I'), (9, 4, 0x86, 'I'), (15, 1, 0x02, 'B'), (25, 1, 0x00, 'B')]
+LENGTH_FIELDS = [(253, 4, 0x86, 'I'), (254, 2, 0x84, 'H'), (2, 4, 0x86, 'I'), (5, 2, 0x84, 'H'), (7, 1, 0x00, 'B'), (9, 1, 0x02, 'B')]
+SESSION_FIELDS = [(253, 4, 0x86, 'I'), (254, 2, 0x84, 'H'), (2, 4, 0x86, 'I'), (5, 1, 0x00, 'B'), (6, 1, 0x00, 'B'), (26, 2, 0x84, 'H')]
+DEVELOPER_FIELDS = [(0, 3)] # (field number, size)
+DEVELOPER_DATA_ID_FIELDS = [(3, 1, 0x02, 'B')]
+FIELD_DESCRIPTION_FIELDS = [(0, 1, 0x02, 'B'), (1, 1, 0x02, 'B'), (2, 1, 0x02, 'B')]
+
+
+def crc16(data):
+    # Reference FIT SDK CRC, nibble at a time
+    table = [0x0000, 0xCC01, 0xD801, 0x1400, 0xF001, 0x3C00, 0x2800, 0xE401, 0xA001, 0x6C00, 0x7800, 0xB401, 0x5000, 0x9C01, 0x8801, 0x4400]
+    crc = 0
+    for byte in data:
+        for nibble in (byte & 0xF, byte >> 4):
+            crc = (crc >> 4) ^ table[crc & 0xF] ^ table[nibble]
+    return crc
+
+
+def definition(local, mesg_num, fields, big_endian=False, developer_fields=None):
+    header = 0x40 | local | (0x20 if developer_fields else 0)
+    out = bytes([header, 0, int(big_endian)]) + struct.pack('>H' if big_endian else '<H', mesg_num) + bytes([len(fields)])
+    out += b''.join(bytes([number, size, base_type]) for number, size, base_type, _ in fields)
+    if developer_fields:
+        out += bytes([len(developer_fields)]) + b''.join(bytes([number, size, 0]) for number, size in developer_fields)
+    return out
+
+
+def message(local, fields, values, big_endian=False, developer_fields=None, time_offset=None):
+    header = 0x80 | (local << 5) | time_offset if time_offset is not None else local
+    out = bytes([header]) + b''.join(struct.pack(('>' if big_endian else '<') + fmt, value) for (_, _, _, fmt), value in zip(fields, values))
+    if developer_fields:
+        out += b''.join(b'\x01' * size for _, size in developer_fields)
+    return out
+
+
+def fit_file(records=300, seed=1, developer_fields=None, header_size=14):
+    """Activity FIT file with little and big endian records, compressed timestamp records, invalid values
+    and summary messages, random but reproducible."""
+    rng = random.Random(seed)
+    maybe_invalid = lambda value, invalid: invalid if rng.random() < 0.1 else value
+    body = b''
+    if developer_fields: # fitparse needs their description
+        body += definition(7, 207, DEVELOPER_DATA_ID_FIELDS) + message(7, DEVELOPER_DATA_ID_FIELDS, [0])
+        body += definition(8, 206, FIELD_DESCRIPTION_FIELDS)
+        body += b''.join(message(8, FIELD_DESCRIPTION_FIELDS, [0, number, 0x02]) for number, size in developer_fields)
+    body += definition(0, 20, RECORD_FIELDS) + definition(1, 20, BIG_ENDIAN_RECORD_FIELDS, True, developer_fields)
+    body += definition(2, 21, EVENT_FIELDS) + definition(3, 20, COMPRESSED_RECORD_FIELDS)
+    start = timestamp = 1000000000
+    for i in range(records):
+        timestamp += rng.choice([1, 1, 2, 3])
+        kind = rng.random()
+        if kind < 0.6:
+            body += message(0, RECORD_FIELDS, [timestamp, maybe_invalid(rng.randint(-2**30, 2**30), 0x7FFFFFFF), rng.randint(-2**30, 2**30),
+                                               maybe_invalid(rng.randint(0, 5000), 0xFFFF), maybe_invalid(rng.randint(0, 200), 0xFF), rng.randint(0, 10**7),
+                                               maybe_invalid(rng.randint(0, 6000), 0xFFFF), rng.randint(0, 500), maybe_invalid(rng.randint(-20, 40), 0x7F)])
+        elif kind < 0.8:
+            body += message(1, BIG_ENDIAN_RECORD_FIELDS, [timestamp, rng.randint(0, 200), maybe_invalid(rng.randint(0, 10000), 0xFFFFFFFF), rng.randint(0, 10**6)],
+                            True, developer_fields)
+        elif kind < 0.9:
+            body += message(2, EVENT_FIELDS, [timestamp, 3])
+        else:
+            body += message(3, COMPRESSED_RECORD_FIELDS, [rng.randint(0, 200), rng.randint(0, 6000)], time_offset=timestamp & 0x1F)
+    body += definition(4, 19, LAP_FIELDS)
+    for lap in range(3):
+        body += message(4, LAP_FIELDS, [timestamp, lap, start, rng.randint(0, 10**6), rng.randint(0, 10**6), maybe_invalid(150, 0xFF), rng.choice([1, 2, 0xFF])])
+    body += definition(5, 101, LENGTH_FIELDS)
+    for length in range(2):
+        body += message(5, LENGTH_FIELDS, [timestamp, length, start, 20, rng.choice([0, 1, 250]), 30])
+    body += definition(6, 18, SESSION_FIELDS)
+    body += message(6, SESSION_FIELDS, [timestamp, 0, start, 5, maybe_invalid(17, 0xFF), 2500])
+    header = struct.pack('<BBHI4s', header_size, 16, 2000, len(body), b'.FIT')
+    if header_size == 14:
+        header += struct.pack('<H', crc16(header))
+    return header + body + struct.pack('<H', crc16(header + body))
+
+
+def fitparse_messages(data):
+    fit = fitparse.FitFile(io.BytesIO(data))
+    messages = {name: [] for name in MESSAGES}
+    for fit_message in fit.get_messages(MESSAGES):
+        messages[fit_message.name].append(fit_message.get_values())
+    return messages
+
+
+class DecodeFitTest(unittest.TestCase):
+
+    def assertMatchesFitparse(self, data, ignored_fields=()):
+        expected = fitparse_messages(data)
+        decoded = decode_fit(data)
+        for name in MESSAGES:
+            rows = decoded[name].to_dicts()
+            self.assertEqual(len(rows), len(expected[name]), name)
+            for row, expected_row in zip(rows, expected[name]):
+                expected_row = {field: value for field, value in expected_row.items() if field not in ignored_fields}
+                for field, value in expected_row.items():
+                    if isinstance(value, float):
+                        self.assertTrue(math.isclose(row.get(field), value), (name, field, row.get(field), value))
+                    else:
+                        self.assertEqual(row.get(field), value, (name, field))
+                # Fields fitparse doesn't return can only be missing
+                self.assertTrue(all(row[field] is None for field in row.keys() - expected_row.keys()), name)
+        return decoded
+
+    def test_matches_fitparse(self):
+        # Little and big endian records, compressed timestamps and invalid sentinels
+        decoded = self.assertMatchesFitparse(fit_file())
+        self.assertGreater(len(decoded['record']), 0)
+
+    def test_compressed_timestamps_follow_the_last_timestamp(self):
+        rows = decode_fit(fit_file())['record'].to_dicts()
+        timestamps = [row['timestamp'] for row in rows]
+        self.assertEqual(timestamps, sorted(timestamps))
+
+    def test_twelve_byte_header(self):
+        self.assertMatchesFitparse(fit_file(header_size=12))
+
+    def test_developer_fields_are_skipped(self):
+        plain = decode_fit(fit_file())
+        # fitparse returns the developer fields, the decoder doesn't
+        decoded = self.assertMatchesFitparse(fit_file(developer_fields=DEVELOPER_FIELDS), {f'unnamed_dev_field_{number}' for number, size in DEVELOPER_FIELDS})
+        for name in MESSAGES:
+            self.assertEqual(decoded[name].to_dicts(), plain[name].to_dicts())
+
+    def test_chained_files(self):
+        first, second = fit_file(seed=1), fit_file(seed=2)
+        decoded = self.assertMatchesFitparse(first + second)
+        for name in MESSAGES:
+            self.assertEqual(decoded[name].to_dicts(), decode_fit(first)[name].to_dicts() + decode_fit(second)[name].to_dicts())
+
+    def test_truncated_file_is_rejected(self):
+        data = fit_file()
+        for size in [len(data) - 1, len(data) - 2, len(data) // 2, 20]:
+            with self.assertRaises(FitParseError):
+                decode_fit(data[:size])
+
+    def test_crc_mismatch_is_rejected(self):
+        data = bytearray(fit_file())
+        data[len(data) // 2] ^= 0x01
+        with self.assertRaises(FitParseError):
+            decode_fit(bytes(data))
+        data = bytearray(fit_file())
+        data[12] ^= 0x01 # header CRC
+        with self.assertRaises(FitParseError):
+            decode_fit(bytes(data))
+
+    def test_corrupt_messages_raise_fit_parse_error(self):
+        # Valid header and CRCs around random messages : only FitParseError may come out
+        rng = random.Random(3)
+        for i in range(200):
+            body = bytes(rng.randrange(256) for i in range(rng.randint(1, 200)))
+            header = struct.pack('<BBHI4s', 12, 16, 2000, len(body), b'.FIT')
+            try:
+                decode_fit(header + body + struct.pack('<H', crc16(header + body)))
+            except FitParseError:
+                pass
+
+
+class FitCrcTest(unittest.TestCase):
+
+    def test_matches_reference_crc(self):
+        rng = np.random.default_rng(4)
+        for size in list(range(70)) + [1000, 4097, 65537]:
+            data = rng.integers(0, 256, size, dtype=np.uint8)
+            self.assertEqual(fit_crc(data), crc16(data.tobytes()), size)
+
+
+if __name__ == '__main__':
+    unittest.main()
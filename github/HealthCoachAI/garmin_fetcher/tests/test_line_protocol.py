@@ -0,0 +1,90 @@
+import unittest
+
+import numpy as np
+
+from columnar import ColumnarPoints
+from line_protocol import LineProtocolEncoder, encode_field_value, encode_timestamp
+
+
+def point(fields, tags=None, time="2024-01-01T00:00:00+00:00", measurement="HeartRateIntraday"):
+    return {"measurement": measurement, "time": time, "tags": tags or {}, "fields": fields}
+
+
+def encode(points, **kwargs):
+    return b'\n'.join(LineProtocolEncoder(**kwargs).batches(points)).decode('utf-8')
+
+
+class FieldValueTest(unittest.TestCase):
+
+    def test_python_values(self):
+        self.assertEqual(encode_field_value(True), 'true')
+        self.assertEqual(encode_field_value(72), '72i')
+        self.assertEqual(encode_field_value(72.5), '72.5')
+        self.assertEqual(encode_field_value('Morning "Run"\nC:\\'), '"Morning \\"Run\\"\\nC:\\\\"')
+
+    def test_numpy_scalars_are_numbers(self):
+        self.assertEqual(encode_field_value(np.int64(72)), '72i')
+        self.assertEqual(encode_field_value(np.uint8(200)), '200i')
+        self.assertEqual(encode_field_value(np.float32(0.5)), '0.5')
+        self.assertEqual(encode_field_value(np.float64(72.25)), '72.25')
+        self.assertEqual(encode_field_value(np.bool_(False)), 'false')
+
+    def test_values_influxdb_cannot_store(self):
+        for value in [None, float('nan'), float('inf'), -float('inf'), np.float64('nan'), np.float32('inf')]:
+            self.assertIsNone(encode_field_value(value), value)
+
+
+class TimestampTest(unittest.TestCase):
+
+    def test_precisions(self):
+        time = "2024-01-01T00:00:01.123456+00:00"
+        self.assertEqual(encode_timestamp(time, 's'), 1704067201)
+        self.assertEqual(encode_timestamp(time, 'ms'), 1704067201123)
+        self.assertEqual(encode_timestamp(time, 'us'), 1704067201123456)
+        self.assertEqual(encode_timestamp(time, 'ns'), 1704067201123456000)
+
+    def test_naive_times_are_utc(self):
+        self.assertEqual(encode_timestamp("2024-01-01T00:00:00", 's'), encode_timestamp("2024-01-01T01:00:00+01:00", 's'))
+
+
+class LineProtocolEncoderTest(unittest.TestCase):
+
+    def test_escaping(self):
+        line = encode([point({"Heart Rate": 60, "a=b": "x"}, {"Device": "Forerunner 965", "Name": "a,b=c"}, measurement="Heart Rate,v2")])
+        self.assertEqual(line, 'Heart\\ Rate\\,v2,Device=Forerunner\\ 965,Name=a\\,b\\=c Heart\\ Rate=60i,a\\=b="x" 1704067200000')
+
+    def test_tags_are_sorted_and_empty_ones_dropped(self):
+        line = encode([point({"HeartRate": 60}, {"b": "2", "a": "1", "c": None, "d": ""})])
+        self.assertEqual(line, 'HeartRateIntraday,a=1,b=2 HeartRate=60i 1704067200000')
+
+    def test_empty_fields_are_dropped(self):
+        lines = encode([
+            point({"HeartRate": None, "Stress": float('nan'), "Steps": 10}),
+            point({"HeartRate": None, "Stress": np.float64('nan')}), # nothing left : no line
+        ], precision='s')
+        self.assertEqual(lines, 'HeartRateIntraday Steps=10i 1704067200')
+
+    def test_columnar_points(self):
+        block = ColumnarPoints("StressIntraday", np.array([1704067200000, 1704067260000], dtype=np.int64),
+                               {"stressLevel": np.array([25.0, np.nan]), "bodyBattery": np.array([np.nan, np.nan])}, {"Device": "x"})
+        self.assertEqual(encode([block], precision='ns'), 'StressIntraday,Device=x stressLevel=25.0 1704067200000000000')
+        self.assertEqual(encode([block], precision='s'), 'StressIntraday,Device=x stressLevel=25.0 1704067200')
+
+    def test_batches_are_closed_by_size(self):
+        points = [point({"HeartRate": i}, {"Device": "x"}, time=f"2024-01-01T00:{i // 60:02d}:{i % 60:02d}+00:00") for i in range(500)]
+        line_bytes = len(encode(points[:1]).encode('utf-8'))
+        encoder = LineProtocolEncoder(max_batch_bytes=20 * (line_bytes + 1))
+        batches = list(encoder.batches(points))
+        self.assertGreater(len(batches), 1)
+        self.assertTrue(all(len(batch) <= encoder.max_batch_bytes for batch in batches))
+        # Nothing lost or reordered across batches, each of which starts with a full prefix
+        self.assertEqual(b'\n'.join(batches).decode('utf-8'), encode(points, max_batch_bytes=2**30))
+        self.assertTrue(all(batch.startswith(b'HeartRateIntraday,Device=x ') for batch in batches))
+
+    def test_line_larger_than_a_batch_is_sent_alone(self):
+        batches = list(LineProtocolEncoder(max_batch_bytes=10).batches([point({"HeartRate": 60}), point({"HeartRate": 61})]))
+        self.assertEqual(len(batches), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
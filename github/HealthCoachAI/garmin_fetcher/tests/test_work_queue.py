@@ -0,0 +1,107 @@
+import os
+import tempfile
+import time
+import unittest
+
+from work_queue import BackfillQueue
+
+DATES = ["2024-01-01", "2024-01-02", "2024-01-03", "2024-01-04"]
+METRICS = ["sleep", "steps"]
+
+
+class BackfillQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "queue.sqlite")
+        self.queues = []
+
+    def tearDown(self):
+        for queue in self.queues:
+            queue.close()
+        self.directory.cleanup()
+
+    def queue(self, worker_id="worker-a", **kwargs):
+        queue = BackfillQueue(self.path, worker_id, **kwargs)
+        self.queues.append(queue)
+        return queue
+
+    def drain(self, queue):
+        tasks = []
+        while (task := queue.lease()) is not None:
+            tasks.append(task)
+            self.assertTrue(queue.complete(*task))
+        return tasks
+
+    def test_enqueue_keeps_finished_tasks(self):
+        queue = self.queue()
+        self.assertEqual(queue.enqueue(DATES, METRICS), 8)
+        self.assertTrue(queue.complete(*queue.lease()))
+        self.assertEqual(queue.enqueue(DATES, METRICS), 0)
+        self.assertEqual(queue.counts(), {"done": 1, "pending": 7})
+
+    def test_newest_date_first_in_metric_order(self):
+        queue = self.queue()
+        queue.enqueue(DATES, METRICS)
+        self.assertEqual(self.drain(queue), [(date_str, metric) for date_str in reversed(DATES) for metric in METRICS])
+        self.assertEqual(queue.outstanding(), 0)
+
+    def test_expired_lease_is_handed_out_again(self):
+        first = self.queue("worker-a", lease_seconds=0.3)
+        second = self.queue("worker-b", lease_seconds=0.3)
+        first.enqueue(DATES[:1], METRICS[:1])
+        task = first.lease()
+        first.close() # no more lease renewals, as if the worker died
+        self.assertIsNone(second.lease())
+        time.sleep(0.5)
+        self.assertEqual(second.lease(), task)
+        # The first worker lost its lease : it can't finish or fail the task any more
+        self.assertFalse(first.complete(*task))
+        self.assertFalse(first.fail(*task, "late"))
+        self.assertTrue(second.complete(*task))
+        self.assertEqual(second.counts(), {"done": 1})
+
+    def test_heartbeat_keeps_a_slow_task_leased(self):
+        first = self.queue("worker-a", lease_seconds=0.3)
+        second = self.queue("worker-b", lease_seconds=0.3)
+        first.enqueue(DATES[:1], METRICS[:1])
+        task = first.lease()
+        time.sleep(0.6)
+        self.assertIsNone(second.lease())
+        self.assertFalse(second.complete(*task))
+        self.assertTrue(first.complete(*task))
+
+    def test_failed_attempts(self):
+        queue = self.queue(max_attempts=2)
+        queue.enqueue(DATES[:1], METRICS[:1])
+        task = queue.lease()
+        self.assertTrue(queue.fail(*task, "timeout"))
+        self.assertEqual(queue.counts(), {"pending": 1})
+        self.assertEqual(queue.lease(), task)
+        self.assertTrue(queue.fail(*task, "timeout"))
+        self.assertEqual(queue.counts(), {"failed": 1})
+        self.assertIsNone(queue.lease())
+        self.assertFalse(queue.fail(*task, "timeout")) # not leased any more
+
+    def test_delayed_tasks_wait(self):
+        queue = self.queue()
+        queue.enqueue(DATES[:1], METRICS[:1])
+        task = queue.lease()
+        self.assertTrue(queue.release(*task, delay_seconds=60))
+        self.assertIsNone(queue.lease())
+        self.assertEqual(queue.outstanding(), 1)
+
+    def test_shards_split_the_dates(self):
+        shards = [self.queue(f"worker-{index}", shard_index=index, shard_count=3) for index in range(3)]
+        shards[0].enqueue(DATES, METRICS)
+        leased = [self.drain(shard) for shard in shards]
+        for tasks in leased:
+            # A date is in one shard only, with all of its metrics
+            self.assertEqual(len(tasks), len({date_str for date_str, metric in tasks}) * len(METRICS))
+        self.assertEqual(sorted(task for tasks in leased for task in tasks), sorted((date_str, metric) for date_str in DATES for metric in METRICS))
+        date_shards = [{date_str for date_str, metric in tasks} for tasks in leased]
+        self.assertFalse(date_shards[0] & date_shards[1] or date_shards[0] & date_shards[2] or date_shards[1] & date_shards[2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import os
+import tempfile
+import unittest
+
+from write_spool import RECORD_HEADER, WriteSpool
+
+
+def batch(number):
+    return f"HeartRateIntraday HeartRate={number}i {1704067200000 + number}".encode('utf-8')
+
+
+class Receiver:
+    """send() of replay, accepting at most limit batches."""
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.batches = []
+
+    def __call__(self, precision, sent_batch):
+        if self.limit is not None and len(self.batches) >= self.limit:
+            return False
+        self.batches.append((precision, sent_batch))
+        return True
+
+
+class WriteSpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = self.directory.name
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def segments(self):
+        return sorted(name for name in os.listdir(self.path) if name.endswith(".spool"))
+
+    def test_replays_in_order_across_segments(self):
+        spool = WriteSpool(self.path, max_segment_bytes=200)
+        for number in range(10):
+            spool.append('ms', batch(number))
+        self.assertGreater(len(self.segments()), 1)
+        receiver = Receiver()
+        self.assertEqual(spool.replay(receiver), 10)
+        self.assertEqual(receiver.batches, [('ms', batch(number)) for number in range(10)])
+        self.assertEqual(self.segments(), [])
+        self.assertEqual(spool.pending_bytes(), 0)
+
+    def test_cursor_resumes_after_the_last_sent_batch(self):
+        spool = WriteSpool(self.path, max_segment_bytes=200)
+        for number in range(10):
+            spool.append('s', batch(number))
+        first = Receiver(limit=4)
+        self.assertEqual(spool.replay(first), 4)
+        # A new spool on the same directory, as after a restart
+        restarted = WriteSpool(self.path, max_segment_bytes=200)
+        second = Receiver()
+        self.assertEqual(restarted.replay(second), 6)
+        self.assertEqual(first.batches + second.batches, [('s', batch(number)) for number in range(10)])
+
+    def test_pending_bytes_excludes_replayed_records(self):
+        spool = WriteSpool(self.path)
+        for number in range(4):
+            spool.append('ms', batch(number))
+        total = spool.pending_bytes()
+        spool.replay(Receiver(limit=1))
+        self.assertEqual(spool.pending_bytes(), total - RECORD_HEADER.size - len(b'ms ' + batch(0)))
+
+    def test_corrupt_record_ends_its_segment(self):
+        spool = WriteSpool(self.path, max_segment_bytes=200)
+        for number in range(6):
+            spool.append('ms', batch(number))
+        first_segment = os.path.join(self.path, self.segments()[0])
+        records_in_first = os.path.getsize(first_segment) // (RECORD_HEADER.size + len(b'ms ' + batch(0)))
+        # Torn write : the second record of the first segment loses its last byte
+        with open(first_segment, "r+b") as segment_file:
+            data = bytearray(segment_file.read())
+            record_size = RECORD_HEADER.size + len(b'ms ' + batch(1))
+            data[2 * record_size - 1] ^= 0xFF
+            segment_file.seek(0)
+            segment_file.write(data)
+        receiver = Receiver()
+        with self.assertLogs(level='WARNING'):
+            spool.replay(receiver)
+        # The records after the corrupt one in its segment are skipped, the next segments are replayed
+        self.assertEqual(receiver.batches, [('ms', batch(number)) for number in [0] + list(range(records_in_first, 6))])
+        self.assertEqual(spool.corrupt_records, 1)
+        self.assertEqual(self.segments(), [])
+
+    def test_truncated_record_ends_its_segment(self):
+        spool = WriteSpool(self.path)
+        for number in range(3):
+            spool.append('ms', batch(number))
+        segment = os.path.join(self.path, self.segments()[0])
+        os.truncate(segment, os.path.getsize(segment) - 3)
+        receiver = Receiver()
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(spool.replay(receiver), 2)
+        self.assertEqual(spool.corrupt_records, 1)
+
+    def test_size_cap_drops_the_oldest_segments(self):
+        record_size = RECORD_HEADER.size + len(b'ms ' + batch(0))
+        spool = WriteSpool(self.path, max_segment_bytes=2 * record_size, max_total_bytes=4 * record_size)
+        with self.assertLogs(level='ERROR'):
+            for number in range(10):
+                spool.append('ms', batch(number))
+        self.assertLessEqual(spool.pending_bytes(), 4 * record_size)
+        self.assertEqual(spool.dropped_bytes, 6 * record_size)
+        receiver = Receiver()
+        spool.replay(receiver)
+        self.assertEqual(receiver.batches, [('ms', batch(number)) for number in range(6, 10)])
+
+
+if __name__ == '__main__':
+    unittest.main()
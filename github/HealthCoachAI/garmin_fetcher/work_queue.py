@@ -0,0 +1,117 @@
+import logging, os, sqlite3, threading, time
+from datetime import datetime
+from state_store import immediate_transaction
+
+
+class BackfillQueue:
+    """Durable queue of (date, metric) fetch tasks for bulk backfills, stored in a SQLite file.
+
+    Several fetcher processes (or pods sharing a volume) can work on the same queue : a task is leased
+    by one worker at a time and goes back to the queue when its lease expires, so a crash or restart
+    resumes exactly at the unfinished tasks. Dates are split into shard_count shards by day number and
+    a worker only leases tasks of its own shard_index. Tasks are handed out newest date first.
+    A heartbeat thread renews the leases this worker holds every third of lease_seconds, so a slow task
+    is not handed out twice, and complete/release/fail only change a task this worker still holds.
+    """
+
+    def __init__(self, path, worker_id, lease_seconds=900, shard_index=0, shard_count=1, max_attempts=3):
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.shard_index = shard_index
+        self.shard_count = max(1, shard_count)
+        self.max_attempts = max_attempts
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS tasks (
+            date TEXT NOT NULL,
+            metric TEXT NOT NULL,
+            metric_order INTEGER NOT NULL,
+            day_number INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            worker TEXT,
+            lease_expires REAL,
+            not_before REAL NOT NULL DEFAULT 0,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            PRIMARY KEY (date, metric))""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS tasks_status_date ON tasks (status, date)")
+        self._stopped = threading.Event()
+        self._heartbeat = threading.Thread(target=self._renew_leases, name="backfill-queue-heartbeat", daemon=True)
+        self._heartbeat.start()
+
+    def enqueue(self, dates, metrics):
+        """Adds the missing (date, metric) tasks and returns how many were new. Finished tasks are kept as they are."""
+        rows = [(date_str, metric, order, datetime.strptime(date_str, "%Y-%m-%d").toordinal()) for date_str in dates for order, metric in enumerate(metrics)]
+        with self._lock:
+            with immediate_transaction(self._db):
+                before = self._db.execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
+                self._db.executemany("INSERT OR IGNORE INTO tasks (date, metric, metric_order, day_number) VALUES (?, ?, ?, ?)", rows)
+                after = self._db.execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
+        return after - before
+
+    def lease(self):
+        """Claims the next available task of this worker's shard, returns (date, metric) or None."""
+        now = time.time()
+        with self._lock:
+            with immediate_transaction(self._db):
+                row = self._db.execute(
+                    """SELECT date, metric FROM tasks
+                    WHERE day_number % ? = ?
+                    AND ((status = 'pending' AND not_before <= ?) OR (status = 'leased' AND lease_expires < ?))
+                    ORDER BY date DESC, metric_order LIMIT 1""",
+                    (self.shard_count, self.shard_index, now, now)
+                ).fetchone()
+                if row:
+                    self._db.execute(
+                        "UPDATE tasks SET status = 'leased', worker = ?, lease_expires = ? WHERE date = ? AND metric = ?",
+                        (self.worker_id, now + self.lease_seconds, row[0], row[1])
+                    )
+        return tuple(row) if row else None
+
+    def complete(self, date_str, metric):
+        """Marks a leased task done, returns False if this worker no longer holds its lease."""
+        return self._update("UPDATE tasks SET status = 'done', worker = NULL, lease_expires = NULL, last_error = NULL WHERE date = ? AND metric = ? AND status = 'leased' AND worker = ?", (date_str, metric, self.worker_id))
+
+    def release(self, date_str, metric, delay_seconds=0):
+        """Puts a leased task back without counting it as a failed attempt (rate limits, re-login)."""
+        return self._update("UPDATE tasks SET status = 'pending', worker = NULL, lease_expires = NULL, not_before = ? WHERE date = ? AND metric = ? AND status = 'leased' AND worker = ?", (time.time() + delay_seconds, date_str, metric, self.worker_id))
+
+    def fail(self, date_str, metric, error, delay_seconds=0):
+        """Records a failed attempt, the task is retried after delay_seconds until max_attempts is reached."""
+        return self._update(
+            """UPDATE tasks SET attempts = attempts + 1, last_error = ?, worker = NULL, lease_expires = NULL, not_before = ?,
+            status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END
+            WHERE date = ? AND metric = ? AND status = 'leased' AND worker = ?""",
+            (str(error), time.time() + delay_seconds, self.max_attempts, date_str, metric, self.worker_id)
+        )
+
+    def outstanding(self):
+        """Number of tasks of this worker's shard which are not finished yet (pending or leased by any worker)."""
+        with self._lock:
+            return self._db.execute(
+                "SELECT COUNT(*) FROM tasks WHERE day_number % ? = ? AND status IN ('pending', 'leased')",
+                (self.shard_count, self.shard_index)
+            ).fetchone()[0]
+
+    def counts(self):
+        with self._lock:
+            return dict(self._db.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall())
+
+    def close(self):
+        """Stops renewing the leases of this worker, the tasks it still holds go back to the queue when they expire."""
+        self._stopped.set()
+        self._heartbeat.join()
+
+    def _renew_leases(self):
+        while not self._stopped.wait(self.lease_seconds / 3):
+            try:
+                self._update("UPDATE tasks SET lease_expires = ? WHERE status = 'leased' AND worker = ?", (time.time() + self.lease_seconds, self.worker_id))
+            except sqlite3.Error:
+                logging.exception("Backfill queue : failed to renew the leases of this worker")
+
+    def _update(self, query, params):
+        # Returns True if the query changed a task
+        with self._lock:
+            return self._db.execute(query, params).rowcount > 0
@@ -0,0 +1,97 @@
+import logging, threading, time
+
+
+class WritePipeline:
+    """Background writer merging the points of many metrics and days into large InfluxDB writes.
+
+    submit() queues points with an optional callback and returns at once, unless more than max_pending_points
+    are already waiting : the fetch loop then blocks until the writer catches up. The writer sends a batch
+    once flush_points points are queued or the oldest queued points have waited flush_seconds.
+    write_batch(points) must return True on success : the on_success callbacks of a batch only run after a successful
+    write, its on_failure callbacks after a failed one.
+    """
+
+    def __init__(self, write_batch, flush_points=50000, flush_seconds=5, max_pending_points=500000):
+        self.write_batch = write_batch
+        self.flush_points = flush_points
+        self.flush_seconds = flush_seconds
+        self.max_pending_points = max_pending_points
+        self.written_batches = 0
+        self.failed_batches = 0
+        self._items = []
+        self._pending_points = 0
+        self._oldest_item_time = None
+        self._writing = False
+        self._flush_requested = False
+        self._failed_since_flush = False
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="influxdb-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, points, point_count, on_success=None, on_failure=None):
+        with self._condition:
+            while self._pending_points and self._pending_points + point_count > self.max_pending_points and not self._closed:
+                self._condition.wait()
+            if self._closed:
+                raise RuntimeError("Write pipeline is closed")
+            if not self._items:
+                self._oldest_item_time = time.monotonic()
+            self._items.append((points, on_success, on_failure))
+            self._pending_points += point_count
+            self._condition.notify_all()
+
+    def flush(self):
+        """Blocks until everything submitted so far is written, returns False if any write failed since the last flush."""
+        with self._condition:
+            self._flush_requested = True
+            self._condition.notify_all()
+            while self._items or self._writing:
+                self._condition.wait()
+            self._flush_requested = False
+            failed, self._failed_since_flush = self._failed_since_flush, False
+        return not failed
+
+    def close(self):
+        succeeded = self.flush()
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+        return succeeded
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._closed:
+                    if self._items and (self._flush_requested or self._pending_points >= self.flush_points or time.monotonic() - self._oldest_item_time >= self.flush_seconds):
+                        break
+                    self._condition.wait(self.flush_seconds if not self._items else max(0.0, self._oldest_item_time + self.flush_seconds - time.monotonic()))
+                if self._closed and not self._items:
+                    return
+                items, self._items = self._items, []
+                self._pending_points = 0
+                self._writing = True
+                self._condition.notify_all() # make room for blocked submitters
+            batch = [point for points, on_success, on_failure in items for point in points]
+            try:
+                succeeded = self.write_batch(batch)
+            except Exception:
+                logging.exception("Write pipeline : unexpected error while writing a batch")
+                succeeded = False
+            # Callbacks only report the outcome of the write : one raising doesn't fail the batch or the other items
+            for points, on_success, on_failure in items:
+                callback = on_success if succeeded else on_failure
+                if callback:
+                    try:
+                        callback()
+                    except Exception:
+                        logging.exception("Write pipeline : unexpected error in a %s write callback", "successful" if succeeded else "failed")
+            with self._condition:
+                if succeeded:
+                    self.written_batches += 1
+                else:
+                    self.failed_batches += 1
+                    self._failed_since_flush = True
+                self._writing = False
+                self._condition.notify_all()
@@ -0,0 +1,108 @@
+import logging, os, struct, threading, zlib
+
+RECORD_HEADER = struct.Struct("<II") # payload length, crc32 of the payload
+
+
+class WriteSpool:
+    """Append-only spool of line protocol batches which could not be written to InfluxDB.
+
+    Batches are appended as length + crc32 framed records to numbered segment files in directory, a new
+    segment is started once the current one reaches max_segment_bytes. replay() sends the records back in
+    the order they were spooled and remembers its position in a cursor file, so a crash while replaying
+    resumes after the last record which was sent. A record failing its checksum ends its segment (torn
+    write at a crash). Above max_total_bytes the oldest segments are dropped.
+    """
+
+    def __init__(self, directory, max_segment_bytes=8 * 2**20, max_total_bytes=512 * 2**20):
+        self.directory = directory
+        self.max_segment_bytes = max_segment_bytes
+        self.max_total_bytes = max_total_bytes
+        self.spooled_batches = 0
+        self.replayed_batches = 0
+        self.dropped_bytes = 0
+        self.corrupt_records = 0
+        self._lock = threading.RLock()
+        os.makedirs(directory, exist_ok=True)
+        self._cursor_path = os.path.join(directory, "cursor")
+
+    def _segments(self):
+        return sorted(name for name in os.listdir(self.directory) if name.endswith(".spool"))
+
+    def _segment_path(self, name):
+        return os.path.join(self.directory, name)
+
+    def pending_bytes(self):
+        with self._lock:
+            segment, offset = self._read_cursor()
+            return sum(os.path.getsize(self._segment_path(name)) for name in self._segments()) - (offset if segment in self._segments() else 0)
+
+    def append(self, precision, batch):
+        """Spools one line protocol batch (bytes) written at the given precision."""
+        payload = precision.encode("ascii") + b" " + batch
+        record = RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        with self._lock:
+            segments = self._segments()
+            if not segments or os.path.getsize(self._segment_path(segments[-1])) + len(record) > self.max_segment_bytes:
+                next_number = int(segments[-1].split(".")[0]) + 1 if segments else 1
+                segments.append(f"{next_number:012d}.spool")
+            with open(self._segment_path(segments[-1]), "ab") as segment_file:
+                segment_file.write(record)
+                segment_file.flush()
+                os.fsync(segment_file.fileno())
+            self.spooled_batches += 1
+            self._enforce_size_cap()
+
+    def replay(self, send):
+        """Sends spooled batches in order with send(precision, batch) until it returns False, returns the number of batches sent."""
+        replayed = 0
+        with self._lock:
+            for name in self._segments():
+                cursor_segment, offset = self._read_cursor()
+                offset = offset if cursor_segment == name else 0
+                with open(self._segment_path(name), "rb") as segment_file:
+                    segment_file.seek(offset)
+                    while True:
+                        header = segment_file.read(RECORD_HEADER.size)
+                        if len(header) < RECORD_HEADER.size:
+                            break
+                        length, crc = RECORD_HEADER.unpack(header)
+                        payload = segment_file.read(length)
+                        if len(payload) < length or zlib.crc32(payload) != crc:
+                            self.corrupt_records += 1
+                            logging.warning(f"Write spool : corrupt record in segment {name} at offset {offset} - skipping the rest of the segment")
+                            break
+                        precision, batch = payload.split(b" ", 1)
+                        if not send(precision.decode("ascii"), batch):
+                            return replayed
+                        offset += RECORD_HEADER.size + length
+                        self._write_cursor(name, offset)
+                        replayed += 1
+                        self.replayed_batches += 1
+                os.remove(self._segment_path(name))
+                self._write_cursor("", 0)
+        return replayed
+
+    def _enforce_size_cap(self):
+        segments = self._segments()
+        total = sum(os.path.getsize(self._segment_path(name)) for name in segments)
+        while total > self.max_total_bytes and len(segments) > 1:
+            oldest = segments.pop(0)
+            size = os.path.getsize(self._segment_path(oldest))
+            os.remove(self._segment_path(oldest))
+            total -= size
+            self.dropped_bytes += size
+            logging.error(f"Write spool : size cap of {self.max_total_bytes / 2**20:.0f} MB reached - dropped oldest segment {oldest} ({size / 2**20:.1f} MB)")
+
+    def _read_cursor(self):
+        try:
+            with open(self._cursor_path) as cursor_file:
+                segment, offset = cursor_file.read().split()
+            return segment, int(offset)
+        except (FileNotFoundError, ValueError):
+            return "", 0
+
+    def _write_cursor(self, segment, offset):
+        temporary_path = self._cursor_path + ".tmp"
+        with open(temporary_path, "w") as cursor_file:
+            cursor_file.write(f"{segment or '-'} {offset}")
+        os.replace(temporary_path, self._cursor_path)